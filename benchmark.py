@@ -0,0 +1,206 @@
+# -*-coding:utf-8-*-
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from similarity import LocalMethods
+
+# number of nodes of every scale and the (generator, parameters) of every graph model
+GRAPH_SCALES = {
+    'small': 2000,
+    'medium': 20000,
+    'large': 100000,
+}
+GRAPH_MODELS = {
+    'er': ('erdos_renyi', {'mean_degree': 10}),
+    'ba': ('barabasi_albert', {'edges_per_node': 5}),
+    'powerlaw': ('power_law_configuration', {'exponent': 2.3, 'min_degree': 2}),
+}
+
+
+def _edge_frame(source, target):
+    """
+    drop self loops and repeated undirected edges
+    return : df_edge_list
+        source     target
+    """
+    source, target = np.minimum(source, target), np.maximum(source, target)
+    keep = source != target
+    pairs = np.unique(np.stack([source[keep], target[keep]], axis=1), axis=0)
+    return pd.DataFrame({'source': pairs[:, 0], 'target': pairs[:, 1]})
+
+
+def erdos_renyi(num_nodes, seed, mean_degree=10):
+    """
+    G(n, m) random graph with num_nodes * mean_degree / 2 edges drawn uniformly
+    """
+    rng = np.random.default_rng(seed)
+    num_edges = num_nodes * mean_degree // 2
+    return _edge_frame(rng.integers(0, num_nodes, num_edges), rng.integers(0, num_nodes, num_edges))
+
+
+def barabasi_albert(num_nodes, seed, edges_per_node=5):
+    """
+    preferential attachment, every new node links to edges_per_node existing nodes chosen proportionally to degree
+    """
+    rng = np.random.default_rng(seed)
+    # every edge end appears once in ends, so a uniform draw from ends is proportional to degree
+    ends = np.zeros(2 * num_nodes * edges_per_node, dtype=np.int64)
+    source = np.zeros(num_nodes * edges_per_node, dtype=np.int64)
+    target = np.zeros(num_nodes * edges_per_node, dtype=np.int64)
+
+    seed_nodes = edges_per_node + 1
+    first = np.array([(i, j) for i in range(seed_nodes) for j in range(i)], dtype=np.int64).reshape(-1, 2)
+    num_edges = len(first)
+    source[:num_edges], target[:num_edges] = first[:, 0], first[:, 1]
+    ends[:2 * num_edges] = first.ravel()
+
+    for node in range(seed_nodes, num_nodes):
+        chosen = ends[rng.integers(0, 2 * num_edges, edges_per_node)]
+        source[num_edges:num_edges + edges_per_node] = node
+        target[num_edges:num_edges + edges_per_node] = chosen
+        ends[2 * num_edges:2 * num_edges + 2 * edges_per_node:2] = node
+        ends[2 * num_edges + 1:2 * num_edges + 2 * edges_per_node:2] = chosen
+        num_edges += edges_per_node
+
+    return _edge_frame(source[:num_edges], target[:num_edges])
+
+
+def power_law_configuration(num_nodes, seed, exponent=2.3, min_degree=2):
+    """
+    configuration model with a power law degree sequence P(k) ~ k^-exponent, k >= min_degree,
+    the stubs are matched at random, self loops and repeated edges are dropped
+    """
+    rng = np.random.default_rng(seed)
+    degree = np.floor(min_degree * (1 - rng.random(num_nodes)) ** (-1.0 / (exponent - 1))).astype(np.int64)
+    degree = np.minimum(degree, num_nodes - 1)
+    if degree.sum() % 2:
+        degree[0] += 1
+
+    stubs = rng.permutation(np.repeat(np.arange(num_nodes), degree))
+    return _edge_frame(stubs[0::2], stubs[1::2])
+
+
+def make_graph(model, scale, seed):
+    generator_name, parameters = GRAPH_MODELS[model]
+    return globals()[generator_name](GRAPH_SCALES[scale], seed, **parameters)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _run_one(task):
+    """
+    time one index on one graph in a fresh process, so the peak RSS belongs to this index only
+    """
+    model, scale, seed, name, engine, repeat = task
+    df_edge_list = make_graph(model, scale, seed)
+
+    local = LocalMethods(df_edge_list, engine=engine)
+    start = time.perf_counter()
+    local.get_adjacency()
+    build_seconds = time.perf_counter() - start
+    rss_before = _peak_rss_mb()
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        getattr(local, 'cal_' + name)()
+        seconds.append(time.perf_counter() - start)
+
+    return {'seconds': min(seconds), 'build_seconds': build_seconds, 'peak_rss_mb': _peak_rss_mb(),
+            'rss_before_mb': rss_before}
+
+
+def run_benchmark(models, scales, names=None, engine='pandas', repeat=1, seed=0):
+    """
+    time every index of LocalMethods on the synthetic graphs, the quasi-local LP and Katz included,
+    with their default parameters
+
+    return : {'config': ..., 'results': {'<model>-<scale>': {'edges': m, '<index>': {'seconds': ..., ...}}}}
+    """
+    names = names or LocalMethods.similarity_names + LocalMethods.quasi_local_names
+    report = {'config': {'engine': engine, 'repeat': repeat, 'seed': seed, 'python': platform.python_version(),
+                         'numpy': np.__version__, 'pandas': pd.__version__},
+              'results': {}}
+
+    context = multiprocessing.get_context('spawn')
+    for model in models:
+        for scale in scales:
+            graph_name = '%s-%s' % (model, scale)
+            graph_result = {'nodes': GRAPH_SCALES[scale], 'edges': len(make_graph(model, scale, seed))}
+            for name in names:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    graph_result[name] = pool.apply(_run_one, ((model, scale, seed, name, engine, repeat),))
+                print('%-16s %-8s %9.3fs %9.1fMB' % (graph_name, name, graph_result[name]['seconds'],
+                                                       graph_result[name]['peak_rss_mb']))
+            report['results'][graph_name] = graph_result
+    return report
+
+
+def compare_with_baseline(report, baseline, threshold=0.2, min_seconds=0.05):
+    """
+    find the (graph, index) pairs that got slower or used more memory than the baseline by more than threshold,
+    timings below min_seconds in both runs are treated as noise
+
+    return : list of regression messages, empty when there is none
+    """
+    regressions = []
+    for graph_name, graph_result in report['results'].items():
+        base_graph = baseline.get('results', {}).get(graph_name, {})
+        for name, result in graph_result.items():
+            if not isinstance(result, dict) or name not in base_graph:
+                continue
+            base = base_graph[name]
+            if max(result['seconds'], base['seconds']) >= min_seconds and \
+                    result['seconds'] > base['seconds'] * (1 + threshold):
+                regressions.append('%s %s time %.3fs -> %.3fs' % (graph_name, name, base['seconds'],
+                                                                  result['seconds']))
+            if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold):
+                regressions.append('%s %s peak RSS %.1fMB -> %.1fMB' % (graph_name, name, base['peak_rss_mb'],
+                                                                       result['peak_rss_mb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark LocalMethods on synthetic graphs')
+    parser.add_argument('--models', nargs='+', default=sorted(GRAPH_MODELS), choices=sorted(GRAPH_MODELS))
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(GRAPH_SCALES))
+    parser.add_argument('--indices', nargs='+', default=None,
+                        choices=LocalMethods.similarity_names + LocalMethods.quasi_local_names)
+    parser.add_argument('--engine', default='pandas', choices=LocalMethods.engines)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown / memory growth')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.models, args.scales, args.indices, args.engine, args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_with_baseline(report, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# -*-coding:utf-8-*-
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def file_digest(file_name, block_size=1 << 20):
+    """
+    the sha256 of the contents of a file, read block by block
+    """
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def array_digest(arrays):
+    """
+    the sha256 of the dtypes, shapes and contents of a sequence of numpy arrays (memory-mapped ones too),
+    object arrays (string node IDs) are hashed as fixed width strings, their memory only holds pointers
+    """
+    sha = hashlib.sha256()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        array = np.ascontiguousarray(array)
+        sha.update(('%s%s' % (array.dtype.str, array.shape)).encode('utf-8'))
+        sha.update(memoryview(array).cast('B'))
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """
+    a content-addressed cache of the artifacts of a run, shared by the processes of one machine
+    an entry is a directory of files addressed by the sha256 of the contents of the inputs and the parameters
+    (see key), so an unchanged input with the same parameters finds the artifacts of an earlier run
+
+    layout of cache_dir:
+        index.json ----> key -> {'kind', 'bytes', 'last_used'} of every entry
+        digests.json ----> input file -> [size, mtime_ns, sha256], an input is only read again when it changed
+        entries/<key> ----> the files of an entry
+        locks/<key>.lock ----> held while an entry is computed, read or evicted
+
+    every update of the json files holds an exclusive flock on cache_dir/.lock and replaces the file atomically,
+    an entry is built in a temporary directory and renamed into entries/ when it is complete,
+    when the entries exceed max_bytes the least recently used ones that nobody holds are removed
+    """
+
+    def __init__(self, cache_dir='../temp/result_cache', max_bytes=16 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry_dir = os.path.join(cache_dir, 'entries')
+        self.lock_dir = os.path.join(cache_dir, 'locks')
+        for directory in (self.entry_dir, self.lock_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    @contextmanager
+    def _flock(self, lock_file_name, exclusive=True, blocking=True):
+        """
+        hold a flock on lock_file_name, yield False instead of waiting when blocking is False and it is held
+        """
+        with open(lock_file_name, 'a') as lock_file:
+            operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _key_lock(self, key, blocking=True):
+        return self._flock(os.path.join(self.lock_dir, key + '.lock'), blocking=blocking)
+
+    def _read_json(self, name):
+        file_name = os.path.join(self.cache_dir, name)
+        if not os.path.exists(file_name):
+            return {}
+        with open(file_name) as json_file:
+            return json.load(json_file)
+
+    def _write_json(self, name, content):
+        handle, temp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as json_file:
+            json.dump(content, json_file)
+        os.replace(temp_name, os.path.join(self.cache_dir, name))
+
+    @contextmanager
+    def _locked_json(self, name):
+        """
+        read-modify-write a json file of the cache under the cache lock
+        """
+        with self._flock(os.path.join(self.cache_dir, '.lock')):
+            content = self._read_json(name)
+            yield content
+            self._write_json(name, content)
+
+    def file_digests(self, file_names):
+        """
+        the sha256 of every input file, reused from digests.json while its size and mtime are unchanged
+        """
+        stats = dict((file_name, os.stat(file_name)) for file_name in file_names)
+        known = self._read_json('digests.json')
+        digests, computed = [], {}
+        for file_name in file_names:
+            path = os.path.abspath(file_name)
+            stamp = [stats[file_name].st_size, stats[file_name].st_mtime_ns]
+            if known.get(path, [None, None, None])[:2] == stamp:
+                digests.append(known[path][2])
+                continue
+            digest = file_digest(file_name)
+            computed[path] = stamp + [digest]
+            digests.append(digest)
+        if computed:
+            with self._locked_json('digests.json') as known:
+                known.update(computed)
+        return digests
+
+    def key(self, kind, params=None, file_names=(), arrays=()):
+        """
+        the address of an entry
+        input: kind ----> what the entry holds, e.g. 'node_renumber'
+               params ----> json serializable parameters of the method
+               file_names ----> input files, addressed by their contents, not their names
+               arrays ----> input numpy arrays, addressed by their contents
+
+        return : hex sha256
+        """
+        content = {'kind': kind, 'params': params or {}, 'files': self.file_digests(list(file_names)),
+                   'arrays': array_digest(arrays) if len(arrays) > 0 else None}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _directory_bytes(directory):
+        return sum(os.path.getsize(os.path.join(root, file_name)) for root, _, file_names in os.walk(directory)
+                   for file_name in file_names)
+
+    @contextmanager
+    def open_entry(self, key, kind=''):
+        """
+        with cache.open_entry(key) as (entry_dir, hit):
+            if not hit:
+                write the artifacts into entry_dir
+            read the artifacts from entry_dir
+        the lock of the key is held for the whole block, so a concurrent job waits and then hits instead of
+        computing the same entry again, a block that raises leaves no entry behind
+        """
+        entry_dir = os.path.join(self.entry_dir, key)
+        with self._key_lock(key):
+            if os.path.isdir(entry_dir):
+                with self._locked_json('index.json') as index:
+                    record = index.setdefault(key, {'kind': kind, 'bytes': self._directory_bytes(entry_dir)})
+                    record['last_used'] = time.time()
+                yield entry_dir, True
+                return
+
+            temp_dir = tempfile.mkdtemp(dir=self.entry_dir, prefix='.building_')
+            try:
+                yield temp_dir, False
+                os.rename(temp_dir, entry_dir)
+            except BaseException:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+            with self._locked_json('index.json') as index:
+                index[key] = {'kind': kind, 'bytes': self._directory_bytes(entry_dir), 'last_used': time.time()}
+                self._evict(index, keep=key)
+
+    def _evict(self, index, keep=None):
+        """
+        remove the least recently used entries until the total fits max_bytes,
+        an entry whose lock is held by another process is skipped, keep is never removed
+        """
+        total = sum(record['bytes'] for record in index.values())
+        for key in sorted(index, key=lambda entry_key: index[entry_key]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            with self._key_lock(key, blocking=False) as locked:
+                if not locked:
+                    continue
+                shutil.rmtree(os.path.join(self.entry_dir, key), ignore_errors=True)
+            total -= index.pop(key)['bytes']
+
+    def clear(self):
+        """
+        remove every entry that nobody holds
+        """
+        with self._locked_json('index.json') as index:
+            saved_max_bytes, self.max_bytes = self.max_bytes, -1
+            try:
+                self._evict(index)
+            finally:
+                self.max_bytes = saved_max_bytes
+
+
+def store_files(entry_dir, files):
+    """
+    copy files into an entry
+    input: files ----> dict from the file names in the entry to the paths of the files
+    """
+    for entry_name, file_name in files.items():
+        shutil.copy(file_name, os.path.join(entry_dir, entry_name))
+
+
+def restore_files(entry_dir, files):
+    """
+    copy the files of an entry back in the order of files, the copies can be changed without touching the entry
+    input: files ----> dict from the file names in the entry to the paths to restore them to
+    """
+    for entry_name, file_name in files.items():
+        shutil.copy(os.path.join(entry_dir, entry_name), file_name)
+
+
+def _write_entry(entry_dir, num_bytes):
+    with open(os.path.join(entry_dir, 'data'), 'wb') as data_file:
+        data_file.write(b'x' * num_bytes)
+
+
+def test_result_cache():
+    work_dir = tempfile.mkdtemp()
+    cache = ResultCache(os.path.join(work_dir, 'cache'), max_bytes=250)
+    input_names = [os.path.join(work_dir, name) for name in ('a.edges', 'b.edges')]
+    for input_name in input_names:
+        with open(input_name, 'w') as input_file:
+            input_file.write('0 1\n1 2\n')
+
+    # the key follows the contents of the inputs and the parameters, not the file names
+    key = cache.key('test', {'k': 1}, input_names[:1])
+    assert key == cache.key('test', {'k': 1}, input_names[1:])
+    assert key != cache.key('test', {'k': 2}, input_names[:1])
+    with open(input_names[1], 'a') as input_file:
+        input_file.write('2 3\n')
+    assert key != cache.key('test', {'k': 1}, input_names[1:])
+
+    # a miss builds the entry, the next open hits it, a block that raises leaves nothing behind
+    with cache.open_entry(key, 'test') as (entry_dir, hit):
+        assert not hit
+        _write_entry(entry_dir, 100)
+    with cache.open_entry(key, 'test') as (entry_dir, hit):
+        assert hit and os.path.getsize(os.path.join(entry_dir, 'data')) == 100
+    try:
+        with cache.open_entry('failed', 'test') as (entry_dir, hit):
+            raise RuntimeError('the computation failed')
+    except RuntimeError:
+        pass
+    assert sorted(os.listdir(cache.entry_dir)) == [key]
+
+    # over max_bytes the least recently used entry goes, using the first entry again keeps it
+    with cache.open_entry('second', 'test') as (entry_dir, hit):
+        _write_entry(entry_dir, 100)
+    with cache.open_entry(key, 'test') as (entry_dir, hit):
+        assert hit
+    with cache.open_entry('third', 'test') as (entry_dir, hit):
+        _write_entry(entry_dir, 100)
+    assert sorted(os.listdir(cache.entry_dir)) == sorted([key, 'third'])
+    assert sorted(cache._read_json('index.json')) == sorted([key, 'third'])
+    cache.clear()
+    assert os.listdir(cache.entry_dir) == [] and cache._read_json('index.json') == {}
+
+    # equal strings in different object arrays hash the same
+    node_ids = np.array(['p%d' % i for i in range(50)], dtype=object)
+    assert array_digest([node_ids]) == array_digest([np.array(list(node_ids), dtype=object)])
+    assert array_digest([node_ids]) != array_digest([node_ids[::-1]])
+
+
+if __name__ == '__main__':
+    test_result_cache()
@@ -0,0 +1,256 @@
+# -*-coding:utf-8-*-
+
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+from similarity import LocalMethods
+
+
+def undirected_edges(df_edge_list):
+    """
+    the edges of df_edge_list (integer node IDs, e.g. renumbered by NodeReNumber) as sorted (smaller, larger)
+    pairs without self loops and repeated edges
+    return : source, target ----> int64 arrays with source < target
+    """
+    source = df_edge_list['source'].values.astype(np.int64)
+    target = df_edge_list['target'].values.astype(np.int64)
+    source, target = np.minimum(source, target), np.maximum(source, target)
+    keep = source != target
+    pairs = np.unique(np.stack([source[keep], target[keep]], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def split_edges(df_edge_list, probe_ratio=0.1, seed=0):
+    """
+    this method is implemented for splitting the undirected edges into a train set and a probe set at random
+    input:
+        df_edge_list ----> source and target columns, every undirected edge is kept once
+        probe_ratio ----> the fraction of the edges moved to the probe set
+        seed ----> seed of the shuffle
+    return : df_train, df_probe
+        source     target
+    """
+    source, target = undirected_edges(df_edge_list)
+    order = np.random.default_rng(seed).permutation(len(source))
+    num_probe = int(round(len(source) * probe_ratio))
+    probe, train = np.sort(order[:num_probe]), np.sort(order[num_probe:])
+    df_train = pd.DataFrame({'source': source[train], 'target': target[train]})
+    df_probe = pd.DataFrame({'source': source[probe], 'target': target[probe]})
+    return df_train, df_probe
+
+
+def sample_non_edges(df_edge_list, num_samples, seed=0, node_ids=None):
+    """
+    draw distinct node pairs uniformly among the pairs that are not edges of df_edge_list,
+    pairs are drawn in vectorized rounds and the self loops, edges and repeated pairs of a round are rejected
+    input:
+        df_edge_list ----> the edges to avoid, in either direction
+        num_samples ----> number of non-edges, at most the number of non-edges of the graph
+        seed ----> seed of the draws
+        node_ids ----> the nodes to draw from, all the nodes of df_edge_list when None
+    return : df_non_edge
+        source     target    (source < target)
+    """
+    if node_ids is None:
+        node_ids = np.unique(np.concatenate([df_edge_list['source'].values, df_edge_list['target'].values]))
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    num_nodes = len(node_ids)
+    source, target = undirected_edges(df_edge_list)
+    if num_samples > num_nodes * (num_nodes - 1) // 2 - len(source):
+        raise ValueError('the graph has fewer than %d non-edges' % num_samples)
+
+    # a pair (u, v) with u < v in compact IDs is the key u * num_nodes + v
+    edge_keys = np.searchsorted(node_ids, source) * num_nodes + np.searchsorted(node_ids, target)
+    edge_keys = edge_keys[np.isin(source, node_ids) & np.isin(target, node_ids)]
+    rng = np.random.default_rng(seed)
+    sampled = np.zeros(0, dtype=np.int64)
+    while len(sampled) < num_samples:
+        draws = max(2 * (num_samples - len(sampled)), 1024)
+        u = rng.integers(0, num_nodes, draws)
+        v = rng.integers(0, num_nodes, draws)
+        keys = np.minimum(u, v) * num_nodes + np.maximum(u, v)
+        keys = keys[(u != v) & ~np.isin(keys, edge_keys)]
+        sampled = np.concatenate([sampled, keys])
+        # keep the first draw of every pair, in draw order
+        _, first = np.unique(sampled, return_index=True)
+        sampled = sampled[np.sort(first)]
+    sampled = sampled[:num_samples]
+    return pd.DataFrame({'source': node_ids[sampled // num_nodes], 'target': node_ids[sampled % num_nodes]})
+
+
+def auc_score(probe_scores, non_edge_scores):
+    """
+    the probability that a probe edge scores higher than a non-edge, a tie counts 1/2,
+    computed from the ranks of all the scores (Mann-Whitney U) instead of comparing every pair
+    """
+    probe_scores = np.asarray(probe_scores, dtype=np.float64)
+    non_edge_scores = np.asarray(non_edge_scores, dtype=np.float64)
+    num_probe, num_non_edge = len(probe_scores), len(non_edge_scores)
+    if num_probe == 0 or num_non_edge == 0:
+        return np.nan
+    ranks = rankdata(np.concatenate([probe_scores, non_edge_scores]))
+    return (ranks[:num_probe].sum() - num_probe * (num_probe + 1) / 2.0) / (num_probe * num_non_edge)
+
+
+def precision_at(probe_scores, non_edge_scores, top_l):
+    """
+    the fraction of probe edges among the top_l highest scored pairs,
+    the pairs tied at the cut are shared out in proportion, which is the expectation over random tie breaks
+    """
+    probe_scores = np.asarray(probe_scores, dtype=np.float64)
+    non_edge_scores = np.asarray(non_edge_scores, dtype=np.float64)
+    scores = np.concatenate([probe_scores, non_edge_scores])
+    top_l = min(top_l, len(scores))
+    if top_l == 0:
+        return np.nan
+    cut = np.partition(scores, len(scores) - top_l)[len(scores) - top_l]
+    above = np.count_nonzero(scores > cut)
+    tied = np.count_nonzero(scores == cut)
+    probe_above = np.count_nonzero(probe_scores > cut)
+    probe_tied = np.count_nonzero(probe_scores == cut)
+    return (probe_above + (top_l - above) * probe_tied / float(tied)) / top_l
+
+
+def evaluate_split(df_edge_list, probe_ratio=0.1, num_non_edges=None, top_l=None, seed=0, names=None,
+                   **local_kwargs):
+    """
+    this method is implemented for one round of link prediction:
+    the probe edges are removed, the indices are computed on the train edges for the probe edges and
+    the sampled non-edges only (cal_candidate_similarity), and every index is scored by AUC and precision
+    input:
+        df_edge_list ----> the whole graph
+        probe_ratio ----> the fraction of the edges held out
+        num_non_edges ----> number of sampled non-edges, as many as the probe edges when None
+        top_l ----> L of precision@L, the number of probe edges when None
+        seed ----> seed of the split and of the non-edge sampling
+        names ----> the indices to score, LocalMethods.similarity_names when None
+        local_kwargs ----> the other arguments of LocalMethods, e.g. compact
+    return : df_evaluation
+        index     AUC     precision
+    """
+    names = names or LocalMethods.similarity_names
+    df_train, df_probe = split_edges(df_edge_list, probe_ratio, seed)
+    num_non_edges = len(df_probe) if num_non_edges is None else num_non_edges
+    top_l = len(df_probe) if top_l is None else top_l
+    # the non-edges of the whole graph, a probe edge is never drawn as a non-edge
+    df_non_edge = sample_non_edges(df_edge_list, num_non_edges, seed + 1)
+
+    local_methods = LocalMethods(df_train, **local_kwargs)
+    df_candidate = local_methods.cal_candidate_similarity(pd.concat([df_probe, df_non_edge], ignore_index=True))
+    num_probe = len(df_probe)
+
+    rows = []
+    for name in names:
+        scores = df_candidate[name].values
+        rows.append({'index': name, 'AUC': auc_score(scores[:num_probe], scores[num_probe:]),
+                     'precision': precision_at(scores[:num_probe], scores[num_probe:], top_l)})
+    return pd.DataFrame(rows, columns=['index', 'AUC', 'precision'])
+
+
+_worker_edge_list = None
+
+
+def _init_worker(df_edge_list):
+    global _worker_edge_list
+    _worker_edge_list = df_edge_list
+
+
+def _worker_evaluate_split(task):
+    repeat, seed, kwargs = task
+    df_evaluation = evaluate_split(_worker_edge_list, seed=seed, **kwargs)
+    df_evaluation.insert(0, 'repeat', repeat)
+    return df_evaluation
+
+
+def evaluate(df_edge_list, repeat=10, n_jobs=1, seed=0, **kwargs):
+    """
+    repeat evaluate_split on independent random splits, the splits run in a process pool when n_jobs > 1
+    (or -1 for all cores), every worker receives the edge list once
+    input:
+        repeat ----> number of splits, split i uses the seed seed + 2 * i
+        kwargs ----> the arguments of evaluate_split (probe_ratio, num_non_edges, top_l, names, compact, ...)
+    return : df_evaluation, one row per split and index
+        repeat     index     AUC     precision
+    """
+    tasks = [(i, seed + 2 * i, kwargs) for i in range(repeat)]
+    n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+    if n_jobs > 1 and repeat > 1:
+        with multiprocessing.Pool(min(n_jobs, repeat), initializer=_init_worker, initargs=(df_edge_list,)) as pool:
+            df_evaluation_list = pool.map(_worker_evaluate_split, tasks)
+    else:
+        _init_worker(df_edge_list)
+        df_evaluation_list = [_worker_evaluate_split(task) for task in tasks]
+    return pd.concat(df_evaluation_list, ignore_index=True)
+
+
+def summarize(df_evaluation):
+    """
+    the mean and standard deviation of AUC and precision over the splits, one row per index
+    """
+    df_summary = df_evaluation.groupby('index', sort=False)[['AUC', 'precision']].agg(['mean', 'std'])
+    df_summary.columns = ['%s_%s' % column for column in df_summary.columns]
+    return df_summary
+
+
+def test_evaluation():
+    rng = np.random.default_rng(0)
+    # integer scores tie often, a tie counts 1/2 in the pairwise comparison
+    probe_scores = rng.integers(0, 5, 40)
+    non_edge_scores = rng.integers(0, 5, 70)
+    pairwise = np.mean([1.0 if p > n else 0.5 if p == n else 0.0 for p in probe_scores for n in non_edge_scores])
+    assert np.isclose(auc_score(probe_scores, non_edge_scores), pairwise)
+
+    # without ties precision@L is the probe count among the L highest scores
+    probe_scores = rng.permutation(110)[:40] + 0.5
+    non_edge_scores = np.setdiff1d(np.arange(110) + 0.5, probe_scores)
+    labels = np.concatenate([np.ones(40), np.zeros(70)])
+    for top_l in (1, 10, 40, 110):
+        top = np.argsort(-np.concatenate([probe_scores, non_edge_scores]))[:top_l]
+        assert np.isclose(precision_at(probe_scores, non_edge_scores, top_l), labels[top].mean())
+    # 2 of the 4 pairs tied at the cut make the top 3, half of the tied pairs are probe edges
+    assert np.isclose(precision_at([2, 1, 1], [1, 1], 3), (1 + 2 * 2 / 4.0) / 3)
+
+    df_edge_list = pd.DataFrame({'source': rng.integers(0, 50, 300), 'target': rng.integers(0, 50, 300)})
+    source, target = undirected_edges(df_edge_list)
+    edges = set(zip(source, target))
+    df_train, df_probe = split_edges(df_edge_list, 0.2, seed=1)
+    train, probe = set(zip(df_train['source'], df_train['target'])), set(zip(df_probe['source'], df_probe['target']))
+    assert not train & probe and train | probe == edges and len(df_train) + len(df_probe) == len(edges)
+
+    df_non_edge = sample_non_edges(df_edge_list, 200, seed=2)
+    non_edges = set(zip(df_non_edge['source'], df_non_edge['target']))
+    assert len(non_edges) == 200 and not non_edges & edges
+    assert (df_non_edge['source'] < df_non_edge['target']).all()
+
+    # the pool runs the same splits
+    df_serial = evaluate(df_edge_list, repeat=3, n_jobs=1, names=['CN', 'JC', 'RA'])
+    df_pool = evaluate(df_edge_list, repeat=3, n_jobs=2, names=['CN', 'JC', 'RA'])
+    assert df_serial.equals(df_pool)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='link prediction AUC and precision of the LocalMethods indices')
+    parser.add_argument('edge_file', help='the renumbered edges of NodeReNumber, a "source target" header line first')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--probe-ratio', type=float, default=0.1)
+    parser.add_argument('--non-edges', type=int, default=None, help='sampled non-edges per split')
+    parser.add_argument('--top-l', type=int, default=None, help='L of precision@L, the probe size by default')
+    parser.add_argument('--indices', nargs='+', default=None, choices=LocalMethods.similarity_names)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compact', action='store_true')
+    args = parser.parse_args()
+
+    df_edge_list = pd.read_csv(args.edge_file, sep=r'\s+', low_memory=False)
+    df_evaluation = evaluate(df_edge_list, args.repeat, args.n_jobs, args.seed, probe_ratio=args.probe_ratio,
+                             num_non_edges=args.non_edges, top_l=args.top_l, names=args.indices,
+                             compact=args.compact)
+    print(summarize(df_evaluation).to_string(float_format='%.4f'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+# -*-coding:utf-8-*-
+
+import math
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+
+from profiling import stage
+from similarity import LocalMethods, SimilarityWriter, degree_normalize, expand_ranges, load_similarity
+
+
+class ExternalMethods(object):
+    """
+    the external memory mode of LocalMethods.cal_save_all_similarity, for edge files larger than RAM,
+    only the node table (node IDs, degrees and path counts, O(n)) and one partition are in memory at a time
+        1) read the edge file in chunks and spill both directions (middle, neighbor) of every edge
+           to num_partitions files hashed by the middle node
+        2) build the node table from the partitions and cut the source nodes into ranges
+           whose two-hop paths fit memory_budget
+        3) map: per partition, enumerate the neighbor pairs (x, y) of every middle node in batches,
+           pre-aggregate CN, AA and RA per pair and append them to the spill file of the range of x
+        4) reduce: per range, sum the partial scores of every pair and write all the indices
+    the interaction term of RA_CNI, CNI = A * W * A, spans three hops and takes a second pass keyed by W's edges:
+        3) the map also spills B = W * A, the walks u - v - y weighted by W[u, v] = |1 / k_u - 1 / k_v| of every
+           middle node v, to the partition of u
+        3b) per partition, every record (u, y) of B is joined with the neighbors x of u, whose edges are in the
+            same partition, and the partial CNI of (x, y) is appended to the spill file of the range of x
+        4) the reduce adds CNI to RA on the pairs with a common neighbour
+    the output files are the ones of LocalMethods.cal_save_all_similarity, sorted by source and then target
+
+    the edge file is the space separated "source target" file of NodeReNumber, node IDs are integers,
+    NodeReNumber itself reads the whole graph into memory, so the renumbering is not out of core
+
+    memory_budget (bytes) sizes the chunks, the batches and the ranges,
+    a node whose paths alone exceed it still gets a range of its own
+    spill_dir is where the spill files go, the system temp directory when None, they are removed at the end
+    num_partitions is the number of middle node partitions, estimated from the file size when None
+    half = True stores only the pairs with source < target like cal_save_all_similarity
+    profiler (profiling.StageProfiler) records the time, rows and memory of every stage, it is off when None
+    """
+
+    similarity_names = LocalMethods.similarity_names
+    # a partial score record of the map phase, key = source * n + target in compact node IDs
+    record_dtype = np.dtype([('key', np.int64), ('cn', np.int64), ('aa', np.float64), ('ra', np.float64)])
+    # a weighted pair of B = W * A or of the partial CNI, key as record_dtype
+    interaction_dtype = np.dtype([('key', np.int64), ('weight', np.float64)])
+    # rough peak bytes of a record in the reduce phase (the record, the sort order and the output columns)
+    bytes_per_record = 128
+    bytes_per_path = LocalMethods.bytes_per_path
+    # rough peak bytes of a parsed row of an edge chunk, and of the map phase per byte of the edge file
+    bytes_per_row = 256
+    map_bytes_per_file_byte = 16
+
+    def __init__(self, edge_file_name, memory_budget=1 << 30, spill_dir=None, num_partitions=None, half=True,
+                 profiler=None):
+        self.edge_file_name = edge_file_name
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.num_partitions = num_partitions
+        self.half = half
+        self.profiler = profiler
+        self.node_ids = None
+        self.degree = None
+
+    def _stage(self, name):
+        return stage(self.profiler, name)
+
+    def _spill_edges(self, work_dir):
+        """
+        step 1, append the (middle, neighbor) int64 pairs of every chunk to the partition of the middle node
+
+        return : the partition file names
+        """
+        num_partitions = self.num_partitions
+        if num_partitions is None:
+            file_bytes = os.path.getsize(self.edge_file_name)
+            num_partitions = max(int(math.ceil(float(file_bytes) * self.map_bytes_per_file_byte / self.memory_budget)),
+                                 1)
+
+        partition_names = [os.path.join(work_dir, 'partition_%d.bin' % i) for i in range(num_partitions)]
+        partition_files = [open(name, 'wb') for name in partition_names]
+        chunk_rows = max(self.memory_budget // self.bytes_per_row, 1)
+        try:
+            for df_chunk in pd.read_csv(self.edge_file_name, sep=r'\s+', chunksize=chunk_rows):
+                with self._stage('spill_edges') as stage:
+                    source = df_chunk['source'].values.astype(np.int64)
+                    target = df_chunk['target'].values.astype(np.int64)
+                    # the reversed edges followed by the original ones, same as LocalMethods
+                    middle = np.concatenate([target, source])
+                    neighbor = np.concatenate([source, target])
+
+                    partition = middle % num_partitions
+                    order = np.argsort(partition, kind='stable')
+                    bounds = np.searchsorted(partition[order], np.arange(num_partitions + 1))
+                    pairs = np.stack([middle[order], neighbor[order]], axis=1)
+                    for i in range(num_partitions):
+                        if bounds[i + 1] > bounds[i]:
+                            partition_files[i].write(pairs[bounds[i]:bounds[i + 1]].tobytes())
+                    stage.rows = len(df_chunk)
+        finally:
+            for partition_file in partition_files:
+                partition_file.close()
+        return partition_names
+
+    @staticmethod
+    def _read_partition(partition_name):
+        """
+        return : middle, neighbor ----> the original node IDs of a partition file
+        """
+        pairs = np.fromfile(partition_name, dtype=np.int64).reshape(-1, 2)
+        return pairs[:, 0], pairs[:, 1]
+
+    def _build_node_table(self, partition_names):
+        """
+        step 2, every node is the middle node of the records of one partition only,
+        so the node IDs and the degrees are the distinct middle nodes and their record counts
+
+        return : the number of two-hop paths starting from every compact node ID
+        """
+        node_list, degree_list = [], []
+        for partition_name in partition_names:
+            middle, _ = self._read_partition(partition_name)
+            nodes, counts = np.unique(middle, return_counts=True)
+            node_list.append(nodes)
+            degree_list.append(counts)
+        node_ids = np.concatenate(node_list)
+        order = np.argsort(node_ids)
+        self.node_ids = node_ids[order]
+        self.degree = np.concatenate(degree_list)[order]
+
+        # the paths x - w - y from x are the degrees of the middle nodes w next to x
+        paths = np.zeros(len(self.node_ids))
+        for partition_name in partition_names:
+            middle, neighbor = self._read_partition(partition_name)
+            middle_degree = self.degree[np.searchsorted(self.node_ids, middle)]
+            paths += np.bincount(np.searchsorted(self.node_ids, neighbor), weights=middle_degree,
+                                 minlength=len(self.node_ids))
+        return paths
+
+    def _source_ranges(self, paths):
+        """
+        cut the compact source nodes into consecutive ranges of at most memory_budget bytes of partial records,
+        a pair gets one record per partition of its common neighbours, so the paths bound the records
+
+        return : range_start ----> the first compact node of every range, followed by n
+        """
+        budget_records = max(self.memory_budget // self.bytes_per_record, 1)
+        cumulative_paths = np.cumsum(paths)
+        range_start = [0]
+        while range_start[-1] < len(paths):
+            start = range_start[-1]
+            done = cumulative_paths[start - 1] if start > 0 else 0
+            end = max(int(np.searchsorted(cumulative_paths, done + budget_records, side='right')), start + 1)
+            range_start.append(min(end, len(paths)))
+        return np.asarray(range_start, dtype=np.int64)
+
+    def _interaction_records(self, key, weight):
+        """
+        the weighted pairs summed per key and sorted by key, the zero weights are left out
+        """
+        keep = weight != 0
+        key, weight = key[keep], weight[keep]
+        order = np.argsort(key, kind='stable')
+        key, weight = key[order], weight[order]
+        if len(key) == 0:
+            return np.zeros(0, dtype=self.interaction_dtype)
+        pair_start = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+        records = np.zeros(len(pair_start), dtype=self.interaction_dtype)
+        records['key'] = key[pair_start]
+        records['weight'] = np.add.reduceat(weight, pair_start)
+        return records
+
+    @staticmethod
+    def _append_by_range(file_pattern, keys, records, range_start, num_nodes):
+        """
+        append records sorted by key to the file of the source range of every key
+        """
+        if len(keys) == 0:
+            return
+        source_range = np.searchsorted(range_start, keys // num_nodes, side='right') - 1
+        bounds = np.flatnonzero(np.concatenate([[True], source_range[1:] != source_range[:-1], [True]]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            with open(file_pattern % source_range[start], 'ab') as range_file:
+                range_file.write(records[start:end].tobytes())
+
+    def _read_compact_partition(self, partition_name):
+        """
+        return : middle, neighbor ----> the compact node IDs of a partition file, sorted by middle and then neighbor
+        """
+        middle, neighbor = self._read_partition(partition_name)
+        middle = np.searchsorted(self.node_ids, middle)
+        neighbor = np.searchsorted(self.node_ids, neighbor)
+        order = np.lexsort((neighbor, middle))
+        return middle[order], neighbor[order]
+
+    def _map_partition(self, partition_name, range_start, work_dir, num_partitions):
+        """
+        step 3, enumerate the neighbor pairs of the middle nodes of one partition and spill the partial scores,
+        the records of a middle node w are batched as x, each of them is paired with the deg(w) neighbors y of w,
+        so a batch holds at most memory_budget bytes of paths, however high the degree of w is
+        the distinct edges (w, x) of the partition are spilled too, they are the pairs of PA,
+        and the same paths x - w - y weighted by |1 / k_x - 1 / k_w| are the records of B = W * A,
+        spilled to the partition of x for _map_interactions
+        """
+        num_nodes = len(self.node_ids)
+        middle, neighbor = self._read_compact_partition(partition_name)
+
+        edge_keys = np.unique(middle * num_nodes + neighbor)
+        if self.half:
+            edge_keys = edge_keys[edge_keys // num_nodes <= edge_keys % num_nodes]
+        self._append_by_range(os.path.join(work_dir, 'edges_%d.bin'), edge_keys, edge_keys, range_start, num_nodes)
+
+        degree = self.degree.astype(np.int64)
+        aa_weight = np.zeros(num_nodes)
+        aa_weight[degree > 1] = 1.0 / np.log(degree[degree > 1])
+        ra_weight = np.zeros(num_nodes)
+        ra_weight[degree > 0] = 1.0 / degree[degree > 0]
+
+        # the first record of the middle node of every record, and the paths of every record as x
+        group_start = np.searchsorted(middle, middle)
+        record_paths = degree[middle]
+        cumulative_paths = np.cumsum(record_paths)
+        budget_paths = max(self.memory_budget // self.bytes_per_path, 1)
+
+        start = 0
+        while start < len(middle):
+            done = cumulative_paths[start - 1] if start > 0 else 0
+            end = max(int(np.searchsorted(cumulative_paths, done + budget_paths, side='right')), start + 1)
+            with self._stage('map_batch') as stage:
+                counts = record_paths[start:end]
+                path_middle = np.repeat(middle[start:end], counts)
+                path_source = np.repeat(neighbor[start:end], counts)
+                path_target = neighbor[expand_ranges(group_start[start:end], counts)]
+
+                # B[x, y] includes the walks back to x
+                interactions = self._interaction_records(path_source * num_nodes + path_target,
+                                                         np.abs(ra_weight[path_source] - ra_weight[path_middle]))
+                interaction_partition = self.node_ids[interactions['key'] // num_nodes] % num_partitions
+                order = np.argsort(interaction_partition, kind='stable')
+                self._append_by_range(os.path.join(work_dir, 'interaction_%d.bin'), interaction_partition[order],
+                                      interactions[order], np.arange(num_partitions), 1)
+
+                keep = path_source < path_target if self.half else path_source != path_target
+                key = path_source[keep] * num_nodes + path_target[keep]
+                path_middle = path_middle[keep]
+                order = np.argsort(key, kind='stable')
+                key, path_middle = key[order], path_middle[order]
+
+                records = np.zeros(0, dtype=self.record_dtype)
+                if len(key) > 0:
+                    pair_start = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+                    records = np.zeros(len(pair_start), dtype=self.record_dtype)
+                    records['key'] = key[pair_start]
+                    records['cn'] = np.diff(np.append(pair_start, len(key)))
+                    records['aa'] = np.add.reduceat(aa_weight[path_middle], pair_start)
+                    records['ra'] = np.add.reduceat(ra_weight[path_middle], pair_start)
+                self._append_by_range(os.path.join(work_dir, 'partial_%d.bin'), records['key'], records, range_start,
+                                      num_nodes)
+                stage.rows = len(key)
+            start = end
+
+    def _map_interactions(self, partition_index, partition_name, range_start, work_dir):
+        """
+        step 3b, CNI(x, y) = sum over u of A[x, u] * B[u, y], the records (u, y) of B spilled to this partition
+        have their middle node u in it, so the neighbors x of u are read from the same partition file,
+        the records of B are read in chunks and joined in batches of at most memory_budget bytes of paths,
+        the partial CNI of (x, y) is appended to the spill file of the range of x
+        """
+        interaction_file_name = os.path.join(work_dir, 'interaction_%d.bin' % partition_index)
+        if not os.path.exists(interaction_file_name):
+            return
+        num_nodes = len(self.node_ids)
+        middle, neighbor = self._read_compact_partition(partition_name)
+        degree = self.degree.astype(np.int64)
+        budget_paths = max(self.memory_budget // self.bytes_per_path, 1)
+        chunk_records = max(self.memory_budget // self.bytes_per_record, 1)
+
+        interactions = np.memmap(interaction_file_name, dtype=self.interaction_dtype, mode='r')
+        for chunk_start in range(0, len(interactions), chunk_records):
+            chunk = np.array(interactions[chunk_start:chunk_start + chunk_records])
+            record_middle = chunk['key'] // num_nodes
+            record_paths = degree[record_middle]
+            cumulative_paths = np.cumsum(record_paths)
+            start = 0
+            while start < len(chunk):
+                done = cumulative_paths[start - 1] if start > 0 else 0
+                end = max(int(np.searchsorted(cumulative_paths, done + budget_paths, side='right')), start + 1)
+                with self._stage('map_interaction_batch') as stage:
+                    counts = record_paths[start:end]
+                    path_source = neighbor[expand_ranges(np.searchsorted(middle, record_middle[start:end]), counts)]
+                    path_target = np.repeat(chunk['key'][start:end] % num_nodes, counts)
+                    path_weight = np.repeat(chunk['weight'][start:end], counts)
+
+                    keep = path_source < path_target if self.half else path_source != path_target
+                    records = self._interaction_records(path_source[keep] * num_nodes + path_target[keep],
+                                                        path_weight[keep])
+                    self._append_by_range(os.path.join(work_dir, 'cni_%d.bin'), records['key'], records, range_start,
+                                          num_nodes)
+                    stage.rows = len(records)
+                start = end
+        del interactions
+        os.remove(interaction_file_name)
+
+    def _reduce_range(self, range_index, work_dir):
+        """
+        step 4, sum the partial scores of the pairs of one source range
+
+        return : dict from the index names to (source, target, similarity) in compact node IDs,
+                 sorted by source and then target
+        """
+        num_nodes = len(self.node_ids)
+        degree = self.degree.astype(np.int64)
+        similarity_lists = {}
+
+        edge_file_name = os.path.join(work_dir, 'edges_%d.bin' % range_index)
+        edge_keys = np.zeros(0, dtype=np.int64)
+        if os.path.exists(edge_file_name):
+            edge_keys = np.unique(np.fromfile(edge_file_name, dtype=np.int64))
+        source, target = edge_keys // num_nodes, edge_keys % num_nodes
+        similarity_lists['PA'] = (source, target, degree[source] * degree[target])
+
+        partial_file_name = os.path.join(work_dir, 'partial_%d.bin' % range_index)
+        records = np.zeros(0, dtype=self.record_dtype)
+        if os.path.exists(partial_file_name):
+            records = np.fromfile(partial_file_name, dtype=self.record_dtype)
+            records = records[np.argsort(records['key'], kind='stable')]
+
+        key = records['key']
+        pair_start = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]])) if len(key) > 0 else \
+            np.zeros(0, dtype=np.int64)
+        key = key[pair_start]
+        source, target = key // num_nodes, key % num_nodes
+        cn = np.add.reduceat(records['cn'], pair_start) if len(key) > 0 else np.zeros(0, dtype=np.int64)
+        similarity_lists['CN'] = (source, target, cn)
+        for name in ('AA', 'RA'):
+            value = np.add.reduceat(records[name.lower()], pair_start) if len(key) > 0 else np.zeros(0)
+            similarity_lists[name] = (source, target, value)
+        for name in LocalMethods.degree_normalized_names:
+            similarity_lists[name] = (source, target, degree_normalize(name, cn, degree[source], degree[target]))
+
+        # RA-CNI is defined on the pairs with a common neighbour, the keys of RA
+        cni_file_name = os.path.join(work_dir, 'cni_%d.bin' % range_index)
+        cni = np.zeros(len(key))
+        if os.path.exists(cni_file_name):
+            cni_records = np.fromfile(cni_file_name, dtype=self.interaction_dtype)
+            cni_records = self._interaction_records(cni_records['key'], cni_records['weight'])
+            position = np.minimum(np.searchsorted(cni_records['key'], key), max(len(cni_records) - 1, 0))
+            found = cni_records['key'][position] == key if len(cni_records) > 0 else np.zeros(len(key), dtype=bool)
+            cni[found] = cni_records['weight'][position[found]]
+        ra_cni = similarity_lists['RA'][2] + cni
+        keep = ra_cni != 0
+        similarity_lists['RA_CNI'] = (source[keep], target[keep], ra_cni[keep])
+
+        for file_name in (edge_file_name, partial_file_name, cni_file_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        return similarity_lists
+
+    def _id_dtype(self):
+        """
+        int32 for the node IDs when they fit, otherwise int64, same as LocalMethods._id_dtype
+        """
+        info = np.iinfo(np.int32)
+        if len(self.node_ids) == 0 or (self.node_ids[0] >= info.min and self.node_ids[-1] <= info.max):
+            return np.int32
+        return self.node_ids.dtype
+
+    def cal_save_all_similarity(self, data_name, output_format='csv'):
+        """
+        compute all the indices out of core and save them to ../temp/similarity_directory/data_name,
+        the same files as LocalMethods.cal_save_all_similarity
+        input: output_format ----> 'csv' or 'npy', see SimilarityWriter, read the files back with load_similarity
+        """
+        save_dir = os.path.join('../temp/similarity_directory', data_name)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        work_dir = tempfile.mkdtemp(prefix='external_', dir=self.spill_dir)
+        try:
+            partition_names = self._spill_edges(work_dir)
+            with self._stage('build_node_table') as stage:
+                paths = self._build_node_table(partition_names)
+                stage.rows = len(self.node_ids)
+            range_start = self._source_ranges(paths)
+
+            for partition_name in partition_names:
+                with self._stage('map_partition'):
+                    self._map_partition(partition_name, range_start, work_dir, len(partition_names))
+            for partition_index, partition_name in enumerate(partition_names):
+                with self._stage('map_interactions'):
+                    self._map_interactions(partition_index, partition_name, range_start, work_dir)
+                # the edges of the partition are not needed any more
+                os.remove(partition_name)
+
+            with ExitStack() as writer_stack:
+                # an exception removes the partial files of every writer (SimilarityWriter.abort)
+                writers = dict((name, writer_stack.enter_context(
+                    SimilarityWriter(os.path.join(save_dir, data_name + '_' + name), output_format, self._id_dtype(),
+                                     self.half)))
+                               for name in self.similarity_names)
+                for range_index in range(len(range_start) - 1):
+                    with self._stage('reduce_range') as stage:
+                        similarity_lists = self._reduce_range(range_index, work_dir)
+                        stage.rows = len(similarity_lists['CN'][0])
+                    with self._stage('write'):
+                        for name in self.similarity_names:
+                            source, target, similarity = similarity_lists[name]
+                            df_similarity_list = pd.DataFrame()
+                            df_similarity_list['source'] = self.node_ids[source]
+                            df_similarity_list['target'] = self.node_ids[target]
+                            df_similarity_list['similarity'] = similarity
+                            writers[name].write(df_similarity_list)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def test_external_methods():
+    cwd = os.getcwd()
+    # the output goes to ../temp/similarity_directory, next to the working directory
+    work_dir = os.path.join(tempfile.mkdtemp(), 'work')
+    os.makedirs(work_dir)
+    os.chdir(work_dir)
+    try:
+        rng = np.random.default_rng(0)
+        # repeated edges and self loops included, odd node IDs so compact and original IDs differ
+        df_edge_list = pd.DataFrame({'source': rng.integers(0, 80, 400) * 2 + 1,
+                                     'target': rng.integers(0, 80, 400) * 2 + 1})
+        df_edge_list.to_csv('graph.edges', index=False, sep=' ')
+        for half in (True, False):
+            local_methods = LocalMethods(df_edge_list, half=half)
+            for output_format in ('csv', 'npy'):
+                # a small budget spreads the nodes over several ranges
+                external_methods = ExternalMethods('graph.edges', memory_budget=1 << 14, num_partitions=3, half=half)
+                external_methods.cal_save_all_similarity('graph', output_format)
+                for name in ExternalMethods.similarity_names:
+                    df_expected = getattr(local_methods, 'cal_' + name)()
+                    df_expected = df_expected.sort_values(['source', 'target']).reset_index(drop=True)
+                    df_result = load_similarity('../temp/similarity_directory/graph/graph_' + name)
+                    assert df_result[['source', 'target']].equals(df_expected[['source', 'target']].astype(
+                        df_result['source'].dtype)), name
+                    assert np.allclose(df_result['similarity'], df_expected['similarity']), name
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    test_external_methods()
@@ -0,0 +1,61 @@
+# -*-coding:utf-8-*-
+
+import json
+import os
+
+import numpy as np
+
+# the arrays of a graph cache, each one is stored as <cache_dir>/<name>.npy
+graph_cache_arrays = ('indptr', 'indices', 'degree', 'labels')
+
+
+def save_graph_cache(cache_dir, indptr, indices, degree, labels=None):
+    """
+    this method is implemented for saving the CSR adjacency of a renumbered graph as raw .npy files,
+    so a similarity job can memory-map the graph instead of parsing the edge list again
+    input:
+        cache_dir ----> the directory of the cache, created when missing
+        indptr ----> int64 CSR offsets, the neighbors of node i are indices[indptr[i]:indptr[i + 1]]
+        indices ----> int32 neighbor IDs, both directions of every edge
+        degree ----> int32 neighbor count of every node
+        labels ----> optional int label of every node, -1 for nodes without a label
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    arrays = {'indptr': np.asarray(indptr, dtype=np.int64), 'indices': np.asarray(indices, dtype=np.int32),
+              'degree': np.asarray(degree, dtype=np.int32)}
+    if labels is not None:
+        arrays['labels'] = np.asarray(labels)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(cache_dir, name + '.npy'), array)
+
+    # written last, a cache without it is incomplete
+    with open(os.path.join(cache_dir, 'graph.json'), 'w') as meta_file:
+        json.dump({'nodes': len(arrays['degree']), 'entries': len(arrays['indices']), 'labels': labels is not None},
+                  meta_file)
+
+
+def load_graph_cache(cache_dir, mmap_mode='r'):
+    """
+    open a cache written by save_graph_cache, with mmap_mode='r' the arrays are memory-mapped read-only
+    so opening is immediate and processes reading the same cache share the pages
+    input:
+        cache_dir ----> the directory of the cache
+        mmap_mode ----> passed to np.load, None reads the arrays into memory
+    return : a dict from the names of graph_cache_arrays to the arrays, labels is None when it was not saved
+    """
+    meta_file_name = os.path.join(cache_dir, 'graph.json')
+    if not os.path.exists(meta_file_name):
+        raise IOError('%s is not a complete graph cache' % cache_dir)
+    with open(meta_file_name) as meta_file:
+        meta = json.load(meta_file)
+
+    arrays = {}
+    for name in graph_cache_arrays:
+        if name == 'labels' and not meta['labels']:
+            arrays[name] = None
+            continue
+        arrays[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode=mmap_mode)
+    return arrays
@@ -1,9 +1,74 @@
 # -*-coding:utf-8-*-
 
 import os
+import tempfile
+from collections import OrderedDict
 
-import networkx as nx
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from cache import restore_files, store_files
+from graph_cache import graph_cache_arrays, save_graph_cache
+from profiling import stage
+from similarity import build_csr
+
+
+def largest_component_edges(source, target):
+    """
+    this method is implemented for extracting the largest connected component of an undirected graph from two
+    integer edge arrays, without building graph objects
+
+    the output holds the same edges networkx writes for the same input (from_pandas_edgelist + to_pandas_edgelist on
+    the largest component): duplicate and reciprocal edges are kept once and self-loops are kept. networkx orders the
+    rows by python set iteration, so here every edge is oriented from the node that appears first in the edge list
+    and edges are grouped by that node in order of first appearance, which is deterministic
+    input:
+        source, target: integer arrays of the edge list
+    return :
+        source, target arrays of the largest component edges
+    """
+    # node codes in order of first appearance, the order networkx inserts nodes in
+    codes, node_ids = pd.factorize(np.column_stack([source, target]).ravel())
+    num_nodes = len(node_ids)
+    codes = codes.reshape(-1, 2)
+    low = codes.min(axis=1).astype(np.int64)
+    high = codes.max(axis=1).astype(np.int64)
+    del codes
+
+    # keep each undirected edge once, at the row where it first appears
+    _, first_row = np.unique(low * num_nodes + high, return_index=True)
+    first = np.zeros(len(low), dtype=bool)
+    first[first_row] = True
+    del first_row
+    low = low[first]
+    high = high[first]
+    del first
+
+    graph = sp.coo_matrix((np.ones(len(low), dtype=np.int8), (low, high)), shape=(num_nodes, num_nodes))
+    _, component = connected_components(graph, directed=False)
+    del graph
+    sizes = np.bincount(component)
+    # a tie goes to the component found first, that is the one holding the earliest node
+    largest = component[np.flatnonzero(sizes[component] == sizes.max())[0]]
+
+    keep = component[low] == largest
+    low = low[keep]
+    high = high[keep]
+    # rows are still in edge list order, a stable sort groups them by the first node
+    order = np.argsort(low, kind='stable')
+    return node_ids[low[order]], node_ids[high[order]]
+
+
+def _index_array(index):
+    """
+    the values of a pd.Index as an array np.save writes without pickling, string IDs become fixed width strings
+    """
+    values = np.asarray(index)
+    if values.dtype == object:
+        return values.astype(str)
+    return values
 
 
 class NodeReNumber(object):
@@ -12,9 +77,20 @@ class NodeReNumber(object):
         1) Reorder the nodeID
         2) Rewrite the label with number
         3) Save the x.edges xx.nodes in another dirctory
+        4) Save the binary graph cache (CSR arrays and labels) in the graph directory next to them,
+           LocalMethods.from_graph_cache memory-maps it
+
+    profiler (profiling.StageProfiler) records the time, rows and memory of every stage, it is off when None
+
+    transform(cache) reuses the outputs and the renumbering maps of an earlier run on input files with the same
+    contents from a cache.ResultCache
     """
 
-    def __init__(self, edge_file_name, node_label_filename, save_prefix):
+    # bump when the outputs change, so older cache entries are not reused
+    cache_version = 1
+
+    def __init__(self, edge_file_name, node_label_filename, save_prefix, profiler=None):
+        self.profiler = profiler
         self.edgeName = edge_file_name
         self.nodeName = node_label_filename
 
@@ -27,80 +103,263 @@ class NodeReNumber(object):
             os.makedirs(save_dir)
 
         self.saveDir = save_dir
+        self.cacheDir = os.path.join(save_dir, 'graph')
+
+        self.dfEdge = None
+        self.mappedEdge = None
+        self.dfNode = None
+        self.nodeIndex = None
+        self.labelIndex = None
+
+    def _stage(self, name):
+        return stage(self.profiler, name)
+
+    def read_edges(self):
+        """
+        parse the edge file once, later steps reuse the cached frame
+        """
+        if self.dfEdge is None:
+            with self._stage('read_edges') as stage:
+                self.dfEdge = pd.read_csv(self.edgeName, names=['source', 'target'], sep=r'\s+', low_memory=False)
+                stage.rows = len(self.dfEdge)
+        return self.dfEdge
+
+    def read_nodes(self):
+        """
+        parse only the first (nodeID) and last (label) column of the node file, the features in between are skipped
+        """
+        if self.dfNode is None:
+            with self._stage('read_nodes') as stage:
+                with open(self.nodeName) as f:
+                    col_num = len(f.readline().split())
+                df = pd.read_csv(self.nodeName, header=None, usecols=[0, col_num - 1], sep=r'\s+', low_memory=False)
+                df.columns = ['nodeID', 'label']
+                self.dfNode = df
+                stage.rows = len(df)
+        return self.dfNode
 
     def get_node_map_dict(self):
-        df_edge = pd.read_csv(self.edgeName, names=['source', 'target'], delim_whitespace=True, low_memory=False)
-        df_node = pd.read_csv(self.nodeName, header=None, delim_whitespace=True, low_memory=False)
-
-        col_num = df_node.shape[1]
-        names = ['nodeID'] + ['f_%d' % i for i in range(col_num - 2)] + ['label']
-        df_node = pd.read_csv(self.nodeName, names=names, delim_whitespace=True, low_memory=False)
-        df_node = df_node[['nodeID', 'label']]
-
-        labels = list(set(df_node['label'].tolist()))
-        labels.sort()
-        nodes_list = df_node['nodeID'].tolist()
-
-        nodes_list_1 = df_edge['source'].tolist()
-        nodes_list_2 = df_edge['target'].tolist()
-
-        nodes_list = nodes_list + nodes_list_1 + nodes_list_2
-        nodes_list = list(set(nodes_list))
-        # 排序 便于复现
-        nodes_list.sort()
+        df_edge = self.read_edges()
+        df_node = self.read_nodes()
 
-        self.nodeName2ID = {}
-        for i, tName in enumerate(nodes_list):
-            self.nodeName2ID[tName] = i
-
-        self.label2num = {}
-        for i, label in enumerate(labels):
-            self.label2num[label] = i
+        with self._stage('build_map') as stage:
+            # 排序 便于复现
+            self.nodeIndex = pd.Index(pd.unique(np.concatenate([df_node['nodeID'].values, df_edge['source'].values,
+                                                               df_edge['target'].values]))).sort_values()
+            self.labelIndex = pd.Index(pd.unique(df_node['label'].values)).sort_values()
+            stage.rows = len(self.nodeIndex)
 
     def transform_edge_new(self):
-
-        df = pd.read_csv(self.edgeName, names=['source', 'target'], delim_whitespace=True, low_memory=False)
-        G = nx.from_pandas_edgelist(df, source='source', target='target')
-
-        # 最大联通子图
-        largest_cc = max(nx.connected_component_subgraphs(G), key=len)
-
-        df_new_edges = nx.to_pandas_edgelist(largest_cc)
-
-        df_new_edges['source'] = df_new_edges['source'].map(lambda x: self.nodeName2ID[x])
-        df_new_edges['target'] = df_new_edges['target'].map(lambda x: self.nodeName2ID[x])
-
-        df_new_edges.to_csv(self.saveDir + '/' + self.saveEdge, index=False, sep=' ')
+        df = self.read_edges()
+
+        with self._stage('largest_component') as stage:
+            # 最大联通子图
+            source, target = largest_component_edges(self.nodeIndex.get_indexer(df['source']),
+                                                     self.nodeIndex.get_indexer(df['target']))
+            df_new_edges = pd.DataFrame({'source': source, 'target': target})
+            stage.rows = len(df_new_edges)
+
+        with self._stage('write_edges') as stage:
+            df_new_edges.to_csv(self.saveDir + '/' + self.saveEdge, index=False, sep=' ')
+            stage.rows = len(df_new_edges)
+
+    def map_edges(self):
+        """
+        the edge list with renumbered node IDs, computed once
+        """
+        if self.mappedEdge is None:
+            df = self.read_edges()
+            with self._stage('map_edges') as stage:
+                self.mappedEdge = pd.DataFrame({'source': self.nodeIndex.get_indexer(df['source']),
+                                                'target': self.nodeIndex.get_indexer(df['target'])})
+                stage.rows = len(self.mappedEdge)
+        return self.mappedEdge
 
     def transform_edge(self):
+        df_new = self.map_edges()
 
-        df = pd.read_csv(self.edgeName, names=['source', 'target'], delim_whitespace=True, low_memory=False)
-
-        df['source'] = df['source'].map(lambda x: self.nodeName2ID[x])
-        df['target'] = df['target'].map(lambda x: self.nodeName2ID[x])
-
-        df.to_csv(self.saveDir + '/' + self.saveEdge, index=False, sep=' ')
+        with self._stage('write_edges') as stage:
+            df_new.to_csv(self.saveDir + '/' + self.saveEdge, index=False, sep=' ')
+            stage.rows = len(df_new)
 
     def transform_node(self):
-
-        df = pd.read_csv(self.nodeName, header=None, delim_whitespace=True, low_memory=False)
-        col_num = df.shape[1]
-        names = ['nodeID'] + ['f_%d' % i for i in range(col_num - 2)] + ['label']
-        df = pd.read_csv(self.nodeName, names=names, delim_whitespace=True, low_memory=False)
-        df_new = df[['nodeID', 'label']].copy()
-        df_new['nodeID'] = df_new['nodeID'].map(lambda x: self.nodeName2ID[x])
-        df_new['label'] = df_new['label'].map(lambda x: self.label2num[x])
-
-        df_new.to_csv(self.saveDir + '/' + self.saveNode, index=False, sep=' ')
-
-    def transform(self):
-        self.get_node_map_dict()
-        self.transform_edge()
-        self.transform_node()
+        df = self.read_nodes()
+
+        with self._stage('map_nodes') as stage:
+            df_new = pd.DataFrame({'nodeID': self.nodeIndex.get_indexer(df['nodeID']),
+                                   'label': self.labelIndex.get_indexer(df['label'])})
+            stage.rows = len(df_new)
+
+        with self._stage('write_nodes') as stage:
+            df_new.to_csv(self.saveDir + '/' + self.saveNode, index=False, sep=' ')
+            stage.rows = len(df_new)
+
+    def write_graph_cache(self):
+        """
+        save the CSR arrays of the renumbered edges (both directions, like LocalMethods builds them)
+        and the renumbered label of every node (-1 for nodes that only appear in the edges)
+        """
+        df_edge = self.map_edges()
+        df_node = self.read_nodes()
+
+        with self._stage('write_graph_cache') as stage:
+            num_nodes = len(self.nodeIndex)
+            source = df_edge['source'].values
+            target = df_edge['target'].values
+            indptr, indices, degree = build_csr(np.concatenate([target, source]), np.concatenate([source, target]),
+                                                num_nodes)
+
+            labels = np.full(num_nodes, -1, dtype=np.int32)
+            labels[self.nodeIndex.get_indexer(df_node['nodeID'])] = self.labelIndex.get_indexer(df_node['label'])
+
+            save_graph_cache(self.cacheDir, indptr, indices, degree, labels)
+            stage.rows = len(indices)
+
+    def _output_files(self):
+        """
+        every file transform writes by its name in a cache entry, graph.json last since a graph cache without it
+        is incomplete
+        """
+        output_files = OrderedDict([('edges', self.saveDir + '/' + self.saveEdge),
+                                    ('nodes', self.saveDir + '/' + self.saveNode)])
+        for name in graph_cache_arrays:
+            output_files[name + '.npy'] = os.path.join(self.cacheDir, name + '.npy')
+        output_files['graph.json'] = os.path.join(self.cacheDir, 'graph.json')
+        return output_files
+
+    def transform(self, cache=None):
+        """
+        write the renumbered edges, nodes and graph cache
+        input: cache ----> a cache.ResultCache, the outputs and the renumbering maps (nodeIndex, labelIndex) are
+                           restored from it when the edge and node files have the contents of an earlier run
+        """
+        if cache is None:
+            self._transform()
+            return
+
+        key = cache.key('node_renumber', {'version': self.cache_version}, [self.edgeName, self.nodeName])
+        with cache.open_entry(key, 'node_renumber') as (entry_dir, hit):
+            if hit:
+                with self._stage('restore_cache'):
+                    if not os.path.exists(self.cacheDir):
+                        os.makedirs(self.cacheDir)
+                    restore_files(entry_dir, self._output_files())
+                    self.nodeIndex = pd.Index(np.load(os.path.join(entry_dir, 'node_index.npy')))
+                    self.labelIndex = pd.Index(np.load(os.path.join(entry_dir, 'label_index.npy')))
+                return
+
+            self._transform()
+            with self._stage('store_cache'):
+                store_files(entry_dir, self._output_files())
+                np.save(os.path.join(entry_dir, 'node_index.npy'), _index_array(self.nodeIndex))
+                np.save(os.path.join(entry_dir, 'label_index.npy'), _index_array(self.labelIndex))
+
+    def _transform(self):
+        with self._stage('get_node_map_dict'):
+            self.get_node_map_dict()
+        with self._stage('transform_edge'):
+            self.transform_edge()
+        with self._stage('transform_node'):
+            self.transform_node()
+        self.write_graph_cache()
+        # the parsed files are only needed while transforming
+        self.dfEdge = None
+        self.dfNode = None
+        self.mappedEdge = None
+
+
+def _write_network(edge_file_name, node_file_name, edges, nodes):
+    with open(edge_file_name, 'w') as f:
+        for source, target in edges:
+            f.write('%s\t%s\n' % (source, target))
+    with open(node_file_name, 'w') as f:
+        for node_id, label in nodes:
+            f.write('%s\t0\t1\t%s\n' % (node_id, label))
+
+
+def test_node_renumber():
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        rng = np.random.RandomState(0)
+        for prefix, names in (('int', [3 * i + 7 for i in range(40)]), ('str', ['p%d' % i for i in range(40)])):
+            edges = [(names[a], names[b]) for a, b in rng.randint(0, 35, size=(120, 2))]
+            # a few nodes only appear in the edges, the last ones only in the node file
+            nodes = [(names[i], ['Agents', 'AI', 'DB', 'ML'][i % 4]) for i in range(5, 40)]
+            _write_network(prefix + '.cites', prefix + '.content', edges, nodes)
+            NodeReNumber(prefix + '.cites', prefix + '.content', prefix).transform()
+
+            # the dict maps over the sorted node and label sets the renumbering was first written with
+            node_names = set([node_id for node_id, _ in nodes] + [name for edge in edges for name in edge])
+            node_name2id = dict((name, i) for i, name in enumerate(sorted(node_names)))
+            label2num = dict((label, i) for i, label in enumerate(sorted(set(label for _, label in nodes))))
+
+            save_dir = os.path.join('transformed_dataset', prefix)
+            df_edge = pd.read_csv(os.path.join(save_dir, prefix + '.edges'), sep=' ')
+            assert list(zip(df_edge['source'], df_edge['target'])) == \
+                [(node_name2id[source], node_name2id[target]) for source, target in edges]
+            df_node = pd.read_csv(os.path.join(save_dir, prefix + '.nodes'), sep=' ')
+            assert list(zip(df_node['nodeID'], df_node['label'])) == \
+                [(node_name2id[node_id], label2num[label]) for node_id, label in nodes]
+    finally:
+        os.chdir(cwd)
+
+
+def _largest_component_reference(edges):
+    """
+    the largest component edges as a set of undirected edges, by breadth first search over python dicts
+    """
+    neighbors = OrderedDict()
+    for source, target in edges:
+        neighbors.setdefault(source, set()).add(target)
+        neighbors.setdefault(target, set()).add(source)
+    seen = set()
+    largest = set()
+    for start in neighbors:
+        if start in seen:
+            continue
+        component = set([start])
+        queue = [start]
+        while queue:
+            node = queue.pop()
+            for neighbor in neighbors[node] - component:
+                component.add(neighbor)
+                queue.append(neighbor)
+        seen |= component
+        if len(component) > len(largest):
+            largest = component
+    return set(frozenset(edge) for edge in edges if edge[0] in largest)
+
+
+def test_largest_component():
+    rng = np.random.RandomState(0)
+    for num_nodes, num_edges in ((30, 20), (60, 50), (200, 120)):
+        edges = [tuple(edge) for edge in rng.randint(0, num_nodes, size=(num_edges, 2))]
+        # duplicate and reciprocal edges are kept once, self-loops are kept
+        edges += [edges[0], edges[1][::-1], (edges[2][0], edges[2][0])]
+        source, target = largest_component_edges(np.array([edge[0] for edge in edges]),
+                                                 np.array([edge[1] for edge in edges]))
+        result = list(zip(source, target))
+        assert len(set(frozenset(edge) for edge in result)) == len(result)
+        assert set(frozenset(edge) for edge in result) == _largest_component_reference(edges)
+
+        # every edge starts at the node that appears first, rows are grouped by that node in order of appearance
+        first_seen = OrderedDict()
+        for edge in edges:
+            for node in edge:
+                first_seen.setdefault(node, len(first_seen))
+        assert all(first_seen[a] <= first_seen[b] for a, b in result)
+        assert [first_seen[a] for a, _ in result] == sorted(first_seen[a] for a, _ in result)
 
 
 if __name__ == '__main__':
+    test_node_renumber()
+    test_largest_component()
+
     citeEdges = 'dataset/citeseer/citeseer.cites'
     citeNodes = 'dataset/citeseer/citeseer.content'
-    test = NodeReNumber(citeEdges, citeNodes, 'citeseer')
-    test.transform()
+    if os.path.exists(citeNodes):
+        test = NodeReNumber(citeEdges, citeNodes, 'citeseer')
+        test.transform()
+    else:
+        print('skip renumbering citeseer, %s is missing' % citeNodes)
@@ -0,0 +1,130 @@
+# -*-coding:utf-8-*-
+
+import json
+import os
+import resource
+import sys
+import time
+
+
+def current_rss_bytes():
+    """
+    the resident set size of this process, read from /proc on linux, the peak RSS elsewhere
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _NullStage(object):
+    """
+    the stage handed out when profiling is disabled, every operation is a no-op
+    """
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+def stage(profiler, name):
+    """
+    a stage of profiler, or the shared no-op one when profiling is off (profiler is None)
+    """
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        self.profiler._stack.append(self.name)
+        self.path = '/'.join(self.profiler._stack)
+        self.rss_before = current_rss_bytes() if self.profiler.track_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.profiler._stack.pop()
+
+        record = {'name': self.name, 'path': self.path, 'seconds': seconds, 'rows': self.rows}
+        if self.profiler.track_memory:
+            rss_after = current_rss_bytes()
+            record['rss_after'] = rss_after
+            record['memory_delta'] = rss_after - self.rss_before
+        self.profiler._add(record)
+        return False
+
+
+class StageProfiler(object):
+    """
+    this class records the wall time, the row count and the RSS delta of named stages,
+    hand it to LocalMethods or NodeReNumber as profiler=StageProfiler()
+
+        with profiler.stage('self_merge') as stage:
+            ...
+            stage.rows = len(df_common_neighbor)
+
+    nested stages are recorded with their path, e.g. cal_CN/self_merge
+    callback ----> called with the record dict of every finished stage
+    """
+
+    def __init__(self, callback=None, track_memory=True):
+        self.callback = callback
+        self.track_memory = track_memory
+        self.records = []
+        self._stack = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def report(self):
+        """
+        return : {'stages': every record in finishing order,
+                  'summary': {path: {'count', 'seconds', 'rows', 'memory_delta'}} summed over the calls}
+        """
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(record['path'], {'count': 0, 'seconds': 0.0, 'rows': 0, 'memory_delta': 0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['rows'] += record['rows'] or 0
+            total['memory_delta'] += record.get('memory_delta') or 0
+        return {'stages': list(self.records), 'summary': summary}
+
+    def to_json(self, file_name=None):
+        """
+        the report as a json string, also written to file_name when given
+        """
+        report_json = json.dumps(self.report(), indent=2)
+        if file_name is not None:
+            with open(file_name, 'w') as report_file:
+                report_file.write(report_json)
+        return report_json
+
+    def reset(self):
+        self.records = []
+        self._stack = []
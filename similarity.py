@@ -1,8 +1,839 @@
 # -*-coding:utf8 -*-
-import math
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+from multiprocessing import shared_memory
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+
+from cache import array_digest, restore_files, store_files
+from graph_cache import load_graph_cache, save_graph_cache
+from profiling import stage
+from sketch import bottom_k_sketches, estimate_common_neighbors, estimate_jaccard, lsh_candidate_pairs, \
+    minhash_signatures
+
+Adjacency = namedtuple('Adjacency', ['node_ids', 'indptr', 'indices', 'degree'])
+
+
+def build_csr(source, target, num_nodes):
+    """
+    build the CSR arrays of a graph from compact node IDs (0 ... num_nodes - 1)
+    every (source, target) row becomes one entry in the neighbor list of source,
+    so repeated rows are kept and counted in the degree just like the pandas groupby
+
+    return : indptr, indices, degree
+        the neighbors of node i are indices[indptr[i]:indptr[i + 1]], sorted
+    """
+    order = np.lexsort((target, source))
+    indices = np.asarray(target)[order].astype(np.int32)
+    degree = np.bincount(source, minlength=num_nodes).astype(np.int32)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(degree, out=indptr[1:])
+    return indptr, indices, degree
+
+
+def safe_divide(numerator, denominator):
+    """
+    elementwise numerator / denominator with 0 where the denominator is 0
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+def degree_normalize(name, common_neighbor, degree_x, degree_y):
+    """
+    turn common neighbour counts into one of the degree normalized indices,
+    pairs whose denominator is 0 (both degrees 0) get 0
+    input: name ----> JC, SA, SO, HPI, HDI or LLHN
+           common_neighbor, degree_x, degree_y ----> arrays aligned on the node pairs
+
+    return : the similarity array
+    """
+    common_neighbor = np.asarray(common_neighbor, dtype=np.float64)
+    degree_x = np.asarray(degree_x, dtype=np.float64)
+    degree_y = np.asarray(degree_y, dtype=np.float64)
+
+    if name == 'JC':
+        return safe_divide(common_neighbor, degree_x + degree_y - common_neighbor)
+    if name == 'SA':
+        return safe_divide(common_neighbor, np.sqrt(degree_x * degree_y))
+    if name == 'SO':
+        return safe_divide(2 * common_neighbor, degree_x + degree_y)
+    if name == 'HPI':
+        return safe_divide(common_neighbor, np.minimum(degree_x, degree_y))
+    if name == 'HDI':
+        return safe_divide(common_neighbor, np.maximum(degree_x, degree_y))
+    if name == 'LLHN':
+        return safe_divide(common_neighbor, degree_x * degree_y)
+    raise ValueError('unknown degree normalized index: %s' % name)
+
+
+def expand_ranges(starts, lengths):
+    """
+    concatenate the integer ranges [starts[i], starts[i] + lengths[i]) into one array
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+
+def common_neighbor_sums(indptr, indices, degree, sources=None, half=False):
+    """
+    enumerate every two-hop path x - w - y (x != y) starting from the given source nodes exactly once
+    and accumulate CN, AA and RA of each (x, y) pair from the same enumeration
+    input: indptr, indices, degree ----> the CSR adjacency
+           sources ----> compact node IDs to use as x, all nodes when None
+           half ----> only keep the pairs with x < y
+
+    return : source, target, cn, aa, ra
+        compact node pairs with at least one common neighbour, sorted by source and then target
+    """
+    num_nodes = len(degree)
+    if sources is None:
+        sources = np.arange(num_nodes)
+    sources = np.asarray(sources, dtype=np.int64)
+
+    degree = np.asarray(degree, dtype=np.int64)
+    aa_weight = np.zeros(num_nodes)
+    aa_weight[degree > 1] = 1.0 / np.log(degree[degree > 1])
+    ra_weight = np.zeros(num_nodes)
+    ra_weight[degree > 0] = 1.0 / degree[degree > 0]
+
+    # first hop x -> w
+    first_hop = expand_ranges(indptr[sources], degree[sources])
+    path_source = np.repeat(sources, degree[sources])
+    middle = indices[first_hop].astype(np.int64)
+
+    # second hop w -> y
+    second_hop = expand_ranges(indptr[middle], degree[middle])
+    path_source = np.repeat(path_source, degree[middle])
+    path_target = indices[second_hop]
+    middle = np.repeat(middle, degree[middle])
+
+    keep = path_source < path_target if half else path_source != path_target
+    key = path_source[keep] * num_nodes + path_target[keep]
+    middle = middle[keep]
+
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    middle = middle[order]
+    if len(key) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0), np.zeros(0)
+
+    group_start = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    group_key = key[group_start]
+
+    cn = np.diff(np.append(group_start, len(key)))
+    aa = np.add.reduceat(aa_weight[middle], group_start)
+    ra = np.add.reduceat(ra_weight[middle], group_start)
+    return group_key // num_nodes, group_key % num_nodes, cn, aa, ra
+
+
+def candidate_common_neighbor_sums(indptr, indices, degree, source, target, batch_size=65536):
+    """
+    CN, AA and RA of the given compact node pairs only,
+    the sorted neighbor lists of both ends are intersected batch by batch,
+    so the cost grows with the degrees of the candidates instead of the number of two-hop pairs
+    input: indptr, indices, degree ----> the CSR adjacency
+           source, target ----> compact node IDs of the candidate pairs
+
+    return : cn, aa, ra ----> arrays aligned on the candidate pairs, 0 when there is no common neighbour
+    """
+    num_nodes = len(degree)
+    source = np.asarray(source, dtype=np.int64)
+    target = np.asarray(target, dtype=np.int64)
+    degree = np.asarray(degree, dtype=np.int64)
+
+    aa_weight = np.zeros(num_nodes)
+    aa_weight[degree > 1] = 1.0 / np.log(degree[degree > 1])
+    ra_weight = np.zeros(num_nodes)
+    ra_weight[degree > 0] = 1.0 / degree[degree > 0]
+
+    cn = np.zeros(len(source), dtype=np.int64)
+    aa = np.zeros(len(source))
+    ra = np.zeros(len(source))
+
+    def neighbor_keys(nodes):
+        # key = pair position * num_nodes + neighbor, sorted because the CSR rows are sorted
+        position = np.repeat(np.arange(len(nodes), dtype=np.int64), degree[nodes])
+        key = position * num_nodes + indices[expand_ranges(indptr[nodes], degree[nodes])]
+        key, multiplicity = np.unique(key, return_counts=True)
+        return key, multiplicity
+
+    for start in range(0, len(source), batch_size):
+        batch_source = source[start:start + batch_size]
+        batch_target = target[start:start + batch_size]
+
+        key_x, multiplicity_x = neighbor_keys(batch_source)
+        key_y, multiplicity_y = neighbor_keys(batch_target)
+        common_key, index_x, index_y = np.intersect1d(key_x, key_y, assume_unique=True, return_indices=True)
+
+        position = common_key // num_nodes
+        middle = common_key % num_nodes
+        paths = multiplicity_x[index_x] * multiplicity_y[index_y]
+
+        batch_length = len(batch_source)
+        cn[start:start + batch_length] = np.bincount(position, weights=paths, minlength=batch_length)
+        aa[start:start + batch_length] = np.bincount(position, weights=paths * aa_weight[middle],
+                                                     minlength=batch_length)
+        ra[start:start + batch_length] = np.bincount(position, weights=paths * ra_weight[middle],
+                                                     minlength=batch_length)
+    return cn, aa, ra
+
+
+def light_common_neighbor_counts(indptr, indices, degree, max_middle_degree, sources=None, half=False):
+    """
+    the pairs that share a common neighbour of degree <= max_middle_degree and the number of such common neighbours,
+    the hubs above max_middle_degree are skipped so the enumeration costs at most max_middle_degree per CSR entry,
+    None keeps every middle node
+    input: indptr, indices, degree ----> the CSR adjacency
+           sources ----> compact node IDs to use as x, all nodes when None, a block of _source_blocks keeps the
+                         enumerated paths within the memory budget
+           half ----> only keep the pairs with source < target
+
+    return : source, target, count ----> compact node pairs sorted by source and then target
+    """
+    num_nodes = len(degree)
+    if sources is None:
+        sources = np.arange(num_nodes)
+    sources = np.asarray(sources, dtype=np.int64)
+    degree = np.asarray(degree, dtype=np.int64)
+    if max_middle_degree is None:
+        max_middle_degree = degree.max() if num_nodes else 0
+
+    # first hop x -> w, only to the light middle nodes
+    first_hop = expand_ranges(indptr[sources], degree[sources])
+    path_source = np.repeat(sources, degree[sources])
+    middle = indices[first_hop].astype(np.int64)
+    light = degree[middle] <= max_middle_degree
+    path_source = path_source[light]
+    middle = middle[light]
+    del first_hop, light
+
+    # second hop w -> y
+    second_hop = expand_ranges(indptr[middle], degree[middle])
+    path_source = np.repeat(path_source, degree[middle])
+    path_target = np.asarray(indices[second_hop], dtype=np.int64)
+    del second_hop, middle
+
+    keep = path_source < path_target if half else path_source != path_target
+    key, count = np.unique(path_source[keep] * num_nodes + path_target[keep], return_counts=True)
+    return key // num_nodes, key % num_nodes, count
+
+
+def path_counts(indptr, indices, degree, length=2):
+    """
+    the number of walks of the given length starting from every node x, A^(length - 1) * degree,
+    for length 2 the two-hop paths x - w - y, i.e. the sum of the degrees of its neighbors
+    """
+    row = np.repeat(np.arange(len(degree)), np.diff(indptr))
+    counts = np.asarray(degree, dtype=np.float64)
+    for _ in range(length - 1):
+        counts = np.bincount(row, weights=counts[indices], minlength=len(degree))
+    return counts
+
+
+def top_k_per_source(source, target, similarity, k, presorted=False):
+    """
+    keep the k highest scores of every source node, ties are broken by the smaller target
+    input: source, target, similarity ----> arrays of one block of pairs
+           presorted ----> the pairs are already sorted by source and then target,
+                           the sort is stable so the target key can be left out
+
+    return : source, target, similarity sorted by source and then by descending similarity
+    """
+    if len(source) == 0:
+        return source, target, similarity
+
+    if presorted:
+        order = np.lexsort((-similarity, source))
+    else:
+        order = np.lexsort((target, -similarity, source))
+    source = source[order]
+
+    group_start = np.flatnonzero(np.concatenate([[True], source[1:] != source[:-1]]))
+    rank = np.arange(len(source)) - np.repeat(group_start, np.diff(np.append(group_start, len(source))))
+    keep = order[rank < k]
+    return source[rank < k], target[keep], similarity[keep]
+
+
+def similarity_block(indptr, indices, degree, sources, name=None, k=None, half=False):
+    """
+    the work of one block of source nodes, shared by the serial and the parallel mode
+    input: name ----> None for the fused sums, otherwise one index of the common neighbour family
+           k ----> keep only the top-k targets of every source when given
+           half ----> only keep the pairs with source < target
+
+    return : source, target, cn, aa, ra when name is None, otherwise source, target, similarity
+    """
+    source, target, cn, aa, ra = common_neighbor_sums(indptr, indices, degree, sources, half)
+    if name is None:
+        return source, target, cn, aa, ra
+
+    if name == 'CN':
+        similarity = cn
+    elif name == 'AA':
+        similarity = aa
+    elif name == 'RA':
+        similarity = ra
+    else:
+        similarity = degree_normalize(name, cn, degree[source], degree[target])
+
+    if k is not None:
+        return top_k_per_source(source, target, similarity, k, presorted=True)
+    return source, target, similarity
+
+
+def sparse_adjacency(indptr, indices):
+    """
+    the adjacency matrix A of CSR arrays as a scipy CSR matrix,
+    A[x, y] is the number of times y appears in the neighbor list of x
+    """
+    num_nodes = len(indptr) - 1
+    data = np.ones(len(indices), dtype=np.int64)
+    matrix = sp.csr_matrix((data, indices, indptr), shape=(num_nodes, num_nodes), copy=True)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def cni_weight(matrix, degree):
+    """
+    the edge weighted matrix W of RA-CNI, W[x, y] = A[x, y] * |1 / k_x - 1 / k_y|
+    """
+    inverse_degree = safe_divide(1.0, degree)
+    row = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    data = matrix.data * np.abs(inverse_degree[row] - inverse_degree[matrix.indices])
+    weight = sp.csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+    weight.eliminate_zeros()
+    return weight
+
+
+def walk_operands(matrix, degree, name, weight=None):
+    """
+    the right factors of the walk products of walk_block, computed once per process
+    return : (diag(1 / k) * A, W * A) for RA_CNI, W = cni_weight when weight is None,
+             (A,) for CN, (diag(1 / log k) * A,) for AA, (diag(1 / k) * A,) for RA,
+             (A as float64,) for LP and Katz
+    """
+    if name == 'RA_CNI':
+        weight = cni_weight(matrix, degree) if weight is None else weight
+        return sp.diags(safe_divide(1.0, degree)).dot(matrix).tocsr(), weight.dot(matrix).tocsr()
+    if name == 'CN':
+        return (matrix,)
+    if name == 'AA':
+        # nodes of degree 1 can only be the common neighbour of a node and itself
+        degree = np.asarray(degree, dtype=np.float64)
+        aa_weight = np.zeros(len(degree))
+        aa_weight[degree > 1] = 1.0 / np.log(degree[degree > 1])
+        return (sp.diags(aa_weight).dot(matrix).tocsr(),)
+    if name == 'RA':
+        return (sp.diags(safe_divide(1.0, degree)).dot(matrix).tocsr(),)
+    return (matrix.astype(np.float64),)
+
+
+def walk_block(matrix, operands, rows, name, weights=None, k=None, half=False):
+    """
+    the sparse walk products of one block of consecutive source rows, shared by the serial and the parallel mode
+    input: operands ----> walk_operands of name
+           name ----> RA_CNI, CN, AA or RA of the sparse engine, or LP and Katz whose walks of length l are
+                      weighted by weights[l]
+           k ----> keep only the top-k targets of every source when given
+           half ----> only keep the pairs with source < target
+
+    return : source, target, similarity sorted by source and then target,
+             or by source and then descending similarity in the top-k mode
+    """
+    block = matrix[rows[0]:rows[-1] + 1]
+    if name == 'RA_CNI':
+        right_ra, right_cni = operands
+        ra = block.dot(right_ra).tocsr()
+        # CNI only where RA-CNI is defined, i.e. on the pattern of RA
+        cni = block.dot(right_cni).tocsr()
+        ra_pattern = ra.copy()
+        ra_pattern.data = np.ones(len(ra_pattern.data))
+        score = (ra + cni.multiply(ra_pattern)).tocsr()
+    elif name in ('CN', 'AA', 'RA'):
+        score = block.dot(operands[0]).tocsr()
+    else:
+        walks = block.astype(np.float64)
+        score = walks * weights[1] if 1 in weights else None
+        for length in range(2, max(weights) + 1):
+            walks = walks.dot(operands[0])
+            if length in weights:
+                score = walks * weights[length] if score is None else score + walks * weights[length]
+    score.sort_indices()
+    score = score.tocoo()
+
+    source = score.row.astype(np.int64) + rows[0]
+    target = score.col.astype(np.int64)
+    keep = (source < target if half else source != target) & (score.data != 0)
+    # the rows of the CSR product are sorted by source and then target
+    source, target, similarity = source[keep], target[keep], score.data[keep]
+    if k is not None:
+        return top_k_per_source(source, target, similarity, k, presorted=True)
+    return source, target, similarity
+
+
+# the adjacency of a worker process, attached to the shared memory of the parent in _init_worker
+_worker_adjacency = None
+# the sparse matrix and the walk_operands of a worker process, built from _worker_adjacency on first use
+_worker_walk = {}
+
+
+def _init_worker(array_specs):
+    global _worker_adjacency
+    handles, arrays = [], []
+    for shm_name, shape, dtype in array_specs:
+        handle = shared_memory.SharedMemory(name=shm_name)
+        handles.append(handle)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=handle.buf))
+    # keep the handles alive as long as the arrays
+    _worker_adjacency = (handles, arrays)
+    _worker_walk.clear()
+
+
+def _init_worker_from_cache(cache_dir):
+    global _worker_adjacency
+    # every worker maps the same files, the pages are shared through the page cache
+    arrays = load_graph_cache(cache_dir, mmap_mode='r')
+    _worker_adjacency = (None, [arrays['indptr'], arrays['indices'], arrays['degree']])
+    _worker_walk.clear()
+
+
+def _worker_similarity_block(task):
+    indptr, indices, degree = _worker_adjacency[1]
+    sources, name, k, half = task
+    return similarity_block(indptr, indices, degree, sources, name, k, half)
+
+
+def _worker_walk_block(task):
+    indptr, indices, degree = _worker_adjacency[1]
+    rows, name, weights, k, half = task
+    if 'matrix' not in _worker_walk:
+        _worker_walk['matrix'] = sparse_adjacency(indptr, indices)
+    operand_name = 'walk' if name in LocalMethods.quasi_local_names else name
+    if operand_name not in _worker_walk:
+        _worker_walk[operand_name] = walk_operands(_worker_walk['matrix'], degree, name)
+    return walk_block(_worker_walk['matrix'], _worker_walk[operand_name], rows, name, weights, k, half)
+
+
+class SimilarityWriter(object):
+    """
+    write a similarity list chunk by chunk
+    output_format:
+    'csv' ----> space separated text with a header, same as df.to_csv(save_file_name, index=False, sep=' ')
+    'npy' ----> the columns as three .npy files save_file_name.source.npy, save_file_name.target.npy and
+                save_file_name.similarity.npy, node IDs as id_dtype and scores as float32,
+                the headers are rewritten with the final length on close so the chunks are never held in memory
+    every format also writes save_file_name.meta.json with the format, the row count and
+    whether the list is half stored (only source < target, see expand_half_similarity),
+    on close only, a writer left by an exception (used as a context manager) removes its partial files instead
+    """
+
+    output_formats = ('csv', 'npy')
+    npy_columns = ('source', 'target', 'similarity')
+
+    def __init__(self, save_file_name, output_format='csv', id_dtype=np.int32, half=False):
+        if output_format not in self.output_formats:
+            raise ValueError('unknown output format %s, expected one of %s' % (output_format,
+                                                                              ', '.join(self.output_formats)))
+        self.save_file_name = save_file_name
+        self.output_format = output_format
+        self.half = half
+        self.row_count = 0
+
+        # the files of an earlier save in the other format would shadow this one, and its meta.json
+        # would describe a list that is about to be overwritten
+        for other_format in self.output_formats:
+            if other_format != output_format:
+                for suffix, file_name in self.file_names(save_file_name, other_format).items():
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+        if os.path.exists(save_file_name + '.meta.json'):
+            os.remove(save_file_name + '.meta.json')
+
+        if output_format == 'npy':
+            if np.dtype(id_dtype).kind not in 'iu':
+                raise ValueError('npy output needs integer node IDs, renumber the graph with NodeReNumber first')
+            self.dtypes = [np.dtype(id_dtype), np.dtype(id_dtype), np.dtype(np.float32)]
+            self.files = [open('%s.%s.npy' % (save_file_name, column), 'wb') for column in self.npy_columns]
+            for npy_file, dtype in zip(self.files, self.dtypes):
+                self._write_npy_header(npy_file, dtype, 0)
+
+    @classmethod
+    def file_names(cls, save_file_name, output_format):
+        """
+        every file a writer of this format creates for save_file_name
+        return : dict from the suffix of the file ('' for the csv file) to its name
+        """
+        suffixes = [''] if output_format == 'csv' else ['.%s.npy' % column for column in cls.npy_columns]
+        return dict((suffix, save_file_name + suffix) for suffix in suffixes + ['.meta.json'])
+
+    @staticmethod
+    def _write_npy_header(npy_file, dtype, length):
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)}
+        np.lib.format.write_array_header_1_0(npy_file, header)
+
+    def write(self, df_similarity_list):
+        if self.output_format == 'csv':
+            first_chunk = self.row_count == 0
+            df_similarity_list.to_csv(self.save_file_name, index=False, sep=' ', mode='w' if first_chunk else 'a',
+                                      header=first_chunk)
+        else:
+            for npy_file, dtype, column in zip(self.files, self.dtypes, self.npy_columns):
+                npy_file.write(np.ascontiguousarray(df_similarity_list[column].values, dtype=dtype).tobytes())
+        self.row_count += len(df_similarity_list)
+
+    def close(self):
+        if self.output_format == 'csv':
+            if self.row_count == 0:
+                pd.DataFrame(columns=list(self.npy_columns)).to_csv(self.save_file_name, index=False, sep=' ')
+        else:
+            # numpy pads the header for growth, so the final length fits in place
+            for npy_file, dtype in zip(self.files, self.dtypes):
+                npy_file.seek(0)
+                self._write_npy_header(npy_file, dtype, self.row_count)
+                npy_file.close()
+
+        with open(self.save_file_name + '.meta.json', 'w') as meta_file:
+            json.dump({'format': self.output_format, 'rows': self.row_count, 'half': self.half}, meta_file)
+
+    def abort(self):
+        """
+        close the files and remove them, an interrupted list must not look complete
+        """
+        if self.output_format == 'npy':
+            for npy_file in self.files:
+                npy_file.close()
+        for file_name in self.file_names(self.save_file_name, self.output_format).values():
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_similarity_meta(save_file_name):
+    """
+    the meta.json of a similarity list written by SimilarityWriter,
+    a list without one is a plain csv file unless only the npy columns exist
+
+    return : dict with format and half
+    """
+    if os.path.exists(save_file_name + '.meta.json'):
+        with open(save_file_name + '.meta.json') as meta_file:
+            meta = json.load(meta_file)
+    else:
+        output_format = 'npy' if not os.path.exists(save_file_name) and \
+            os.path.exists('%s.source.npy' % save_file_name) else 'csv'
+        meta = {'format': output_format}
+    meta.setdefault('half', False)
+    return meta
+
+
+def load_similarity(save_file_name, mmap_mode='r', expand=False):
+    """
+    load a similarity list written by SimilarityWriter, the npy format is memory-mapped unless mmap_mode is None
+    input: expand ----> return both directions of a half stored list (this reads it into memory)
+
+    return : df_similarity_list
+        source     target   similarity
+    """
+    meta = read_similarity_meta(save_file_name)
+    half = meta['half']
+
+    if meta['format'] == 'csv':
+        df_similarity_list = pd.read_csv(save_file_name, sep=' ')
+    else:
+        columns = {}
+        for column in SimilarityWriter.npy_columns:
+            columns[column] = np.load('%s.%s.npy' % (save_file_name, column), mmap_mode=mmap_mode)
+        df_similarity_list = pd.DataFrame(columns, copy=False)
+
+    if expand and half:
+        return expand_half_similarity(df_similarity_list)
+    return df_similarity_list
+
+
+def expand_half_similarity(df_similarity_list):
+    """
+    turn a half stored similarity list (source < target) into both directions,
+    self pairs are their own mirror and stay single
+
+    return : df_similarity_list sorted by source and target
+    """
+    df_mirror = df_similarity_list[df_similarity_list['source'] != df_similarity_list['target']].copy()
+    df_mirror['source'] = df_similarity_list['target']
+    df_mirror['target'] = df_similarity_list['source']
+    df_similarity_list = pd.concat([df_similarity_list, df_mirror], ignore_index=True)
+    return df_similarity_list.sort_values(['source', 'target']).reset_index(drop=True)
+
+
+def _iter_similarity_chunks(save_file_name, chunk_rows):
+    """
+    read a similarity list written by SimilarityWriter chunk by chunk, a half stored list also yields the mirror
+    of every chunk (self pairs are their own mirror), string node IDs are read as fixed width strings
+
+    return : generator of source, target, similarity arrays
+    """
+    meta = read_similarity_meta(save_file_name)
+    half = meta['half']
+
+    if meta['format'] == 'npy':
+        columns = [np.load('%s.%s.npy' % (save_file_name, column), mmap_mode='r')
+                   for column in SimilarityWriter.npy_columns]
+        chunks = ((columns[0][start:start + chunk_rows], columns[1][start:start + chunk_rows],
+                   columns[2][start:start + chunk_rows]) for start in range(0, len(columns[0]), chunk_rows))
+    else:
+        chunks = ((df_chunk['source'].values, df_chunk['target'].values, df_chunk['similarity'].values)
+                  for df_chunk in pd.read_csv(save_file_name, sep=' ', chunksize=chunk_rows))
+
+    for source, target, similarity in chunks:
+        source, target, similarity = np.asarray(source), np.asarray(target), np.asarray(similarity)
+        # np.save cannot write object arrays without pickling, as preprocessing._index_array
+        if source.dtype == object:
+            source = source.astype(str)
+        if target.dtype == object:
+            target = target.astype(str)
+        yield source, target, similarity
+        if half:
+            mirror = source != target
+            yield target[mirror], source[mirror], similarity[mirror]
+
+
+def build_similarity_store(save_file_name, chunk_rows=1 << 22):
+    """
+    this method is implemented for indexing a similarity list written by cal_save_all_similarity for queries,
+    the store is the directory save_file_name + '.store' and holds both directions of every pair:
+        node_ids.npy ----> the sorted distinct source nodes
+        offsets.npy ----> the rows of node_ids[i] are offsets[i]:offsets[i + 1]
+        target.npy, similarity.npy ----> the rows, sorted by source and then target
+        by_score.npy ----> the i-th entry of a source is the row, within the source, of its i-th highest
+                           similarity (ties by the smaller target), so a top-k list is k reads
+        meta.json ----> row count, and whether node_ids is 0 ... n - 1 so a node is its own position
+    the list is bucketed by source and every source is sorted by chunks of at most chunk_rows rows (a source with
+    more rows is sorted alone), only the node table is held whole in memory, open the store with SimilarityStore
+    input: save_file_name ----> the base name given to SimilarityWriter (csv or npy), node IDs are integers
+                                or strings, which are stored as fixed width strings
+
+    return : the store directory
+    """
+    store_dir = save_file_name + '.store'
+    building_dir = store_dir + '.building'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    os.makedirs(building_dir)
+
+    # the rows of every source node
+    node_ids, counts = None, None
+    target_dtype, similarity_dtype = np.dtype(np.int64), np.dtype(np.float64)
+    for source, target, similarity in _iter_similarity_chunks(save_file_name, chunk_rows):
+        chunk_ids, chunk_counts = np.unique(source, return_counts=True)
+        if node_ids is not None:
+            chunk_ids, inverse = np.unique(np.concatenate([node_ids, chunk_ids]), return_inverse=True)
+            chunk_counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([counts, chunk_counts]))
+            # string IDs of a later chunk may be wider
+            target_dtype = np.promote_types(target_dtype, target.dtype)
+            similarity_dtype = np.promote_types(similarity_dtype, similarity.dtype)
+        else:
+            target_dtype, similarity_dtype = target.dtype, similarity.dtype
+        node_ids, counts = chunk_ids, chunk_counts.astype(np.int64)
+    if node_ids is None:
+        node_ids, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    num_rows = int(offsets[-1])
+
+    def open_column(name, dtype):
+        return np.lib.format.open_memmap(os.path.join(building_dir, name + '.npy'), mode='w+', dtype=dtype,
+                                         shape=(num_rows,))
+
+    # bucket the rows by source, in reading order within a source
+    target_column = open_column('target', target_dtype)
+    similarity_column = open_column('similarity', similarity_dtype)
+    cursor = offsets[:-1].copy()
+    for source, target, similarity in _iter_similarity_chunks(save_file_name, chunk_rows):
+        if node_ids.dtype.kind == 'U':
+            # a csv chunk of numeric looking IDs is read as integers, compare them as the strings they were
+            source, target = source.astype(node_ids.dtype), target.astype(target_dtype)
+        position = np.searchsorted(node_ids, source)
+        order = np.argsort(position, kind='stable')
+        position = position[order]
+        group_start = np.flatnonzero(np.concatenate([[True], position[1:] != position[:-1]])) if len(order) > 0 \
+            else np.zeros(0, dtype=np.int64)
+        rank = np.arange(len(order)) - np.repeat(group_start, np.diff(np.append(group_start, len(order))))
+        rows = cursor[position] + rank
+        target_column[rows] = target[order]
+        similarity_column[rows] = similarity[order]
+        cursor += np.bincount(position, minlength=len(node_ids))
+
+    # sort every source by target and rank it by score, whole sources at a time
+    by_score = open_column('by_score', np.int32 if counts.max(initial=0) <= np.iinfo(np.int32).max else np.int64)
+    start = 0
+    while start < len(node_ids):
+        end = max(int(np.searchsorted(offsets, offsets[start] + chunk_rows, side='right')) - 1, start + 1)
+        first, last = offsets[start], offsets[end]
+        segment = np.repeat(np.arange(end - start), counts[start:end])
+        order = np.lexsort((target_column[first:last], segment))
+        target_block = target_column[first:last][order]
+        similarity_block = similarity_column[first:last][order]
+        target_column[first:last] = target_block
+        similarity_column[first:last] = similarity_block
+        score_order = np.lexsort((target_block, -similarity_block.astype(np.float64), segment))
+        by_score[first:last] = score_order - (offsets[start:end] - first)[segment]
+        start = end
+    for column in (target_column, similarity_column, by_score):
+        column.flush()
+    del target_column, similarity_column, by_score
+
+    np.save(os.path.join(building_dir, 'node_ids.npy'), node_ids)
+    np.save(os.path.join(building_dir, 'offsets.npy'), offsets)
+    dense = bool(node_ids.dtype.kind in 'iu' and (len(node_ids) == 0 or (node_ids[0] == 0 and
+                                                                         node_ids[-1] == len(node_ids) - 1)))
+    with open(os.path.join(building_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'rows': num_rows, 'nodes': len(node_ids), 'dense': dense}, meta_file)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.rename(building_dir, store_dir)
+    return store_dir
+
+
+class SimilarityStore(object):
+    """
+    query a store of build_similarity_store, the columns are memory-mapped so opening it reads nothing
+    score(u, v) / scores(sources, targets) ----> binary search in the sorted targets of u, O(log d)
+    candidates(u, k) ----> the rows of u by descending similarity, one seek through the offsets
+    a pair that is not stored has no score, e.g. no common neighbour, and gets default
+    """
+
+    def __init__(self, store_dir, mmap_mode='r'):
+        with open(os.path.join(store_dir, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.node_ids = np.load(os.path.join(store_dir, 'node_ids.npy'))
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'), mmap_mode=mmap_mode)
+        self.target = np.load(os.path.join(store_dir, 'target.npy'), mmap_mode=mmap_mode)
+        self.similarity = np.load(os.path.join(store_dir, 'similarity.npy'), mmap_mode=mmap_mode)
+        self.by_score = np.load(os.path.join(store_dir, 'by_score.npy'), mmap_mode=mmap_mode)
+
+    @classmethod
+    def open(cls, data_name, name, similarity_dir='../temp/similarity_directory', mmap_mode='r'):
+        """
+        the store of index name saved by cal_save_all_similarity(data_name, store=True)
+        """
+        return cls(os.path.join(similarity_dir, data_name, data_name + '_' + name + '.store'), mmap_mode)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def _node_array(self, nodes):
+        """
+        the query nodes as an array comparable with the stored IDs, strings when the store holds string IDs
+        """
+        nodes = np.atleast_1d(np.asarray(nodes))
+        if self.node_ids.dtype.kind == 'U' and nodes.dtype.kind != 'U':
+            nodes = nodes.astype(str)
+        return nodes
+
+    def _positions(self, nodes):
+        """
+        return : position, found ----> the position of every node in node_ids, found is False for nodes without rows
+        """
+        nodes = self._node_array(nodes)
+        num_nodes = len(self.node_ids)
+        if self.meta['dense'] and nodes.dtype.kind in 'iu':
+            found = (nodes >= 0) & (nodes < num_nodes)
+            return np.where(found, nodes, 0).astype(np.int64), found
+        position = np.searchsorted(self.node_ids, nodes)
+        position[position == num_nodes] = 0
+        found = self.node_ids[position] == nodes if num_nodes > 0 else np.zeros(len(nodes), dtype=bool)
+        return position, found
+
+    def _row_ranges(self, nodes):
+        """
+        return : start, end ----> the rows of every node, empty for nodes without rows
+        """
+        position, found = self._positions(nodes)
+        start = np.where(found, self.offsets[position], 0)
+        end = np.where(found, self.offsets[position + 1], 0)
+        return start, end
+
+    def scores(self, sources, targets, default=0.0):
+        """
+        the similarity of many pairs at once, all the binary searches advance together one level per step
+        input: sources, targets ----> arrays of node IDs
+
+        return : similarity array aligned on the pairs, default for the pairs that are not stored
+        """
+        sources = self._node_array(sources)
+        targets = self._node_array(targets)
+        low, end = self._row_ranges(sources)
+        high = end.copy()
+        active = np.flatnonzero(low < high)
+        while len(active) > 0:
+            middle = (low[active] + high[active]) // 2
+            right = self.target[middle] < targets[active]
+            low[active] = np.where(right, middle + 1, low[active])
+            high[active] = np.where(right, high[active], middle)
+            active = active[low[active] < high[active]]
+
+        result = np.full(len(sources), default, dtype=np.float64)
+        hit = np.flatnonzero(low < end)
+        hit = hit[self.target[low[hit]] == targets[hit]]
+        result[hit] = self.similarity[low[hit]]
+        return result
+
+    def score(self, source, target, default=0.0):
+        """
+        the similarity of one pair, default when it is not stored
+        """
+        return float(self.scores([source], [target], default)[0])
+
+    def candidates(self, node, k=None):
+        """
+        the targets of node by descending similarity, ties by the smaller target
+        input: k ----> only the first k when given
+
+        return : df_candidate_list
+            target     similarity
+        """
+        start, end = self._row_ranges([node])
+        start, end = int(start[0]), int(end[0])
+        if k is not None:
+            end = min(end, start + k)
+        rows = start + np.asarray(self.by_score[start:end], dtype=np.int64)
+        return pd.DataFrame({'target': self.target[rows], 'similarity': self.similarity[rows]})
+
+
+def apply_similarity_delta(df_stored, df_delta):
+    """
+    apply the delta of LocalMethods.add_edges / remove_edges to a stored wide table
+    (or to a source/target/similarity list when the delta is reduced to the same columns)
+
+    return : the updated table sorted by source and target
+    """
+    delta_pairs = pd.MultiIndex.from_frame(df_delta[['source', 'target']])
+    stored_pairs = pd.MultiIndex.from_frame(df_stored[['source', 'target']])
+
+    df_updated = df_stored[~stored_pairs.isin(delta_pairs)]
+    df_upsert = df_delta.loc[~df_delta['removed'], list(df_stored.columns)]
+    df_updated = pd.concat([df_updated, df_upsert], ignore_index=True)
+    return df_updated.sort_values(['source', 'target']).reset_index(drop=True)
 
 
 class LocalMethods(object):
@@ -29,10 +860,931 @@ class LocalMethods(object):
     10) Hub Depressed Index (HDI)
     11) Local Leicht-Holme-Newman Index (LLHN)
 
+    engine selects how the common neighbour family (CN, AA, RA, JC, SA, SO, HPI, HDI, LLHN) is computed:
+    'pandas' ----> enumerate the common neighbours and aggregate them with merges and groupby
+    'sparse' ----> sparse matrix products over the adjacency matrix A,
+                   A*A for CN, A*diag(1/log k)*A for AA and A*diag(1/k)*A for RA
+
+    memory_budget (bytes) partitions the source nodes into blocks whose estimated two-hop paths fit the budget,
+    the common neighbour family is then computed block by block with either engine (the sparse one multiplies
+    the rows of a block), the scores are exact
+
+    n_jobs > 1 (or -1 for all cores) computes the blocks in a process pool which reads the adjacency from shared memory,
+    it covers the common neighbour family (with either engine, as memory_budget), RA_CNI and the quasi-local LP and
+    Katz, PA is a product of degrees and needs no pool, cal_candidate_similarity and the MinHash and sketch estimates
+    always run in one process
+
+    half = True computes and returns only the pairs with source < target, every index is symmetric,
+    expand_half_similarity restores both directions
+
+    profiler (profiling.StageProfiler) records the time, rows and memory of every stage, it is off when None
+
+    from_graph_cache builds the object from the binary graph cache of NodeReNumber instead of an edge list
+
+    compact = True keeps node IDs in int32 (when they fit, see _id_dtype) and scores in float32 from the adjacency
+    to the output frames, including the enumerated common neighbours of the pandas engine
+
     """
 
-    def __init__(self, df_edge_list):
+    engines = ('pandas', 'sparse')
+    similarity_names = ['CN', 'AA', 'RA', 'RA_CNI', 'PA', 'JC', 'SA', 'SO', 'HPI', 'HDI', 'LLHN']
+    common_neighbor_names = ['CN', 'AA', 'RA', 'JC', 'SA', 'SO', 'HPI', 'HDI', 'LLHN']
+    degree_normalized_names = ['JC', 'SA', 'SO', 'HPI', 'HDI', 'LLHN']
+    # the walk based indices of iter_quasi_local_blocks, saved by cal_save_all_similarity(quasi_local=True)
+    quasi_local_names = ['LP', 'Katz']
+    # bump when the saved similarity files change, so older cache entries are not reused
+    cache_version = 1
+    # rough peak bytes of the enumeration per two-hop path, used to size the blocks
+    bytes_per_path = 64
+    default_block_size = 1024
+    # two-hop paths enumerated at once by the pandas engine
+    path_chunk_size = 1 << 22
+
+    def __init__(self, df_edge_list, engine='pandas', memory_budget=None, n_jobs=1, half=False, profiler=None,
+                 compact=False):
+        if engine not in self.engines:
+            raise ValueError('unknown engine %s, expected one of %s' % (engine, ', '.join(self.engines)))
+
         self.df_edge_list = df_edge_list
+        self.engine = engine
+        self.memory_budget = memory_budget
+        self.n_jobs = n_jobs
+        self.half = half
+        self.profiler = profiler
+        self.compact = compact
+        self._adjacency = None
+        self._sparse_adjacency = None
+        self._cni_weight = None
+        self._minhash_signatures = {}
+        self._bottom_k_sketches = {}
+        # set when the adjacency is memory-mapped from a graph cache, the pool workers then map the same files
+        self.graph_cache_dir = None
+        self.node_labels = None
+
+    @classmethod
+    def from_graph_cache(cls, cache_dir, mmap_mode='r', **kwargs):
+        """
+        build a LocalMethods on the graph cache written by NodeReNumber (graph_cache.save_graph_cache),
+        the CSR arrays are memory-mapped so nothing is parsed and the pages are shared between processes
+        input:
+            cache_dir ----> the cache directory, transformed_dataset/<name>/graph for NodeReNumber
+            mmap_mode ----> 'r' to memory-map the arrays, None to read them into memory
+            kwargs ----> the other arguments of LocalMethods (engine, memory_budget, n_jobs, half, profiler, compact)
+        the node IDs are the renumbered IDs 0 ... n - 1, the labels are kept in node_labels
+        """
+        local_methods = cls(None, **kwargs)
+        arrays = load_graph_cache(cache_dir, mmap_mode)
+        node_ids = np.arange(len(arrays['degree']), dtype=np.int64)
+        local_methods._adjacency = Adjacency(node_ids, arrays['indptr'], arrays['indices'], arrays['degree'])
+        local_methods.node_labels = arrays['labels']
+        if mmap_mode is not None:
+            local_methods.graph_cache_dir = cache_dir
+        return local_methods
+
+    def _stage(self, name):
+        return stage(self.profiler, name)
+
+    def get_adjacency(self):
+        """
+        build the symmetric adjacency of the graph on first use and cache it,
+        every index reads the neighbor table and the degree table from here
+
+        return : Adjacency(node_ids, indptr, indices, degree)
+            node_ids ----> the original node ID of every compact node ID, sorted
+            indptr, indices ----> CSR arrays of int32 compact neighbor IDs
+            degree ----> the neighbor count of every compact node ID
+        """
+        if self._adjacency is None:
+            with self._stage('build_adjacency') as stage:
+                self._adjacency = self._build_adjacency()
+                stage.rows = len(self._adjacency.indices)
+        return self._adjacency
+
+    def _build_adjacency(self):
+        """
+        the CSR arrays of df_edge_list in both directions, see get_adjacency
+        """
+        source = self.df_edge_list['source'].values
+        target = self.df_edge_list['target'].values
+        node_ids, compact = np.unique(np.concatenate([target, source]), return_inverse=True)
+        compact = compact.reshape(-1)
+        num_edges = len(source)
+
+        # the reversed edges followed by the original ones, same as df_all_nodes_pair
+        all_source = compact
+        all_target = np.concatenate([compact[num_edges:], compact[:num_edges]])
+
+        indptr, indices, degree = build_csr(all_source, all_target, len(node_ids))
+        return Adjacency(node_ids, indptr, indices, degree)
+
+    def get_sparse_adjacency(self):
+        """
+        the adjacency matrix A as a scipy CSR matrix, built from the cached CSR arrays on first use,
+        A[x, y] is the number of times y appears in the neighbor list of x
+        """
+        if self._sparse_adjacency is None:
+            adjacency = self.get_adjacency()
+            self._sparse_adjacency = sparse_adjacency(adjacency.indptr, adjacency.indices)
+        return self._sparse_adjacency
+
+    def get_cni_weight(self):
+        """
+        the edge weighted matrix W of RA-CNI, W[x, y] = A[x, y] * |1 / k_x - 1 / k_y|, cached
+        """
+        if self._cni_weight is None:
+            self._cni_weight = cni_weight(self.get_sparse_adjacency(), self.get_adjacency().degree)
+        return self._cni_weight
+
+    def _compact_ids(self, node_list):
+        """
+        map original node IDs to compact node IDs
+        return : compact, found ----> found is False for nodes that are not in the graph
+        """
+        node_ids = self.get_adjacency().node_ids
+        node_list = np.asarray(node_list)
+        compact = np.searchsorted(node_ids, node_list)
+        compact[compact == len(node_ids)] = 0
+        found = node_ids[compact] == node_list if len(node_ids) > 0 else np.zeros(len(node_list), dtype=bool)
+        return compact, found
+
+    @staticmethod
+    def _split_pairs(node_pairs):
+        """
+        node_pairs as a dataframe with source and target columns or an array of shape (n, 2)
+        return : pair_source, pair_target
+        """
+        if isinstance(node_pairs, pd.DataFrame):
+            return node_pairs['source'].values, node_pairs['target'].values
+        node_pairs = np.asarray(node_pairs)
+        return node_pairs[:, 0], node_pairs[:, 1]
+
+    def _node_degree(self, compact, found):
+        """
+        the int64 degree of compact node IDs, 0 for the nodes that are not in the graph
+        """
+        return np.where(found, self.get_adjacency().degree.astype(np.int64)[compact], 0)
+
+    def _id_dtype(self):
+        """
+        int32 for the node IDs when they fit, otherwise their own dtype
+        """
+        node_ids = self.get_adjacency().node_ids
+        if node_ids.dtype.kind not in 'iu':
+            return node_ids.dtype
+        info = np.iinfo(np.int32)
+        if len(node_ids) == 0 or (node_ids[0] >= info.min and node_ids[-1] <= info.max):
+            return np.int32
+        return node_ids.dtype
+
+    def _output_ids(self, compact):
+        """
+        the original node IDs of compact node IDs, in _id_dtype in compact mode
+        """
+        node_ids = self.get_adjacency().node_ids
+        if self.compact:
+            # cast the n node IDs, not the gathered rows
+            node_ids = node_ids.astype(self._id_dtype(), copy=False)
+        return node_ids[compact]
+
+    def _output_scores(self, similarity):
+        """
+        float32 scores in compact mode, unchanged otherwise
+        """
+        if self.compact:
+            return np.asarray(similarity, dtype=np.float32)
+        return similarity
+
+    def _similarity_frame(self, source, target, similarity):
+        """
+        map compact node IDs back to the original IDs
+        return : df_similarity_list
+            source     target   similarity
+        """
+        df_similarity_list = pd.DataFrame()
+        df_similarity_list['source'] = self._output_ids(source)
+        df_similarity_list['target'] = self._output_ids(target)
+        df_similarity_list['similarity'] = self._output_scores(similarity)
+        return df_similarity_list
+
+    def _sparse_blocks(self, name, block_size=None):
+        """
+        the sparse engine for the common neighbour family over the blocks of _source_blocks (see _iter_walk_blocks),
+        A[rows] * A for CN, A[rows] * diag(1/log k) * A for AA and A[rows] * diag(1/k) * A for RA,
+        the degree normalized indices are derived from CN
+
+        return : generator of source, target, similarity sorted by source and then target
+        """
+        degree = self.get_adjacency().degree
+        product_name = name if name in ('AA', 'RA') else 'CN'
+        for source, target, similarity in self._iter_walk_blocks(product_name, block_size=block_size):
+            if name != product_name:
+                similarity = degree_normalize(name, similarity, degree[source], degree[target])
+            yield source, target, similarity
+
+    def _sparse_similarity(self, name):
+        """
+        the sparse engine for the common neighbour family, the whole product at once
+        input: name ----> CN, AA, RA, JC, SA, SO, HPI, HDI or LLHN
+
+        return : df_similarity_list
+            source     target   similarity
+        """
+        blocks = list(self._sparse_blocks(name, max(len(self.get_adjacency().node_ids), 1)))
+        return self._similarity_frame(*[np.concatenate([block[i] for block in blocks]) for i in range(3)])
+
+    def _lookup_degree(self, node_list):
+        """
+        the degree of original node IDs that are all in the graph, a join on the sorted node IDs
+        that adds no key column and cannot produce NaN, int32 in compact mode and int64 otherwise
+        """
+        degree = self.get_adjacency().degree.astype(np.int32 if self.compact else np.int64, copy=False)
+        return degree[np.searchsorted(self.get_adjacency().node_ids, node_list)]
+
+    def _merge_middle_degree(self, df_common_neighbor):
+        """
+        attach the degree of the common neighbour to every row of _get_common_neighbor
+
+        return : df_common_neighbor
+            source_x     source_y     count
+        """
+        with self._stage('degree_merge') as stage:
+            df_common_neighbor = pd.DataFrame({'source_x': df_common_neighbor['source_x'].values,
+                                               'source_y': df_common_neighbor['source_y'].values,
+                                               'count': self._lookup_degree(df_common_neighbor['target'].values)})
+            stage.rows = len(df_common_neighbor)
+        return df_common_neighbor
+
+    def _merge_pair_degree(self, df_common_neighbor_count):
+        """
+        attach the degrees of both ends to the common neighbour counts
+
+        return : df_common_neighbor_with_total_neighbor
+            source_x     source_y     CN     nei_count_x     nei_count_y
+        """
+        if self.compact:
+            df_common_neighbor_count['CN'] = df_common_neighbor_count['CN'].astype(np.int32)
+        with self._stage('degree_merge') as stage:
+            df_common_neighbor_with_total_neighbor = df_common_neighbor_count
+            df_common_neighbor_with_total_neighbor['nei_count_x'] = self._lookup_degree(
+                df_common_neighbor_count['source_x'].values)
+            df_common_neighbor_with_total_neighbor['nei_count_y'] = self._lookup_degree(
+                df_common_neighbor_count['source_y'].values)
+            stage.rows = len(df_common_neighbor_with_total_neighbor)
+        return df_common_neighbor_with_total_neighbor
+
+    def _get_common_neighbor(self):
+        """
+        expand every node into all ordered pairs of its neighbors directly from the CSR arrays,
+        this replaces the self merge of df_all_nodes_pair on target
+
+        return : df_common_neighbor
+            source_x     target     source_y
+            (target is the common neighbour of source_x and source_y, source_x != source_y)
+        """
+        adjacency = self.get_adjacency()
+        with self._stage('self_merge') as stage:
+            degree = adjacency.degree.astype(np.int64)
+
+            path_count = degree * degree
+            path_offset = np.zeros(len(degree) + 1, dtype=np.int64)
+            np.cumsum(path_count, out=path_offset[1:])
+
+            # the int64 index temporaries only live for one chunk of middle nodes
+            chunk_bounds = np.unique(np.searchsorted(path_offset, np.arange(0, path_offset[-1], self.path_chunk_size),
+                                                     side='right') - 1)
+            chunk_bounds = np.append(chunk_bounds, len(degree))
+            columns = {'source_x': [], 'target': [], 'source_y': []}
+            for chunk_start, chunk_end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+                middle = np.repeat(np.arange(chunk_start, chunk_end), path_count[chunk_start:chunk_end])
+                position = np.arange(path_offset[chunk_start], path_offset[chunk_end]) - path_offset[middle]
+                middle_degree = degree[middle]
+                start = adjacency.indptr[middle]
+                source_x = adjacency.indices[start + position // middle_degree]
+                source_y = adjacency.indices[start + position % middle_degree]
+                del position, middle_degree, start
+
+                keep = self._pair_mask(source_x, source_y)
+                columns['source_x'].append(self._output_ids(source_x[keep]))
+                columns['target'].append(self._output_ids(middle[keep]))
+                columns['source_y'].append(self._output_ids(source_y[keep]))
+
+            for column, pieces in columns.items():
+                columns[column] = np.concatenate(pieces) if pieces else self._output_ids(path_count[:0])
+            # the concatenated columns are handed over without another copy
+            df_common_neighbor = pd.DataFrame(columns, copy=False)
+            stage.rows = len(df_common_neighbor)
+        return df_common_neighbor
+
+    def _group_pairs(self, df_common_neighbor, column, how):
+        """
+        the groupby of the pandas engine, count or sum column over the rows of every (source_x, source_y) pair
+        input: how ----> 'count' or 'sum'
+
+        return : source_x     source_y     column, sorted by source_x and then source_y
+
+        in compact mode with int32 node IDs the pair is packed into one int64 key and aggregated with a sort,
+        which needs about half the memory of a groupby on two columns
+        """
+        with self._stage('groupby') as stage:
+            if self.compact and self._id_dtype() == np.int32:
+                offset = np.int64(np.iinfo(np.int32).min)
+                key = df_common_neighbor['source_x'].values.astype(np.int64) << 32
+                key += df_common_neighbor['source_y'].values.astype(np.int64) - offset
+                if how == 'count':
+                    key, value = np.unique(key, return_counts=True)
+                    value = value.astype(np.int32)
+                else:
+                    order = np.argsort(key)
+                    key = key[order]
+                    group_start = np.flatnonzero(np.diff(key, prepend=key[:1] - 1))
+                    value = np.add.reduceat(df_common_neighbor[column].values[order], group_start)
+                    key = key[group_start]
+
+                df_group = pd.DataFrame()
+                df_group['source_x'] = (key >> 32).astype(np.int32)
+                df_group['source_y'] = ((key & 0xffffffff) + offset).astype(np.int32)
+                df_group[column] = value
+            else:
+                df_group = df_common_neighbor.groupby(['source_x', 'source_y'])[[column]]
+                df_group = getattr(df_group, how)().reset_index()
+            stage.rows = len(df_group)
+        return df_group
+
+    def _pair_mask(self, source, target):
+        """
+        the compact node pairs to output: source != target, or source < target in half mode
+        """
+        return source < target if self.half else source != target
+
+    def _is_blocked(self):
+        """
+        the common neighbour family goes through the block pipeline with a memory budget or several jobs
+        """
+        return self.memory_budget is not None or self.n_jobs != 1
+
+    def _iter_blocks(self, name=None, k=None, block_size=None):
+        """
+        run similarity_block over the blocks of _source_blocks, in a process pool when n_jobs != 1 (see _pool_map)
+
+        return : generator of the block results in source order
+        """
+        adjacency = self.get_adjacency()
+        blocks = self._source_blocks(block_size)
+        # top-k needs both directions of every pair
+        half = self.half and k is None
+
+        if self._num_jobs() == 1:
+            for sources in blocks:
+                with self._stage('common_neighbor_block') as stage:
+                    result = similarity_block(adjacency.indptr, adjacency.indices, adjacency.degree, sources, name, k,
+                                              half)
+                    stage.rows = len(result[0])
+                yield result
+            return
+
+        tasks = ((sources, name, k, half) for sources in blocks)
+        for result in self._pool_map(_worker_similarity_block, tasks, 'common_neighbor_block'):
+            yield result
+
+    def _iter_walk_blocks(self, name, k=None, block_size=None, max_length=2, weights=None):
+        """
+        run walk_block over the blocks of _source_blocks sized for walks up to max_length,
+        in a process pool when n_jobs != 1 (see _pool_map)
+        input: name ----> RA_CNI, CN, AA, RA, LP or Katz, see walk_block
+
+        return : generator of source, target, similarity in source order
+        """
+        blocks = self._source_blocks(block_size, max_length)
+        # top-k needs both directions of every pair
+        half = self.half and k is None
+        stage_name = 'walk_product' if name in self.quasi_local_names else 'sparse_product'
+
+        if self._num_jobs() == 1:
+            matrix = self.get_sparse_adjacency()
+            weight = self.get_cni_weight() if name == 'RA_CNI' else None
+            operands = walk_operands(matrix, self.get_adjacency().degree, name, weight)
+            for rows in blocks:
+                with self._stage(stage_name) as stage:
+                    result = walk_block(matrix, operands, rows, name, weights, k, half)
+                    stage.rows = len(result[0])
+                yield result
+            return
+
+        tasks = ((rows, name, weights, k, half) for rows in blocks)
+        for result in self._pool_map(_worker_walk_block, tasks, stage_name):
+            yield result
+
+    def _num_jobs(self):
+        return os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+
+    def _pool_map(self, worker, tasks, stage_name):
+        """
+        run worker over tasks in a pool of n_jobs processes, the workers read the CSR arrays from shared memory,
+        or map the graph cache files, instead of receiving a pickled copy
+
+        return : generator of the results in task order
+        """
+        adjacency = self.get_adjacency()
+        handles, array_specs = [], []
+        try:
+            if self.graph_cache_dir is not None:
+                # the workers map the cache files themselves, nothing is copied
+                initializer, initargs = _init_worker_from_cache, (self.graph_cache_dir,)
+            else:
+                for array in (adjacency.indptr, adjacency.indices, adjacency.degree):
+                    array = np.ascontiguousarray(array)
+                    handle = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                    handles.append(handle)
+                    np.ndarray(array.shape, dtype=array.dtype, buffer=handle.buf)[:] = array
+                    array_specs.append((handle.name, array.shape, array.dtype.str))
+                initializer, initargs = _init_worker, (array_specs,)
+
+            with multiprocessing.Pool(self._num_jobs(), initializer=initializer, initargs=initargs) as pool:
+                results = pool.imap(worker, tasks)
+                while True:
+                    # the time spent waiting for the next block of the pool
+                    with self._stage(stage_name) as stage:
+                        result = next(results, None)
+                        stage.rows = 0 if result is None else len(result[0])
+                    if result is None:
+                        break
+                    yield result
+        finally:
+            for handle in handles:
+                handle.close()
+                handle.unlink()
+
+    def _source_blocks(self, block_size=None, max_length=2):
+        """
+        split the compact source nodes into consecutive blocks,
+        of block_size nodes when it is given, otherwise of at most memory_budget bytes of estimated walks
+        of length 1 ... max_length (the edges and two-hop paths by default), otherwise of default_block_size nodes,
+        a node whose walks alone exceed the budget gets its own block
+        """
+        adjacency = self.get_adjacency()
+        num_nodes = len(adjacency.node_ids)
+
+        if block_size is not None or self.memory_budget is None:
+            block_size = block_size or self.default_block_size
+            for start in range(0, num_nodes, block_size):
+                yield np.arange(start, min(start + block_size, num_nodes))
+            return
+
+        budget_paths = max(self.memory_budget // self.bytes_per_path, 1)
+        paths = np.zeros(num_nodes)
+        for length in range(1, max_length + 1):
+            paths += path_counts(adjacency.indptr, adjacency.indices, adjacency.degree, length)
+        cumulative_paths = np.cumsum(paths)
+        start = 0
+        while start < num_nodes:
+            done = cumulative_paths[start - 1] if start > 0 else 0
+            end = max(int(np.searchsorted(cumulative_paths, done + budget_paths, side='right')), start + 1)
+            yield np.arange(start, min(end, num_nodes))
+            start = end
+
+    def iter_similarity_blocks(self, name):
+        """
+        stream one index of the common neighbour family block by block (see _source_blocks),
+        enumerated or, with the sparse engine, as sparse products of the rows of a block
+
+        return : generator of df_similarity_list blocks, the concatenation is sorted by source and then target
+            source     target   similarity
+        """
+        blocks = self._sparse_blocks(name) if self.engine == 'sparse' else self._iter_blocks(name)
+        for block in blocks:
+            yield self._similarity_frame(*block)
+
+    def _blocked_similarity(self, name):
+        """
+        concatenate the blocks of iter_similarity_blocks
+        """
+        return pd.concat(list(self.iter_similarity_blocks(name)), ignore_index=True)
+
+    def cal_top_k(self, name, k=50, block_size=None):
+        """
+        the top-k mode, keep only the k most similar targets of every source node,
+        the source nodes are processed block by block so the peak memory is O(n * k)
+        plus the two-hop paths of one block
+        input: name ----> one of the common neighbour family: CN, AA, RA, JC, SA, SO, HPI, HDI, LLHN,
+                         or PA, whose top-k are the highest degree non-neighbors and need no enumeration,
+                         or RA_CNI, whose sparse products are cut to the top-k block by block
+               k ----> number of targets kept per source
+               block_size ----> number of source nodes computed at once, sized by memory_budget when None
+
+        return : df_top_k_list, sorted by source and then by descending similarity
+            source     target   similarity
+        """
+        if name == 'PA':
+            return self._similarity_frame(*self._top_k_PA(k))
+        if name == 'RA_CNI':
+            return self.cal_RA_CNI(k, block_size)
+        if name not in self.common_neighbor_names:
+            raise ValueError('top-k is not supported for %s' % name)
+
+        source_list, target_list, similarity_list = [], [], []
+        for source, target, similarity in self._iter_blocks(name, k, block_size):
+            source_list.append(source)
+            target_list.append(target)
+            similarity_list.append(similarity)
+
+        return self._similarity_frame(np.concatenate(source_list), np.concatenate(target_list),
+                                      np.concatenate(similarity_list))
+
+    def _common_neighbor_frame(self, source, target, cn, aa, ra):
+        """
+        the wide table of the common neighbour family from the fused sums of compact node pairs
+            source     target   CN   AA   RA   JC   SA   SO   HPI   HDI   LLHN
+        """
+        adjacency = self.get_adjacency()
+        degree_x = adjacency.degree[source]
+        degree_y = adjacency.degree[target]
+
+        df_common_neighbor_indices = pd.DataFrame()
+        df_common_neighbor_indices['source'] = self._output_ids(source)
+        df_common_neighbor_indices['target'] = self._output_ids(target)
+        df_common_neighbor_indices['CN'] = self._output_scores(cn)
+        df_common_neighbor_indices['AA'] = self._output_scores(aa)
+        df_common_neighbor_indices['RA'] = self._output_scores(ra)
+        for name in self.degree_normalized_names:
+            df_common_neighbor_indices[name] = self._output_scores(degree_normalize(name, cn, degree_x, degree_y))
+        return df_common_neighbor_indices
+
+    def iter_common_neighbor_indices(self):
+        """
+        the fused mode for the common neighbour family, the common neighbours are enumerated once,
+        CN, AA and RA are accumulated together and the degree normalized indices are derived as columns,
+        streamed block by block of source nodes (see _source_blocks)
+
+        return : generator of df_common_neighbor_indices blocks
+            source     target   CN   AA   RA   JC   SA   SO   HPI   HDI   LLHN
+        """
+        for block in self._iter_blocks():
+            yield self._common_neighbor_frame(*block)
+
+    def cal_common_neighbor_indices(self):
+        """
+        concatenate the blocks of iter_common_neighbor_indices into one wide table
+
+        return : df_common_neighbor_indices
+            source     target   CN   AA   RA   JC   SA   SO   HPI   HDI   LLHN
+        """
+        return pd.concat(list(self.iter_common_neighbor_indices()), ignore_index=True)
+
+    def _affected_indices(self, edge_source, edge_target):
+        """
+        the wide table restricted to the pairs whose score can change when the edges (edge_source, edge_target)
+        are added or removed, i.e. every pair with an end in the edges or in their neighbors,
+        both directions of every pair are included
+        """
+        adjacency = self.get_adjacency()
+        nodes, found = self._compact_ids(np.concatenate([edge_source, edge_target]))
+        nodes = np.unique(nodes[found])
+        neighbors = adjacency.indices[expand_ranges(adjacency.indptr[nodes], adjacency.degree[nodes])]
+        sources = np.unique(np.concatenate([nodes, neighbors]))
+
+        source, target, cn, aa, ra = common_neighbor_sums(adjacency.indptr, adjacency.indices, adjacency.degree,
+                                                          sources)
+        # the score of (x, y) for y outside the sources is the score of (y, x)
+        mirror = ~np.isin(target, sources)
+        df_affected = self._common_neighbor_frame(np.concatenate([source, target[mirror]]),
+                                                  np.concatenate([target, source[mirror]]),
+                                                  np.concatenate([cn, cn[mirror]]),
+                                                  np.concatenate([aa, aa[mirror]]),
+                                                  np.concatenate([ra, ra[mirror]]))
+        return df_affected, self.get_adjacency().node_ids[sources]
+
+    def _splice_adjacency(self, edge_source, edge_target, add):
+        """
+        insert or delete both directions of the given edges in the cached CSR arrays,
+        the adjacency is rebuilt instead when a new node appears
+        """
+        adjacency = self.get_adjacency()
+        source, found_source = self._compact_ids(edge_source)
+        target, found_target = self._compact_ids(edge_target)
+        self._sparse_adjacency = None
+        self._cni_weight = None
+        self._minhash_signatures = {}
+        self._bottom_k_sketches = {}
+        # the new arrays live in memory, not in the cache files
+        self.graph_cache_dir = None
+
+        if add and not (found_source.all() and found_target.all()):
+            self._adjacency = None
+            return
+
+        found = found_source & found_target
+        num_nodes = len(adjacency.node_ids)
+        row = np.repeat(np.arange(num_nodes, dtype=np.int64), adjacency.degree)
+        key = row * num_nodes + adjacency.indices
+        change_row = np.concatenate([source[found], target[found]])
+        change_column = np.concatenate([target[found], source[found]])
+        # np.insert keeps the changes that share a position in the given order, so they must be sorted already
+        order = np.lexsort((change_column, change_row))
+        change_row, change_column = change_row[order], change_column[order]
+
+        if add:
+            position = np.searchsorted(key, change_row * num_nodes + change_column)
+            indices = np.insert(adjacency.indices, position, change_column.astype(np.int32))
+            degree = adjacency.degree + np.bincount(change_row, minlength=num_nodes).astype(np.int32)
+        else:
+            keep = ~np.isin(key, change_row * num_nodes + change_column)
+            indices = adjacency.indices[keep]
+            degree = np.bincount(row[keep], minlength=num_nodes).astype(np.int32)
+
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        self._adjacency = Adjacency(adjacency.node_ids, indptr, indices, degree)
+
+    def _edge_list_from_adjacency(self):
+        """
+        an edge list whose adjacency is the cached one, for objects built from a graph cache:
+        every entry with source < target once, and every self-loop once (a self-loop fills two entries)
+        """
+        adjacency = self.get_adjacency()
+        row = np.repeat(np.arange(len(adjacency.node_ids), dtype=np.int64), adjacency.degree)
+        indices = np.asarray(adjacency.indices)
+        loop = np.flatnonzero(row == indices)
+        keep = row < indices
+        keep[loop[::2]] = True
+
+        df_edge_list = pd.DataFrame()
+        df_edge_list['source'] = adjacency.node_ids[row[keep]]
+        df_edge_list['target'] = adjacency.node_ids[indices[keep]]
+        return df_edge_list
+
+    def _update_edges(self, df_edges, add):
+        """
+        the shared part of add_edges and remove_edges
+        """
+        edge_source = df_edges['source'].values
+        edge_target = df_edges['target'].values
+        df_old, old_sources = self._affected_indices(edge_source, edge_target)
+
+        if self.df_edge_list is None:
+            self.df_edge_list = self._edge_list_from_adjacency()
+
+        if add:
+            self.df_edge_list = pd.concat([self.df_edge_list, df_edges[['source', 'target']]], ignore_index=True)
+        else:
+            removed = pd.MultiIndex.from_arrays([np.concatenate([edge_source, edge_target]),
+                                                 np.concatenate([edge_target, edge_source])])
+            edge_pairs = pd.MultiIndex.from_frame(self.df_edge_list[['source', 'target']])
+            self.df_edge_list = self.df_edge_list[~edge_pairs.isin(removed)].reset_index(drop=True)
+        self._splice_adjacency(edge_source, edge_target, add)
+
+        df_new, new_sources = self._affected_indices(edge_source, edge_target)
+        affected = np.union1d(old_sources, new_sources)
+        df_old = df_old[df_old['source'].isin(affected) | df_old['target'].isin(affected)]
+
+        df_delta = pd.merge(df_new, df_old, on=['source', 'target'], how='outer', suffixes=('', '_old'),
+                            indicator=True)
+        df_delta['removed'] = df_delta['_merge'] == 'right_only'
+        changed = df_delta['removed'] | (df_delta['_merge'] == 'left_only')
+        for name in self.common_neighbor_names:
+            df_delta[name] = df_delta[name].fillna(0)
+            changed |= ~np.isclose(df_delta[name].values, df_delta[name + '_old'].fillna(0).values)
+
+        if self.half:
+            changed &= df_delta['source'] < df_delta['target']
+        df_delta = df_delta.loc[changed, ['source', 'target'] + self.common_neighbor_names + ['removed']]
+        df_delta['CN'] = df_delta['CN'].astype(np.int64)
+        return df_delta.sort_values(['source', 'target']).reset_index(drop=True)
+
+    def add_edges(self, df_edges):
+        """
+        add edges to the graph and update the maintained adjacency, only the pairs whose common neighbour
+        family scores can change are recomputed: pairs involving the new edges' ends or their neighbors
+        input: df_edges ----> a dataframe with source and target columns
+
+        return : df_delta, the rows to apply to a stored cal_common_neighbor_indices table (apply_similarity_delta)
+            source     target   CN   AA   RA   JC   SA   SO   HPI   HDI   LLHN   removed
+            removed is True for pairs that no longer have a common neighbour
+        """
+        return self._update_edges(df_edges, add=True)
+
+    def remove_edges(self, df_edges):
+        """
+        remove every occurrence of the given edges, in both directions, see add_edges
+
+        return : df_delta
+            source     target   CN   AA   RA   JC   SA   SO   HPI   HDI   LLHN   removed
+        """
+        return self._update_edges(df_edges, add=False)
+
+    def cal_candidate_similarity(self, node_pairs, batch_size=65536):
+        """
+        compute all the indices for a given set of candidate pairs only,
+        e.g. the test edges and the sampled non-edges of link prediction
+        input: node_pairs ----> a dataframe with source and target columns or an array of shape (n, 2)
+               batch_size ----> number of pairs whose neighbor lists are intersected at once
+
+        return : df_candidate_similarity, one row per candidate pair in the given order
+            source     target   CN   AA   RA   RA_CNI   PA   JC   SA   SO   HPI   HDI   LLHN
+            pairs without common neighbours get 0 for every index except PA,
+            nodes that are not in the graph have degree 0
+        """
+        pair_source, pair_target = self._split_pairs(node_pairs)
+
+        adjacency = self.get_adjacency()
+        source, found_source = self._compact_ids(pair_source)
+        target, found_target = self._compact_ids(pair_target)
+        found = found_source & found_target
+
+        degree_x = self._node_degree(source, found_source)
+        degree_y = self._node_degree(target, found_target)
+
+        cn = np.zeros(len(source), dtype=np.int64)
+        aa = np.zeros(len(source))
+        ra = np.zeros(len(source))
+        cn[found], aa[found], ra[found] = candidate_common_neighbor_sums(
+            adjacency.indptr, adjacency.indices, adjacency.degree, source[found], target[found], batch_size)
+
+        # CNI = sum over x in N(source), y in N(target) of W[x, y], only kept where RA-CNI is defined (CN > 0)
+        cni = np.zeros(len(source))
+        has_common = np.flatnonzero(cn > 0)
+        matrix = self.get_sparse_adjacency()
+        weight = self.get_cni_weight()
+        for start in range(0, len(has_common), batch_size):
+            batch = has_common[start:start + batch_size]
+            reach = matrix[source[batch]].dot(weight)
+            cni[batch] = np.asarray(reach.multiply(matrix[target[batch]]).sum(axis=1)).ravel()
+
+        df_candidate_similarity = pd.DataFrame()
+        df_candidate_similarity['source'] = pair_source
+        df_candidate_similarity['target'] = pair_target
+        df_candidate_similarity['CN'] = self._output_scores(cn)
+        df_candidate_similarity['AA'] = self._output_scores(aa)
+        df_candidate_similarity['RA'] = self._output_scores(ra)
+        df_candidate_similarity['RA_CNI'] = self._output_scores(np.where(cn > 0, ra + cni, 0.0))
+        df_candidate_similarity['PA'] = self._output_scores(degree_x * degree_y)
+        for name in self.degree_normalized_names:
+            df_candidate_similarity[name] = self._output_scores(degree_normalize(name, cn, degree_x, degree_y))
+        return df_candidate_similarity
+
+    def get_minhash_signatures(self, num_hashes=128, seed=0):
+        """
+        the MinHash signatures of the neighbor sets (sketch.minhash_signatures), cached per num_hashes and seed
+        """
+        if (num_hashes, seed) not in self._minhash_signatures:
+            adjacency = self.get_adjacency()
+            with self._stage('minhash_signatures') as stage:
+                self._minhash_signatures[(num_hashes, seed)] = minhash_signatures(
+                    adjacency.indptr, adjacency.indices, adjacency.degree, num_hashes, seed)
+                stage.rows = len(adjacency.node_ids)
+        return self._minhash_signatures[(num_hashes, seed)]
+
+    def cal_minhash_similarity(self, name='JC', num_hashes=128, bands=32, threshold=None, seed=0):
+        """
+        the approximate mode of JC and SO for graphs whose two-hop pairs cannot be enumerated:
+        every node gets a MinHash signature of its neighbor set, banded LSH finds the candidate pairs
+        and the Jaccard index is estimated from the signatures, SO = 2 * JC / (1 + JC)
+        the cost is O(edges * num_hashes) for the signatures plus the candidates, whatever the hub degrees
+        input:
+            name ----> JC or SO
+            num_hashes ----> signature length, more hashes give smaller errors
+            bands ----> number of LSH bands (a divisor of num_hashes), more bands find more low similarity pairs,
+                        pairs above about (1 / bands) ** (bands / num_hashes) are found with high probability
+            threshold ----> drop the pairs estimated below it, only the pairs estimated above 0 are kept when None
+            seed ----> seed of the hash functions
+        the estimates describe neighbor sets, a repeated edge counts once here but twice in cal_JC
+
+        return : df_similarity_list, the same layout as cal_JC (both directions, or source < target in half mode)
+            source     target   similarity
+        """
+        if name not in ('JC', 'SO'):
+            raise ValueError('the MinHash mode supports JC and SO, not %s' % name)
+
+        adjacency = self.get_adjacency()
+        signatures = self.get_minhash_signatures(num_hashes, seed)
+        with self._stage('lsh_candidates') as stage:
+            source, target = lsh_candidate_pairs(signatures, bands, adjacency.degree > 0)
+            stage.rows = len(source)
+        with self._stage('minhash_estimate') as stage:
+            similarity = estimate_jaccard(signatures, source, target)
+            keep = similarity > 0 if threshold is None else similarity >= threshold
+            source, target, similarity = source[keep], target[keep], similarity[keep]
+            if name == 'SO':
+                similarity = 2 * similarity / (1 + similarity)
+            stage.rows = len(source)
+
+        if not self.half:
+            source, target = np.concatenate([source, target]), np.concatenate([target, source])
+            similarity = np.concatenate([similarity, similarity])
+        order = np.lexsort((target, source))
+        return self._similarity_frame(source[order], target[order], similarity[order])
+
+    def get_bottom_k_sketches(self, sketch_size=64, seed=0):
+        """
+        the bottom-k sketches and distinct degrees of the neighbor sets (sketch.bottom_k_sketches),
+        cached per sketch_size and seed
+        """
+        if (sketch_size, seed) not in self._bottom_k_sketches:
+            adjacency = self.get_adjacency()
+            with self._stage('bottom_k_sketches') as stage:
+                self._bottom_k_sketches[(sketch_size, seed)] = bottom_k_sketches(
+                    adjacency.indptr, adjacency.indices, adjacency.degree, sketch_size, seed)
+                stage.rows = len(adjacency.node_ids)
+        return self._bottom_k_sketches[(sketch_size, seed)]
+
+    def _hub_adjacency(self, hub_degree):
+        """
+        the CSR arrays of the adjacency restricted to the neighbors of degree > hub_degree (none when it is None),
+        a row holds at most one entry per hub so intersecting two rows does not depend on the hub degrees
+        """
+        adjacency = self.get_adjacency()
+        num_nodes = len(adjacency.node_ids)
+        row = np.repeat(np.arange(num_nodes, dtype=np.int64), adjacency.degree)
+        hub = np.zeros(len(row), dtype=bool) if hub_degree is None else adjacency.degree[adjacency.indices] > hub_degree
+        degree = np.bincount(row[hub], minlength=num_nodes).astype(np.int32)
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        return indptr, adjacency.indices[hub], degree
+
+    def cal_sketch_similarity(self, name='CN', node_pairs=None, sketch_size=64, exact_degree=None,
+                              hub_degree=1024, seed=0, batch_size=65536):
+        """
+        the approximate mode of CN, JC, SA, SO, HPI, HDI and LLHN for graphs with hubs: the common neighbour count
+        of a pair is intersected exactly when both degrees are <= exact_degree, otherwise it is estimated from
+        bottom-k sketches of the neighbor sets (sketch.estimate_common_neighbors) in O(sketch_size) per pair,
+        the other indices are derived from it with the exact degrees
+        input:
+            name ----> CN, JC, SA, SO, HPI, HDI or LLHN
+            node_pairs ----> score these pairs (a dataframe with source and target columns or an array of shape
+                             (n, 2)), when None the pairs sharing a common neighbour of degree <= hub_degree are
+                             listed and scored, a pair whose common neighbours are all hubs is then not listed
+            sketch_size ----> k of the bottom-k sketches
+            exact_degree ----> largest degree of an exactly intersected pair, sketch_size when None
+            hub_degree ----> common neighbours above this degree are not enumerated when node_pairs is None,
+                             the listed pairs still count them through the estimate, None lists every pair
+            seed ----> seed of the sketch hash function
+        the estimates count distinct neighbors, a repeated edge counts once in an estimated pair
+
+        return : df_similarity_list
+            source     target   similarity
+            the listed pairs in both directions (source < target in half mode) sorted by source and target,
+            or node_pairs in the given order, 0 for nodes that are not in the graph
+        """
+        if name not in self.common_neighbor_names or name in ('AA', 'RA'):
+            raise ValueError('the sketch mode supports CN, JC, SA, SO, HPI, HDI and LLHN, not %s' % name)
+        exact_degree = sketch_size if exact_degree is None else exact_degree
+
+        adjacency = self.get_adjacency()
+        degree = adjacency.degree.astype(np.int64)
+        if node_pairs is None:
+            # block by block like _iter_blocks, the light paths of a block of sources fit the memory budget
+            source_list, target_list, light_count_list = [], [], []
+            for sources in self._source_blocks():
+                with self._stage('light_common_neighbor') as stage:
+                    source, target, light_count = light_common_neighbor_counts(
+                        adjacency.indptr, adjacency.indices, adjacency.degree, hub_degree, sources, self.half)
+                    stage.rows = len(source)
+                source_list.append(source)
+                target_list.append(target)
+                light_count_list.append(light_count)
+            source = np.concatenate(source_list)
+            target = np.concatenate(target_list)
+            light_count = np.concatenate(light_count_list)
+            found = np.ones(len(source), dtype=bool)
+        else:
+            pair_source, pair_target = self._split_pairs(node_pairs)
+            source, found_source = self._compact_ids(pair_source)
+            target, found_target = self._compact_ids(pair_target)
+            found = found_source & found_target
+            light_count = np.zeros(len(source), dtype=np.int64)
+
+        common_neighbor = np.zeros(len(source))
+        exact = found & (np.maximum(degree[source], degree[target]) <= exact_degree)
+        with self._stage('exact_intersection') as stage:
+            if node_pairs is None:
+                # the light common neighbours are counted already, only the hubs are left to intersect
+                indptr, indices, hub_neighbor_degree = self._hub_adjacency(hub_degree)
+            else:
+                indptr, indices, hub_neighbor_degree = adjacency.indptr, adjacency.indices, adjacency.degree
+            common_neighbor[exact] = light_count[exact] + candidate_common_neighbor_sums(
+                indptr, indices, hub_neighbor_degree, source[exact], target[exact], batch_size)[0]
+            stage.rows = int(exact.sum())
+
+        estimated = found & ~exact
+        with self._stage('sketch_estimate') as stage:
+            sketches, distinct = self.get_bottom_k_sketches(sketch_size, seed)
+            common_neighbor[estimated] = estimate_common_neighbors(sketches, distinct, source[estimated],
+                                                                   target[estimated], batch_size)
+            # the common neighbours below hub_degree were counted exactly, a lower bound of the estimate
+            common_neighbor[estimated] = np.maximum(common_neighbor[estimated], light_count[estimated])
+            stage.rows = int(estimated.sum())
+
+        similarity = common_neighbor
+        if name != 'CN':
+            similarity = degree_normalize(name, common_neighbor, np.where(found, degree[source], 0),
+                                          np.where(found, degree[target], 0))
+
+        if node_pairs is not None:
+            df_similarity_list = pd.DataFrame()
+            df_similarity_list['source'] = pair_source
+            df_similarity_list['target'] = pair_target
+            df_similarity_list['similarity'] = self._output_scores(similarity)
+            return df_similarity_list
+        return self._similarity_frame(source, target, similarity)
 
     def cal_CN(self):
         """
@@ -46,23 +1798,21 @@ class LocalMethods(object):
 
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
+        if self._is_blocked():
+            return self._blocked_similarity('CN')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('CN')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor = self._get_common_neighbor()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
 
         df_common_neighbor_count.rename(columns={'target': 'similarity'}, inplace=True)
         df_common_neighbor_count.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
+        df_common_neighbor_count['similarity'] = self._output_scores(df_common_neighbor_count['similarity'].values)
         return df_common_neighbor_count
 
     def cal_AA(self):
@@ -77,30 +1827,19 @@ class LocalMethods(object):
 
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
+        if self._is_blocked():
+            return self._blocked_similarity('AA')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('AA')
 
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'count'}, inplace=True)
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
-
-        df_common_neighbor = pd.merge(df_common_neighbor, df_neighbor_count, left_on=['target'], right_on=['source'],
-                                      how='left').dropna()
-
-        df_common_neighbor = df_common_neighbor[['source_x', 'source_y', 'count']]
-        df_common_neighbor['count'] = df_common_neighbor['count'].map(lambda x: 1.0 / math.log(x))
+        df_common_neighbor = self._merge_middle_degree(self._get_common_neighbor())
+        df_common_neighbor['count'] = self._output_scores(1.0 / np.log(df_common_neighbor['count'].values))
 
-        df_AA_list = df_common_neighbor.groupby(['source_x', 'source_y']).sum()
-        df_AA_list = df_AA_list.reset_index()
+        df_AA_list = self._group_pairs(df_common_neighbor, 'count', 'sum')
 
         df_AA_list.rename(columns={'count': 'similarity', 'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_AA_list
@@ -116,162 +1855,128 @@ class LocalMethods(object):
              ....
 
          """
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
 
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('RA')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('RA')
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
-
-        df_common_neighbor = pd.merge(df_common_neighbor, df_neighbor_count, left_on=['target'], right_on=['source'],
-                                      how='left').dropna()
-
-        df_common_neighbor = df_common_neighbor[['source_x', 'source_y', 'count']]
-        df_common_neighbor['count'] = df_common_neighbor['count'].map(lambda x: 1.0 / x)
+        df_common_neighbor = self._merge_middle_degree(self._get_common_neighbor())
+        df_common_neighbor['count'] = self._output_scores(1.0 / df_common_neighbor['count'].values)
 
-        df_RA_list = df_common_neighbor.groupby(['source_x', 'source_y']).sum()
-        df_RA_list = df_RA_list.reset_index()
+        df_RA_list = self._group_pairs(df_common_neighbor, 'count', 'sum')
 
         df_RA_list.rename(columns={'source_x': 'source', 'source_y': 'target', 'count': 'similarity'}, inplace=True)
         print(df_RA_list.head(10))
         return df_RA_list
 
-    def cal_RA_CNI(self):
+    def cal_RA_CNI(self, k=None, block_size=None):
         """
         this method implemented for resource allocation index
         input: self.edge_list ---->    the edge list of a graph
+               k ----> keep only the top-k targets of every source, applied block by block
+               block_size ----> number of source nodes computed at once, sized by memory_budget when None
 
-        return : df_RA_CNI_list ----> the RA_CNI list
+        RA-CNI(x, y) = RA(x, y) + CNI(x, y) for every pair with at least one common neighbour, where
+        CNI = A * W * A and W is the edge weighted matrix W[u, v] = A[u, v] * |1 / k_u - 1 / k_v| (get_cni_weight),
+        computed block by block of source rows (see _source_blocks), in a process pool when n_jobs != 1
+
+        return : df_RA_CNI_list ----> the RA_CNI list, sorted by source and then target,
+                 or by source and then descending similarity in the top-k mode
             source     target   similarity
             1          2        18
             ....
 
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'count'}, inplace=True)
-
-        df_neighbor_count['count'] = df_neighbor_count['count'].map(lambda x: 1.0 / x)
-
-        # 对pair的source求邻居结点数
-        df_node_pair_gamma = pd.merge(df_all_nodes_pair, df_neighbor_count, on=['source'], how='left')
-        # 对pair的target求邻居结点数
-        df_node_pair_gamma = pd.merge(df_node_pair_gamma, df_neighbor_count, left_on=['target'], right_on=['source'],
-                                      how='left').dropna()
+        source_list, target_list, similarity_list = [], [], []
+        for source, target, similarity in self._iter_walk_blocks('RA_CNI', k, block_size):
+            source_list.append(source)
+            target_list.append(target)
+            similarity_list.append(similarity)
 
-        df_node_pair_gamma['count'] = None
-        df_node_pair_gamma['count'] = df_node_pair_gamma['count_x'] - df_node_pair_gamma['count_y']
-
-        df_node_pair_gamma = df_node_pair_gamma[['source_x', 'source_y', 'count']]
-        df_node_pair_gamma['count'] = df_node_pair_gamma['count'].map(lambda x: abs(x))
+        return self._similarity_frame(np.concatenate(source_list), np.concatenate(target_list),
+                                      np.concatenate(similarity_list))
 
+    def cal_PA(self, node_pairs=None):
         """
-        get RA
+        this method is implemented for preferential attachment index, PA(x, y) = k_x * k_y
+        input: self.df_edge_list
+               node_pairs ----> score these pairs (a dataframe with source and target columns or an array of shape
+                                (n, 2)) instead of the existing edges, any pair of nodes is allowed
+        output: df_PA_list
+            the existing edges in both directions (source <= target in half mode) sorted by source and target,
+            or node_pairs in the given order
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
-
-        df_common_neighbor = pd.merge(df_common_neighbor, df_neighbor_count, left_on=['target'], right_on=['source'],
-                                      how='left')
-        df_common_neighbor = df_common_neighbor[['source_x', 'source_y', 'count']]
-
-        df_RA_list = df_common_neighbor.groupby(['source_x', 'source_y']).sum()
-        df_RA_list = df_RA_list.reset_index()
+        adjacency = self.get_adjacency()
+
+        if node_pairs is None:
+            # the CSR rows are sorted, the distinct (source, target) keys are the distinct edges
+            num_nodes = len(adjacency.node_ids)
+            row = np.repeat(np.arange(num_nodes, dtype=np.int64), adjacency.degree)
+            key = np.unique(row * num_nodes + adjacency.indices)
+            source, target = key // num_nodes, key % num_nodes
+            if self.half:
+                source, target = source[source <= target], target[source <= target]
+            degree = adjacency.degree.astype(np.int64)
+            return self._similarity_frame(source, target, degree[source] * degree[target])
+
+        pair_source, pair_target = self._split_pairs(node_pairs)
+        source, found_source = self._compact_ids(pair_source)
+        target, found_target = self._compact_ids(pair_target)
+
+        df_PA_list = pd.DataFrame()
+        df_PA_list['source'] = pair_source
+        df_PA_list['target'] = pair_target
+        df_PA_list['similarity'] = self._output_scores(self._node_degree(source, found_source) *
+                                                       self._node_degree(target, found_target))
+        return df_PA_list
 
-        df_RA_list.rename(columns={'count': 'similarity'}, inplace=True)
-        """
-        get CNI
+    def _top_k_PA(self, k):
         """
+        top-k of PA without enumerating pairs, the best partners of every node are the highest degree nodes that
+        are not the node itself nor one of its neighbors, so they are read from one degree sorted order of the nodes
 
+        return : source, target, similarity ----> compact node IDs sorted by source and then descending similarity
         """
-        get common neighbors
-        """
-        df_exist_RA_node_pair = df_RA_list[['source_x', 'source_y']]
-
-        df_RA_with_neighbor = pd.merge(df_exist_RA_node_pair, df_all_nodes_pair, left_on='source_x', right_on='source',
-                                       how='left').dropna()
-        df_RA_with_neighbor = df_RA_with_neighbor[['source_x', 'source_y', 'target']]
-        df_RA_with_neighbor.rename(
-            columns={'source_x': 'source_x1', 'source_y': 'source_y1', 'target': 'source_x1_nei'}, inplace=True)
-        df_RA_with_neighbor = pd.merge(df_RA_with_neighbor, df_all_nodes_pair, left_on='source_y1', right_on='source',
-                                       how='left').dropna()
-        df_RA_with_neighbor = df_RA_with_neighbor[['source_x1', 'source_y1', 'source_x1_nei', 'target']]
-        df_RA_with_neighbor.rename(columns={'target': 'source_y1_nei'}, inplace=True)
-        df_RA_with_neighbor_with_CNI = pd.merge(df_RA_with_neighbor, df_node_pair_gamma,
-                                                left_on=['source_x1_nei', 'source_y1_nei'],
-                                                right_on=['source_x', 'source_y'], how='left').dropna()
-
-        df_RA_with_neighbor_with_CNI = df_RA_with_neighbor_with_CNI[['source_x1', 'source_y1', 'count']]
-
-        df_RA_CNI = df_RA_with_neighbor_with_CNI.groupby(['source_x1', 'source_y1']).sum()
-        df_RA_CNI = df_RA_CNI.reset_index()
-
-        df_RA_CNI_list = pd.merge(df_RA_list, df_RA_CNI, left_on=['source_x', 'source_y'],
-                                  right_on=['source_x1', 'source_y1'], how='left').fillna(0)
-
-        df_RA_CNI_list['RACNI'] = df_RA_CNI_list['similarity'] + df_RA_CNI_list['count']
-        df_RA_CNI_list = df_RA_CNI_list[['source_x', 'source_y', 'RACNI']]
-
-        df_RA_CNI_list.rename(columns={'RACNI': 'similarity', 'source_x': 'source', 'source_y': 'target'}, inplace=True)
-        return df_RA_CNI_list
-
-    # not read 
-    def cal_PA(self):
-        """
-        this method is implemented for preferential attachment index
-        input: self.df_edge_list
-        output: df_PA_list
-        """
-
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        all_nodes = self.df_edge_list['source'].tolist()
-        ttt = self.df_edge_list['target'].tolist()
-        all_nodes.extend(ttt)
-        print
-        'all nodes number is ', len(set(all_nodes))
-
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        # print df_neighbor_count.head()
-        df_neighbor_count.rename(columns={'target': 'count1'}, inplace=True)
-
-        df_PA_list = pd.merge(df_all_nodes_pair, df_neighbor_count, left_on=['source'], right_on=['source'],
-                              how='left').fillna(0)
-        # print df_PA_list.head()
-        # print 'gg PA',df_PA_list.shape
-        df_PA_list = pd.merge(df_PA_list, df_neighbor_count, left_on=['target'], right_on=['source'],
-                              how='left').fillna(0)
-        # print 'gg PA',df_PA_list.shape
-        df_PA_list['similarity'] = df_PA_list['count1_x'] * df_PA_list['count1_y']
-        df_PA_list = df_PA_list[['source_x', 'source_y', 'similarity']]
-
-        # print 'gg PA',df_PA_list.shape
-        df_PA_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
-        # print 'gg PA',df_PA_list.head()
-        df_PA_list = df_PA_list.drop_duplicates()
-        return df_PA_list
+        adjacency = self.get_adjacency()
+        num_nodes = len(adjacency.node_ids)
+        degree = adjacency.degree.astype(np.int64)
+        by_degree = np.argsort(-degree, kind='stable')
+
+        row = np.repeat(np.arange(num_nodes, dtype=np.int64), adjacency.degree)
+        neighbor_key = row * num_nodes + adjacency.indices
+
+        # nodes of similar degree share a block so the candidate prefix stays short
+        source_list, target_list, similarity_list = [], [], []
+        start = 0
+        while start < num_nodes:
+            prefix = min(num_nodes, k + 1 + int(degree[by_degree[start]]))
+            end = min(num_nodes, start + max(1, (1 << 20) // prefix))
+            sources = np.sort(by_degree[start:end])
+            start = end
+
+            candidate = np.broadcast_to(by_degree[:prefix], (len(sources), prefix))
+            key = sources[:, None] * num_nodes + candidate
+            position = np.minimum(np.searchsorted(neighbor_key, key), max(len(neighbor_key) - 1, 0))
+            is_neighbor = neighbor_key[position] == key if len(neighbor_key) else np.zeros(key.shape, dtype=bool)
+            valid = ~is_neighbor & (candidate != sources[:, None]) & (degree[candidate] > 0)
+            # nodes without edges, left by remove_edges or stored in a graph cache, are not in the graph
+            valid &= degree[sources][:, None] > 0
+            valid &= np.cumsum(valid, axis=1) <= k
+
+            block_row, block_column = np.nonzero(valid)
+            source_list.append(sources[block_row])
+            target_list.append(candidate[block_row, block_column])
+            similarity_list.append(degree[sources[block_row]] * degree[candidate[block_row, block_column]])
+
+        source = np.concatenate(source_list)
+        order = np.argsort(source, kind='stable')
+        return source[order], np.concatenate(target_list)[order], np.concatenate(similarity_list)[order]
 
     def cal_JC(self):
 
@@ -281,36 +1986,23 @@ class LocalMethods(object):
         output: df_JC_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('JC')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('JC')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['total_neighbor'] = df_common_neighbor_with_total_neighbor[
                                                                        'nei_count_x'] + \
@@ -322,6 +2014,7 @@ class LocalMethods(object):
                                                                df_common_neighbor_with_total_neighbor['total_neighbor']
 
         df_JC_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_JC_list['similarity'] = self._output_scores(df_JC_list['similarity'].values)
 
         df_JC_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_JC_list
@@ -334,47 +2027,33 @@ class LocalMethods(object):
         output: df_SA_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('SA')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('SA')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['nei_mul_nei'] = df_common_neighbor_with_total_neighbor['nei_count_x'] * \
                                                                 df_common_neighbor_with_total_neighbor['nei_count_y']
 
-        df_common_neighbor_with_total_neighbor['nei_mul_nei'] = map(lambda x: pow(x, 0.5),
-                                                                    df_common_neighbor_with_total_neighbor[
-                                                                        'nei_mul_nei'])
+        df_common_neighbor_with_total_neighbor['nei_mul_nei'] = df_common_neighbor_with_total_neighbor['nei_mul_nei'] ** 0.5
         df_common_neighbor_with_total_neighbor['similarity'] = df_common_neighbor_with_total_neighbor['CN'] / \
                                                                df_common_neighbor_with_total_neighbor['nei_mul_nei']
 
         df_SA_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_SA_list['similarity'] = self._output_scores(df_SA_list['similarity'].values)
 
         df_SA_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_SA_list
@@ -387,36 +2066,23 @@ class LocalMethods(object):
         output: df_SO_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('SO')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('SO')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['nei_add_nei'] = df_common_neighbor_with_total_neighbor['nei_count_x'] + \
                                                                 df_common_neighbor_with_total_neighbor['nei_count_y']
@@ -425,6 +2091,7 @@ class LocalMethods(object):
                                                                df_common_neighbor_with_total_neighbor['nei_add_nei']
 
         df_SO_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_SO_list['similarity'] = self._output_scores(df_SO_list['similarity'].values)
 
         df_SO_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_SO_list
@@ -437,36 +2104,23 @@ class LocalMethods(object):
         output: df_HPI_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('HPI')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('HPI')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['nei_min'] = df_common_neighbor_with_total_neighbor[
             ['nei_count_x', 'nei_count_y']].min(axis=1)
@@ -476,6 +2130,7 @@ class LocalMethods(object):
                                                                df_common_neighbor_with_total_neighbor['nei_min']
 
         df_HPI_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_HPI_list['similarity'] = self._output_scores(df_HPI_list['similarity'].values)
 
         df_HPI_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_HPI_list
@@ -488,36 +2143,23 @@ class LocalMethods(object):
         output: df_HDI_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('HDI')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('HDI')
 
         """
         get common neighbours
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['nei_min'] = df_common_neighbor_with_total_neighbor[
             ['nei_count_x', 'nei_count_y']].max(axis=1)
@@ -527,6 +2169,7 @@ class LocalMethods(object):
                                                                df_common_neighbor_with_total_neighbor['nei_min']
 
         df_HDI_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_HDI_list['similarity'] = self._output_scores(df_HDI_list['similarity'].values)
 
         df_HDI_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
 
@@ -541,37 +2184,24 @@ class LocalMethods(object):
         output: df_LLHN_list
         """
 
-        df_edge_list_reverse = pd.DataFrame()
-        df_edge_list_reverse['source'] = self.df_edge_list['target']
-        df_edge_list_reverse['target'] = self.df_edge_list['source']
-        # print df_edge_list_reverse
-
-        df_all_nodes_pair = pd.concat([df_edge_list_reverse, self.df_edge_list])
-        df_neighbor_count = df_all_nodes_pair.groupby(['source']).count()
-        df_neighbor_count = df_neighbor_count.reset_index()
-        df_neighbor_count.rename(columns={'target': 'nei_count'}, inplace=True)
+        if self._is_blocked():
+            return self._blocked_similarity('LLHN')
+        if self.engine == 'sparse':
+            return self._sparse_similarity('LLHN')
 
         """
         get common neighbours
         drwxr-xr-x 3
         """
 
-        df_common_neighbor = pd.merge(df_all_nodes_pair, df_all_nodes_pair, on=['target'], how='left').dropna()
-        df_common_neighbor = df_common_neighbor[df_common_neighbor['source_x'] != df_common_neighbor['source_y']]
+        df_common_neighbor = self._get_common_neighbor()
 
-        df_common_neighbor_count = df_common_neighbor.groupby(['source_x', 'source_y']).count()
-        df_common_neighbor_count = df_common_neighbor_count.reset_index()
+        df_common_neighbor_count = self._group_pairs(df_common_neighbor, 'target', 'count')
         # print df_common_neighbor_count
 
         df_common_neighbor_count.rename(columns={'target': 'CN'}, inplace=True)
 
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_count, df_neighbor_count,
-                                                          left_on=['source_x'], right_on=['source'], how='left')
-
-        df_common_neighbor_with_total_neighbor = df_common_neighbor_with_total_neighbor[
-            ['source_x', 'source_y', 'CN', 'nei_count']]
-        df_common_neighbor_with_total_neighbor = pd.merge(df_common_neighbor_with_total_neighbor, df_neighbor_count,
-                                                          left_on=['source_y'], right_on=['source'], how='left')
+        df_common_neighbor_with_total_neighbor = self._merge_pair_degree(df_common_neighbor_count)
 
         df_common_neighbor_with_total_neighbor['nei_mul_nei'] = df_common_neighbor_with_total_neighbor['nei_count_x'] * \
                                                                 df_common_neighbor_with_total_neighbor['nei_count_y']
@@ -581,10 +2211,131 @@ class LocalMethods(object):
                                                                df_common_neighbor_with_total_neighbor['nei_mul_nei']
 
         df_LLHN_list = df_common_neighbor_with_total_neighbor[['source_x', 'source_y', 'similarity']].copy()
+        df_LLHN_list['similarity'] = self._output_scores(df_LLHN_list['similarity'].values)
         df_LLHN_list.rename(columns={'source_x': 'source', 'source_y': 'target'}, inplace=True)
         return df_LLHN_list
 
-    def cal_save_all_similarity(self, data_name):
+    def iter_quasi_local_blocks(self, name, k=None, block_size=None, epsilon=0.01, beta=0.01, max_length=3):
+        """
+        stream a quasi-local index block by block of source rows,
+        the walk products A[rows] * A * ... * A only ever hold the rows of one block, the blocks are sized so
+        their estimated walks of length 1 ... max_length fit memory_budget (see _source_blocks),
+        and computed in a process pool when n_jobs != 1
+        input: name ----> LP, S = A^2 + epsilon * A^3, or Katz, S = sum over l = 1 ... max_length of beta^l * A^l
+               k ----> keep only the top-k targets of every source when given
+               block_size ----> number of source nodes computed at once, sized by memory_budget when None
+
+        return : generator of df_similarity_list blocks, sorted by source and then target,
+                 or by source and then descending similarity in the top-k mode
+            source     target   similarity
+        """
+        if name == 'LP':
+            max_length = 3
+            weights = {2: 1.0, 3: epsilon}
+        elif name == 'Katz':
+            weights = dict((length, beta ** length) for length in range(1, max_length + 1))
+        else:
+            raise ValueError('unknown quasi-local index: %s' % name)
+
+        for block in self._iter_walk_blocks(name, k, block_size, max_length, weights):
+            yield self._similarity_frame(*block)
+
+    def cal_LP(self, epsilon=0.01, k=None, block_size=None):
+        """
+        this method is implemented for the Local Path index, LP = A^2 + epsilon * A^3,
+        the number of two-hop paths plus the three-hop walks weighted by epsilon (a walk may revisit x or y)
+        input: epsilon ----> the weight of the three-hop walks
+               k ----> keep only the top-k targets of every source, A^3 is then never kept beyond one block
+               block_size ----> see iter_quasi_local_blocks
+
+        return : df_LP_list ----> the LP list
+            source     target   similarity
+        """
+        return pd.concat(list(self.iter_quasi_local_blocks('LP', k, block_size, epsilon=epsilon)), ignore_index=True)
+
+    def cal_Katz(self, beta=0.01, max_length=3, k=None, block_size=None):
+        """
+        this method is implemented for the Katz index truncated at max_length,
+        Katz = beta * A + beta^2 * A^2 + ... + beta^max_length * A^max_length
+        input: beta ----> the damping of a walk per step, below 1 / (the largest eigenvalue of A) for the full sum
+               max_length ----> the longest walk counted
+               k ----> keep only the top-k targets of every source
+               block_size ----> see iter_quasi_local_blocks
+
+        return : df_Katz_list ----> the Katz list
+            source     target   similarity
+        """
+        return pd.concat(list(self.iter_quasi_local_blocks('Katz', k, block_size, beta=beta, max_length=max_length)),
+                         ignore_index=True)
+
+    def cal_save_all_similarity(self, data_name, fused=False, output_format='csv', half=True, quasi_local=False,
+                                quasi_local_params=None, cache=None, store=False):
+        """
+        compute all the indices and save them to ../temp/similarity_directory/data_name
+        input: fused ----> compute the common neighbour family with one pass of cal_common_neighbor_indices
+               output_format ----> 'csv' or 'npy', see SimilarityWriter, read the files back with load_similarity
+               half ----> store only the pairs with source < target, recorded in the .meta.json of every file
+               quasi_local ----> also save LP and Katz, written block by block (iter_quasi_local_blocks)
+               quasi_local_params ----> the keyword arguments of iter_quasi_local_blocks, e.g. {'k': 50, 'beta': 0.01}
+               cache ----> a cache.ResultCache, the files of every index are copied from it when the same graph
+                           (by the contents of its adjacency) was saved with the same parameters before
+               store ----> also index every saved file for point and per-node queries (build_similarity_store),
+                           open them with SimilarityStore.open(data_name, name)
+        """
+        saved_half = self.half
+        self.half = half
+        try:
+            self._save_all_similarity(data_name, fused, output_format, quasi_local, quasi_local_params or {}, cache)
+        finally:
+            self.half = saved_half
+
+        if store:
+            names = self.similarity_names + (self.quasi_local_names if quasi_local else [])
+            for name in names:
+                with self._stage('build_store'):
+                    build_similarity_store('../temp/similarity_directory/%s/%s_%s' % (data_name, data_name, name))
+
+    @contextmanager
+    def _cached_similarity(self, cache, save_files, params):
+        """
+        with self._cached_similarity(cache, save_files, params) as missing:
+            compute and write the indices in missing
+        save_files maps the index names to their save file names, params holds the digest of the graph and the
+        parameters of the files, the indices found in the cache are restored before the block and the missing ones
+        are stored after it, nothing is cached when cache is None
+        """
+        if cache is None:
+            yield list(save_files)
+            return
+
+        keys = dict((name, cache.key('similarity', dict(params, index=name, version=self.cache_version)))
+                    for name in save_files)
+        with ExitStack() as stack:
+            # lock in key order so two jobs never wait on each other
+            entries = {}
+            for name in sorted(save_files, key=keys.get):
+                entries[name] = stack.enter_context(cache.open_entry(keys[name], 'similarity'))
+
+            missing = [name for name in save_files if not entries[name][1]]
+            with self._stage('restore_cache'):
+                for name in save_files:
+                    entry_dir, hit = entries[name]
+                    if hit:
+                        restore_files(entry_dir, self._entry_files(save_files[name], params['format']))
+            yield missing
+            with self._stage('store_cache'):
+                for name in missing:
+                    store_files(entries[name][0], self._entry_files(save_files[name], params['format']))
+
+    @staticmethod
+    def _entry_files(save_file_name, output_format):
+        """
+        the files of one saved index by their names in a cache entry, which do not depend on data_name
+        """
+        return dict(('similarity' + suffix, file_name)
+                    for suffix, file_name in SimilarityWriter.file_names(save_file_name, output_format).items())
+
+    def _save_all_similarity(self, data_name, fused, output_format, quasi_local, quasi_local_params, cache):
         similarity_dir = '../temp/similarity_directory'
 
         if os.path.exists(similarity_dir):
@@ -611,25 +2362,352 @@ class LocalMethods(object):
         11) Local Leicht-Holme-Newman Index (LLHN)
         """
 
-        similarity_name_list = ['CN', 'AA', 'RA', 'RA_CNI', 'PA', 'JC', 'SA', 'SO', 'HPI', 'HDI', 'LLHN']
+        similarity_name_list = self.similarity_names
         similarity_function_list = [self.cal_CN, self.cal_AA, self.cal_RA, self.cal_RA_CNI, self.cal_PA, self.cal_JC,
                                     self.cal_SA, self.cal_SO, self.cal_HPI, self.cal_HDI, self.cal_LLHN]
 
+        def save_file_name(name):
+            return save_dir + '/' + data_name + '_' + name
+
+        def open_writer(name):
+            return SimilarityWriter(save_file_name(name), output_format, self._id_dtype(), self.half)
+
+        def write(writer, df_similarity_list):
+            with self._stage('write') as stage:
+                writer.write(df_similarity_list)
+                stage.rows = len(df_similarity_list)
+
+        params = {'format': output_format, 'half': self.half, 'compact': self.compact, 'engine': self.engine}
+        if cache is not None:
+            # the adjacency addresses the graph, whether it came from an edge list or a graph cache
+            with self._stage('graph_digest'):
+                params['graph'] = array_digest(self.get_adjacency()[:3])
+
+        streamed_names = []
+        if fused:
+            # the common neighbour family is written block by block from one enumeration
+            streamed_names = self.common_neighbor_names
+            save_files = dict((name, save_file_name(name)) for name in streamed_names)
+            with self._cached_similarity(cache, save_files, params) as missing:
+                if missing:
+                    print('similarity calculation', self.cal_common_neighbor_indices.__name__)
+                    with ExitStack() as writer_stack:
+                        writers = dict((name, writer_stack.enter_context(open_writer(name))) for name in missing)
+                        with self._stage(self.cal_common_neighbor_indices.__name__):
+                            for df_common_neighbor_indices in self.iter_common_neighbor_indices():
+                                for name in missing:
+                                    write(writers[name], df_common_neighbor_indices[['source', 'target', name]]
+                                          .rename(columns={name: 'similarity'}))
+
         for i, sim_func in enumerate(similarity_function_list):
-            print('similarity calculation', sim_func.__name__)
-            df_similarity_list = sim_func()
-            save_file_name = save_dir + '/' + data_name + '_' + similarity_name_list[i]
-            df_similarity_list.to_csv(save_file_name, index=False, sep=' ')
+            if similarity_name_list[i] in streamed_names:
+                continue
+            save_files = {similarity_name_list[i]: save_file_name(similarity_name_list[i])}
+            with self._cached_similarity(cache, save_files, params) as missing:
+                if not missing:
+                    continue
+                print('similarity calculation', sim_func.__name__)
+
+                with open_writer(similarity_name_list[i]) as writer:
+                    if self._is_blocked() and similarity_name_list[i] in self.common_neighbor_names:
+                        with self._stage(sim_func.__name__):
+                            for df_similarity_list in self.iter_similarity_blocks(similarity_name_list[i]):
+                                write(writer, df_similarity_list)
+                    else:
+                        with self._stage(sim_func.__name__) as stage:
+                            df_similarity_list = sim_func()
+                            stage.rows = len(df_similarity_list)
+                        write(writer, df_similarity_list)
+
+        if not quasi_local:
+            return
+        # the top-k lists keep both directions of every pair
+        quasi_local_half = self.half and quasi_local_params.get('k') is None
+        for name in self.quasi_local_names:
+            save_files = {name: save_file_name(name)}
+            with self._cached_similarity(cache, save_files, dict(params, quasi_local=quasi_local_params)) as missing:
+                if not missing:
+                    continue
+                print('similarity calculation', 'cal_' + name)
+                writer = SimilarityWriter(save_files[name], output_format, self._id_dtype(), quasi_local_half)
+                with writer, self._stage('cal_' + name):
+                    for df_similarity_list in self.iter_quasi_local_blocks(name, **quasi_local_params):
+                        write(writer, df_similarity_list)
 
 
 def test_similarity():
     edge_file_name = 'transformed_dataset/citeseer/citeseer.edges'
-    df_edge_list = pd.read_csv(edge_file_name, delim_whitespace=True, low_memory=False)
+    if not os.path.exists(edge_file_name):
+        # written by python preprocessing.py from dataset/citeseer
+        print('skip test_similarity, %s is missing' % edge_file_name)
+        return
+    df_edge_list = pd.read_csv(edge_file_name, sep=r'\s+', low_memory=False)
     # df_edge_list = pd.DataFrame({'source': [1, 1, 2], 'target': [2, 3, 3]})
 
     test_local = LocalMethods(df_edge_list)
     test_local.cal_RA_CNI()
 
 
+def _random_edge_list(num_nodes=60, num_edges=240, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'source': rng.integers(0, num_nodes, num_edges),
+                         'target': rng.integers(0, num_nodes, num_edges)})
+
+
+def _assert_frame_close(df_result, df_expected):
+    assert list(df_result.columns) == list(df_expected.columns)
+    assert len(df_result) == len(df_expected)
+    for column in df_result.columns:
+        assert np.allclose(df_result[column].values.astype(np.float64),
+                           df_expected[column].values.astype(np.float64), equal_nan=True), column
+
+
+def test_similarity_writer():
+    save_file_name = os.path.join(tempfile.mkdtemp(), 'CN')
+    df_similarity_list = LocalMethods(_random_edge_list(), half=True).cal_CN()
+    # every format round trips, and a save in the other format replaces the earlier one
+    for output_format, rows in (('npy', 3), ('csv', 5), ('npy', 7), ('csv', len(df_similarity_list))):
+        with SimilarityWriter(save_file_name, output_format, half=True) as writer:
+            for start in range(0, rows, 2):
+                writer.write(df_similarity_list.iloc[start:min(start + 2, rows)])
+        df_loaded = load_similarity(save_file_name)
+        _assert_frame_close(df_loaded, df_similarity_list.iloc[:rows].reset_index(drop=True))
+        assert read_similarity_meta(save_file_name) == {'format': output_format, 'rows': rows, 'half': True}
+    _assert_frame_close(load_similarity(save_file_name, expand=True), LocalMethods(_random_edge_list()).cal_CN())
+
+    # an interrupted save leaves no file behind that looks complete
+    for output_format in SimilarityWriter.output_formats:
+        try:
+            with SimilarityWriter(save_file_name, output_format, half=True) as writer:
+                writer.write(df_similarity_list.iloc[:2])
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        assert os.listdir(os.path.dirname(save_file_name)) == []
+    shutil.rmtree(os.path.dirname(save_file_name))
+
+
+def test_half_storage():
+    df_edge_list = _random_edge_list()
+    whole = LocalMethods(df_edge_list)
+    # both engines, the blocked and the pooled mode keep source < target only, expanding restores the whole list
+    for kwargs in ({}, {'engine': 'sparse'}, {'memory_budget': 4096}, {'n_jobs': 2}):
+        half = LocalMethods(df_edge_list, half=True, **kwargs)
+        for name in LocalMethods.similarity_names + LocalMethods.quasi_local_names:
+            if name == 'PA':
+                continue
+            df_whole = getattr(whole, 'cal_' + name)()
+            df_half = getattr(half, 'cal_' + name)()
+            assert (df_half['source'] < df_half['target']).all()
+            _assert_frame_close(expand_half_similarity(df_half), df_whole)
+    # PA scores the edges, a self loop is its own mirror
+    df_half = LocalMethods(df_edge_list, half=True).cal_PA()
+    assert (df_half['source'] <= df_half['target']).all()
+    _assert_frame_close(expand_half_similarity(df_half), whole.cal_PA())
+
+
+def test_graph_cache():
+    df_edge_list = _random_edge_list()
+    # the cache holds every node of the renumbering, a node without edges scores nothing
+    num_nodes = 70
+    source = df_edge_list['source'].values
+    target = df_edge_list['target'].values
+    indptr, indices, degree = build_csr(np.concatenate([target, source]), np.concatenate([source, target]), num_nodes)
+    cache_dir = os.path.join(tempfile.mkdtemp(), 'graph')
+    save_graph_cache(cache_dir, indptr, indices, degree, np.arange(num_nodes) % 3)
+
+    whole = LocalMethods(df_edge_list)
+    for mmap_mode, kwargs in (('r', {}), (None, {'engine': 'sparse'}), ('r', {'n_jobs': 2})):
+        cached = LocalMethods.from_graph_cache(cache_dir, mmap_mode, **kwargs)
+        assert list(cached.node_labels) == list(np.arange(num_nodes) % 3)
+        for name in LocalMethods.similarity_names + LocalMethods.quasi_local_names:
+            _assert_frame_close(getattr(cached, 'cal_' + name)(), getattr(whole, 'cal_' + name)())
+
+
+def test_incremental_updates():
+    df_edge_list = _random_edge_list()
+    # several added edges share a row and an insert position (after the last neighbour of 0), given in
+    # descending order, the spliced rows must stay sorted
+    neighbors = np.concatenate([df_edge_list['target'][df_edge_list['source'] == 0],
+                                df_edge_list['source'][df_edge_list['target'] == 0]])
+    later = np.setdiff1d(np.concatenate([df_edge_list['source'], df_edge_list['target']]),
+                         np.arange(neighbors.max() + 1))[-3:][::-1]
+    df_added = pd.DataFrame({'source': [0] * len(later) + [3], 'target': list(later) + [0]})
+    df_removed = df_edge_list.iloc[:20]
+
+    test_local = LocalMethods(df_edge_list)
+    df_stored = test_local.cal_common_neighbor_indices()
+    df_stored = apply_similarity_delta(df_stored, test_local.add_edges(df_added))
+    df_stored = apply_similarity_delta(df_stored, test_local.remove_edges(df_removed))
+    adjacency = test_local.get_adjacency()
+    num_nodes = len(adjacency.node_ids)
+    rows = np.repeat(np.arange(num_nodes, dtype=np.int64), adjacency.degree)
+    assert np.all(np.diff(rows * num_nodes + adjacency.indices) >= 0)
+
+    df_final = pd.concat([df_edge_list, df_added], ignore_index=True)
+    removed = df_final.apply(lambda row: frozenset([row['source'], row['target']]), axis=1).isin(
+        set(frozenset(pair) for pair in zip(df_removed['source'], df_removed['target'])))
+    rebuilt = LocalMethods(df_final[~removed.values].reset_index(drop=True))
+    rebuilt_adjacency = rebuilt.get_adjacency()
+    for field in ('node_ids', 'indptr', 'indices', 'degree'):
+        assert np.array_equal(getattr(adjacency, field), getattr(rebuilt_adjacency, field)), field
+    for name in ('PA', 'CN', 'RA'):
+        _assert_frame_close(test_local.cal_top_k(name, 5), rebuilt.cal_top_k(name, 5))
+    _assert_frame_close(test_local.cal_common_neighbor_indices(), rebuilt.cal_common_neighbor_indices())
+    _assert_frame_close(df_stored, rebuilt.cal_common_neighbor_indices())
+
+
+def test_blocked_modes():
+    df_edge_list = _random_edge_list()
+    # a budget of a few walks per block, the blocks must add up to the unblocked results
+    blocked = LocalMethods(df_edge_list, memory_budget=4096)
+    whole = LocalMethods(df_edge_list)
+    for name in ('CN', 'JC', 'RA_CNI'):
+        _assert_frame_close(getattr(blocked, 'cal_' + name)(), getattr(whole, 'cal_' + name)())
+    _assert_frame_close(blocked.cal_LP(), whole.cal_LP())
+    for max_length in (1, 3):
+        _assert_frame_close(blocked.cal_Katz(max_length=max_length), whole.cal_Katz(max_length=max_length))
+    # the pool covers the row blocks of the sparse engine, RA_CNI and the quasi-local indices too
+    pooled = LocalMethods(df_edge_list, engine='sparse', n_jobs=2, memory_budget=4096)
+    for name in ('CN', 'AA', 'RA', 'JC', 'RA_CNI', 'LP', 'Katz'):
+        _assert_frame_close(getattr(pooled, 'cal_' + name)(), getattr(whole, 'cal_' + name)())
+
+
+def test_top_k_modes():
+    df_edge_list = _random_edge_list()
+    whole = LocalMethods(df_edge_list)
+    # half mode and small blocks must not change the top-k, which needs both directions of every pair
+    top_k = LocalMethods(df_edge_list, half=True, memory_budget=4096)
+    for name in ('CN', 'JC', 'RA_CNI'):
+        df_similarity_list = getattr(whole, 'cal_' + name)()
+        df_expected = df_similarity_list.sort_values(['source', 'similarity', 'target'],
+                                                     ascending=[True, False, True]).groupby('source').head(3)
+        _assert_frame_close(top_k.cal_top_k(name, 3), df_expected.reset_index(drop=True))
+    df_katz = whole.cal_Katz()
+    df_expected = df_katz.sort_values(['source', 'similarity', 'target'],
+                                      ascending=[True, False, True]).groupby('source').head(3)
+    _assert_frame_close(top_k.cal_Katz(k=3), df_expected.reset_index(drop=True))
+
+
+def test_similarity_store():
+    df_edge_list = _random_edge_list()
+    # string IDs of different widths, one of them numeric looking
+    names = np.array(['node_%d' % i for i in range(60)], dtype=object)
+    names[5] = '123'
+    df_edge_list = pd.DataFrame({'source': names[df_edge_list['source']], 'target': names[df_edge_list['target']]})
+    df_similarity_list = LocalMethods(df_edge_list, half=True).cal_CN()
+
+    store_base = os.path.join(tempfile.mkdtemp(), 'CN')
+    # stale npy columns of an earlier save must not be indexed
+    for column in SimilarityWriter.npy_columns:
+        np.save('%s.%s.npy' % (store_base, column), np.zeros(3, dtype=np.int32))
+    df_similarity_list.to_csv(store_base, sep=' ', index=False)
+    with open(store_base + '.meta.json', 'w') as meta_file:
+        json.dump({'format': 'csv', 'half': True}, meta_file)
+    store = SimilarityStore(build_similarity_store(store_base, chunk_rows=100))
+
+    df_whole = LocalMethods(df_edge_list).cal_CN()
+    assert len(store) == len(df_whole)
+    assert np.allclose(store.scores(df_whole['source'].values, df_whole['target'].values), df_whole['similarity'])
+    assert store.score(123, 'node_0', default=-1.0) == store.score('123', 'node_0', default=-1.0)
+    df_candidate_list = store.candidates('node_0', 3)
+    df_expected = df_whole[df_whole['source'] == 'node_0'].sort_values(['similarity', 'target'],
+                                                                        ascending=[False, True]).head(3)
+    assert list(df_candidate_list['target']) == list(df_expected['target'])
+    shutil.rmtree(os.path.dirname(store_base))
+
+
+def _simple_edge_list():
+    # the estimates count distinct neighbors, so the graph has no repeated edges nor self loops
+    pairs = np.unique(np.sort(_random_edge_list()[['source', 'target']].values, axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return pd.DataFrame({'source': pairs[:, 0], 'target': pairs[:, 1]})
+
+
+def test_sketch_similarity():
+    df_edge_list = _simple_edge_list()
+    test_local = LocalMethods(df_edge_list)
+    df_jc = test_local.cal_JC()
+
+    # every pair intersected exactly, and sketches holding whole neighbor sets, are both exact
+    _assert_frame_close(test_local.cal_sketch_similarity('JC', exact_degree=len(df_edge_list), hub_degree=None),
+                        df_jc)
+    df_cn = test_local.cal_CN()
+    df_estimate = test_local.cal_sketch_similarity('CN', node_pairs=df_cn[['source', 'target']], exact_degree=0)
+    _assert_frame_close(df_estimate, df_cn)
+
+    # the hubs are not enumerated, the pairs listed through a light neighbour still count them in the estimate
+    hub_degree = int(np.percentile(test_local.get_adjacency().degree, 75))
+    df_hub = test_local.cal_sketch_similarity('CN', exact_degree=0, hub_degree=hub_degree)
+    assert 0 < len(df_hub) < len(df_cn)
+    df_merged = df_cn.merge(df_hub, on=['source', 'target'], how='right', suffixes=('', '_estimate'))
+    _assert_frame_close(df_merged[['source', 'target', 'similarity_estimate']].rename(
+        columns={'similarity_estimate': 'similarity'}), df_merged[['source', 'target', 'similarity']])
+
+    # the light pairs are listed block by block, a small budget lists the same pairs with the same scores
+    for kwargs in ({'memory_budget': 4096}, {'memory_budget': 4096, 'half': True}):
+        blocked_local = LocalMethods(df_edge_list, **kwargs)
+        df_blocked = blocked_local.cal_sketch_similarity('CN', exact_degree=0, hub_degree=hub_degree)
+        df_expected = df_hub[df_hub['source'] < df_hub['target']] if blocked_local.half else df_hub
+        _assert_frame_close(df_blocked, df_expected.reset_index(drop=True))
+
+
+def test_minhash_similarity():
+    test_local = LocalMethods(_simple_edge_list())
+    df_jc = test_local.cal_JC()
+
+    # MinHash only reports pairs with common neighbours, close to JC, and finds the similar ones
+    df_minhash = test_local.cal_minhash_similarity('JC', num_hashes=256, bands=128)
+    df_merged = df_jc.merge(df_minhash, on=['source', 'target'], how='right', suffixes=('', '_estimate'))
+    assert df_merged['similarity'].notna().all()
+    assert np.abs(df_merged['similarity'] - df_merged['similarity_estimate']).max() < 0.15
+    # 128 bands of 2 hashes find the pairs above about 0.09 with high probability
+    df_similar = df_jc[df_jc['similarity'] >= 0.2]
+    assert len(df_similar) > 0
+    assert len(df_similar.merge(df_minhash, on=['source', 'target'])) == len(df_similar)
+
+    # SO is derived from the same estimate
+    df_so = test_local.cal_minhash_similarity('SO', num_hashes=256, bands=128)
+    assert np.allclose(df_so['similarity'], 2 * df_minhash['similarity'] / (1 + df_minhash['similarity']))
+
+
+def test_candidate_similarity():
+    df_edge_list = _random_edge_list()
+    test_local = LocalMethods(df_edge_list)
+    df_common_neighbor_indices = test_local.cal_common_neighbor_indices()
+    df_candidate_similarity = test_local.cal_candidate_similarity(df_common_neighbor_indices[['source', 'target']])
+    _assert_frame_close(df_candidate_similarity[list(df_common_neighbor_indices.columns)], df_common_neighbor_indices)
+    df_ra_cni = test_local.cal_RA_CNI()
+    assert np.allclose(df_candidate_similarity['RA_CNI'], df_ra_cni['similarity'])
+    # a pair without common neighbours only gets PA, a node outside the graph has degree 0
+    df_other = test_local.cal_candidate_similarity(pd.DataFrame({'source': [0, 1000], 'target': [0, 1]}))
+    assert df_other.loc[1, 'PA'] == 0 and df_other.loc[1, 'CN'] == 0
+
+    # an array of pairs in any order, in small batches, gives the rows in the given order
+    order = np.random.default_rng(0).permutation(len(df_common_neighbor_indices))
+    node_pairs = df_common_neighbor_indices[['source', 'target']].values[order]
+    df_shuffled = test_local.cal_candidate_similarity(node_pairs, batch_size=100)
+    _assert_frame_close(df_shuffled, df_candidate_similarity.iloc[order].reset_index(drop=True))
+    assert np.array_equal(df_shuffled['PA'], test_local.cal_PA(node_pairs)['similarity'])
+
+    # compact mode scores the pairs in float32 like every other index
+    compact_local = LocalMethods(df_edge_list, compact=True)
+    df_compact = compact_local.cal_candidate_similarity(node_pairs)
+    assert (df_compact.dtypes[2:] == np.float32).all()
+    assert compact_local.cal_PA(node_pairs)['similarity'].dtype == np.float32
+    assert compact_local.cal_PA()['similarity'].dtype == np.float32
+    assert np.array_equal(compact_local.cal_PA(node_pairs)['similarity'], df_shuffled['PA'])
+
+
 if __name__ == '__main__':
+    test_similarity_writer()
+    test_half_storage()
+    test_graph_cache()
+    test_incremental_updates()
+    test_blocked_modes()
+    test_top_k_modes()
+    test_similarity_store()
+    test_sketch_similarity()
+    test_minhash_similarity()
+    test_candidate_similarity()
     test_similarity()
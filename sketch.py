@@ -0,0 +1,242 @@
+# -*-coding:utf-8-*-
+
+import numpy as np
+
+# the hash functions are h(x) = (a * x + b) mod minhash_prime, a Mersenne prime above every int32 node ID
+minhash_prime = np.uint64((1 << 31) - 1)
+# entries of the CSR arrays hashed at once, bounds the temporaries of the signature pass
+hash_chunk_entries = 1 << 22
+
+
+def _hash_functions(count, seed):
+    """
+    the coefficients a, b of count hash functions h(x) = (a * x + b) mod minhash_prime,
+    a != 0 so every function is a bijection on the node IDs
+    """
+    random_state = np.random.RandomState(seed)
+    hash_a = random_state.randint(1, int(minhash_prime), count).astype(np.uint64)
+    hash_b = random_state.randint(0, int(minhash_prime), count).astype(np.uint64)
+    return hash_a, hash_b
+
+
+def _row_chunks(indptr, indices, degree):
+    """
+    the nodes with neighbors in consecutive chunks of about hash_chunk_entries CSR entries, a row is never split
+    return : generator of (rows, neighbors, row_start) ----> the rows of the chunk, their concatenated neighbor lists
+             as uint64 and the offset of every row in neighbors
+    """
+    rows = np.flatnonzero(np.asarray(degree) > 0)
+    if len(rows) == 0:
+        return
+    indptr = np.asarray(indptr, dtype=np.int64)
+    row_end = indptr[rows + 1]
+    bounds = np.unique(np.searchsorted(row_end, np.arange(0, row_end[-1], hash_chunk_entries), side='right'))
+    bounds = np.append(bounds[bounds < len(rows)], len(rows))
+
+    for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:]):
+        chunk_rows = rows[chunk_start:chunk_end]
+        first_entry = indptr[chunk_rows[0]]
+        neighbors = np.asarray(indices[first_entry:indptr[chunk_rows[-1] + 1]], dtype=np.uint64)
+        yield chunk_rows, neighbors, indptr[chunk_rows] - first_entry
+
+
+def minhash_signatures(indptr, indices, degree, num_hashes=128, seed=0):
+    """
+    this method is implemented for the MinHash signature of every node's neighbor set,
+    signature[x, i] = min over the neighbors w of x of h_i(w), so P(signature[x, i] == signature[y, i]) = J(x, y)
+    repeated neighbors do not change a minimum, the signatures describe neighbor sets
+    input:
+        indptr, indices, degree ----> the CSR adjacency of compact node IDs
+        num_hashes ----> the signature length, the standard error of an estimate is about sqrt(J(1 - J) / num_hashes)
+        seed ----> seed of the hash functions
+    return : signatures, uint32 array of shape (num_nodes, num_hashes),
+             the rows of nodes without neighbors hold minhash_prime and never collide with a real row
+    """
+    hash_a, hash_b = _hash_functions(num_hashes, seed)
+    signatures = np.full((len(degree), num_hashes), minhash_prime, dtype=np.uint32)
+    for rows, neighbors, row_start in _row_chunks(indptr, indices, degree):
+        for hash_index in range(num_hashes):
+            hashed = (hash_a[hash_index] * neighbors + hash_b[hash_index]) % minhash_prime
+            signatures[rows, hash_index] = np.minimum.reduceat(hashed, row_start)
+    return signatures
+
+
+def bottom_k_sketches(indptr, indices, degree, sketch_size=64, seed=0):
+    """
+    this method is implemented for the bottom-k sketch of every node's neighbor set: the sketch_size smallest
+    values of one hash function over the distinct neighbors, the sketch of a set of at most sketch_size
+    elements is the whole set
+    input:
+        indptr, indices, degree ----> the CSR adjacency of compact node IDs
+        sketch_size ----> k, the relative error of an estimate shrinks like 1 / sqrt(k)
+        seed ----> seed of the hash function
+    return : sketches, distinct
+        sketches ----> uint32 array of shape (num_nodes, sketch_size), every row sorted and padded with minhash_prime
+        distinct ----> int64 number of distinct neighbors of every node
+    """
+    hash_a, hash_b = _hash_functions(1, seed)
+    num_nodes = len(degree)
+    sketches = np.full((num_nodes, sketch_size), minhash_prime, dtype=np.uint32)
+    distinct = np.zeros(num_nodes, dtype=np.int64)
+    prime = np.int64(minhash_prime)
+
+    for rows, neighbors, row_start in _row_chunks(indptr, indices, degree):
+        hashed = ((hash_a[0] * neighbors + hash_b[0]) % minhash_prime).astype(np.int64)
+        local_row = np.repeat(np.arange(len(rows), dtype=np.int64), np.diff(np.append(row_start, len(neighbors))))
+        # sorted by row and then hash, repeated neighbors collapse into one key
+        key = np.unique(local_row * prime + hashed)
+        local_row = key // prime
+        count = np.bincount(local_row, minlength=len(rows))
+        distinct[rows] = count
+        rank = np.arange(len(key)) - np.repeat(np.cumsum(count) - count, count)
+        keep = rank < sketch_size
+        sketches[rows[local_row[keep]], rank[keep]] = key[keep] % prime
+    return sketches, distinct
+
+
+def estimate_common_neighbors(sketches, distinct, source, target, batch_size=65536):
+    """
+    estimate |N(x) & N(y)| of every pair from the bottom-k sketches: the k smallest hashes of N(x) | N(y) are
+    among the two sketches, the fraction J of them present in both sketches estimates the Jaccard index and by
+    inclusion-exclusion |N(x) & N(y)| = J * (|N(x)| + |N(y)|) / (1 + J) with the exact distinct degrees,
+    the cost of a pair is O(k) whatever the degrees, and the estimate is exact when |N(x) | N(y)| <= k
+    input: source, target ----> compact node IDs of the pairs
+    return : float64 array aligned on the pairs
+    """
+    sketch_size = sketches.shape[1]
+    common_neighbor = np.zeros(len(source))
+    for start in range(0, len(source), batch_size):
+        batch_x = source[start:start + batch_size]
+        batch_y = target[start:start + batch_size]
+        merged = np.sort(np.concatenate([sketches[batch_x], sketches[batch_y]], axis=1), axis=1)
+
+        repeated = merged[:, 1:] == merged[:, :-1]
+        first = np.ones(merged.shape, dtype=bool)
+        first[:, 1:] = ~repeated
+        first &= merged != minhash_prime
+        # the k smallest distinct hashes of the union
+        sample = first & (np.cumsum(first, axis=1) <= sketch_size)
+        in_both = np.zeros(merged.shape, dtype=bool)
+        in_both[:, :-1] = repeated
+        in_both &= sample
+
+        sample_size = sample.sum(axis=1)
+        jaccard = in_both.sum(axis=1) / np.maximum(sample_size, 1)
+        common_neighbor[start:start + batch_size] = jaccard * (distinct[batch_x] + distinct[batch_y]) / (1 + jaccard)
+    return common_neighbor
+
+
+def lsh_candidate_pairs(signatures, bands, valid=None):
+    """
+    this method is implemented for banded LSH over MinHash signatures, the signature is cut into bands of
+    rows = num_hashes // bands values and two nodes become a candidate pair when any band is identical,
+    a pair of Jaccard similarity J is found with probability 1 - (1 - J ** rows) ** bands,
+    the threshold of the S curve is about (1 / bands) ** (1 / rows)
+    input:
+        signatures ----> the output of minhash_signatures
+        bands ----> more bands find more low similarity pairs at the cost of more candidates
+        valid ----> boolean mask of the nodes to pair, all nodes when None
+    return : source, target ----> int64 compact node IDs of the candidate pairs, source < target, sorted
+    """
+    num_nodes, num_hashes = signatures.shape
+    if bands < 1 or num_hashes % bands != 0:
+        raise ValueError('bands must divide the %d hashes of the signatures' % num_hashes)
+    rows = num_hashes // bands
+    nodes = np.arange(num_nodes) if valid is None else np.flatnonzero(valid)
+
+    random_state = np.random.RandomState(num_hashes * 7919 + bands)
+    multipliers = random_state.randint(1, 1 << 62, rows, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+
+    pair_key = np.zeros(0, dtype=np.int64)
+    for band in range(bands):
+        # one 64 bit key per node and band, distinct bands very rarely share a key
+        band_key = np.zeros(len(nodes), dtype=np.uint64)
+        for row in range(rows):
+            band_key += signatures[nodes, band * rows + row].astype(np.uint64) * multipliers[row]
+
+        order = np.argsort(band_key, kind='stable')
+        sorted_key = band_key[order]
+        group_start = np.flatnonzero(np.concatenate([[True], sorted_key[1:] != sorted_key[:-1]]))
+        group_size = np.diff(np.append(group_start, len(nodes)))
+
+        # every member of a bucket is paired with the members after it
+        position = np.arange(len(nodes), dtype=np.int64)
+        group_end = np.repeat(group_start + group_size, group_size)
+        partner_count = group_end - position - 1
+        first = np.repeat(position, partner_count)
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(partner_count, out=offsets[1:])
+        second = first + 1 + np.arange(offsets[-1]) - np.repeat(offsets[:-1], partner_count)
+
+        node_x = nodes[order[first]].astype(np.int64)
+        node_y = nodes[order[second]].astype(np.int64)
+        band_pairs = np.minimum(node_x, node_y) * num_nodes + np.maximum(node_x, node_y)
+        pair_key = np.union1d(pair_key, band_pairs)
+
+    return pair_key // num_nodes, pair_key % num_nodes
+
+
+def estimate_jaccard(signatures, source, target, batch_size=65536):
+    """
+    the fraction of equal signature values of every pair, an unbiased estimate of the Jaccard similarity
+    input: source, target ----> compact node IDs of the pairs
+    return : float64 array aligned on the pairs
+    """
+    jaccard = np.zeros(len(source))
+    for start in range(0, len(source), batch_size):
+        batch_x = signatures[source[start:start + batch_size]]
+        batch_y = signatures[target[start:start + batch_size]]
+        jaccard[start:start + batch_size] = (batch_x == batch_y).mean(axis=1)
+    return jaccard
+
+
+def minhash_error_report(local_methods, name='JC', threshold=0.5, **settings):
+    """
+    this method is implemented for measuring the approximate mode of LocalMethods.cal_minhash_similarity
+    against the exact index of the same object
+    input:
+        local_methods ----> a LocalMethods
+        name ----> JC or SO
+        threshold ----> the similarity above which a pair counts as relevant for recall and precision
+        settings ----> num_hashes, bands and seed of cal_minhash_similarity
+    return : a dict with
+        exact_pairs, approximate_pairs ----> the number of pairs each mode returns
+        recall ----> the fraction of exact pairs >= threshold that the approximate mode scores >= threshold
+        candidate_recall ----> the fraction of exact pairs >= threshold that the approximate mode returns at all,
+                               the rest was missed by LSH, the difference with recall is estimation noise
+        precision ----> the fraction of approximate pairs >= threshold whose exact score is >= threshold
+        mean_absolute_error, max_absolute_error ----> of the estimates over the pairs both modes return
+    """
+    df_exact = getattr(local_methods, 'cal_' + name)()
+    df_approximate = local_methods.cal_minhash_similarity(name, **settings)
+
+    df_both = df_exact.merge(df_approximate, on=['source', 'target'], how='outer', suffixes=('_exact', '_approx'),
+                             indicator=True)
+    exact = df_both['similarity_exact'].fillna(0.0).values.astype(np.float64)
+    approximate = df_both['similarity_approx'].fillna(0.0).values.astype(np.float64)
+    found = (df_both['_merge'] == 'both').values
+
+    relevant = exact >= threshold
+    retrieved = approximate >= threshold
+    error = np.abs(exact[found] - approximate[found])
+    return {'name': name, 'threshold': threshold,
+            'exact_pairs': len(df_exact), 'approximate_pairs': len(df_approximate),
+            'recall': float((relevant & retrieved).sum()) / max(int(relevant.sum()), 1),
+            'candidate_recall': float((relevant & found).sum()) / max(int(relevant.sum()), 1),
+            'precision': float((relevant & retrieved).sum()) / max(int(retrieved.sum()), 1),
+            'mean_absolute_error': float(error.mean()) if len(error) else 0.0,
+            'max_absolute_error': float(error.max()) if len(error) else 0.0}
+
+
+if __name__ == '__main__':
+    import json
+
+    import pandas as pd
+
+    from similarity import LocalMethods
+
+    edge_file_name = 'transformed_dataset/citeseer/citeseer.edges'
+    df_edge_list = pd.read_csv(edge_file_name, sep=r'\s+', low_memory=False)
+    test_local = LocalMethods(df_edge_list)
+    for name in ('JC', 'SO'):
+        print(json.dumps(minhash_error_report(test_local, name, threshold=0.5, num_hashes=128, bands=32)))